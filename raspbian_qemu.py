@@ -0,0 +1,3521 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Marc Meadows
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    raspbian_qemu - Handy tool for non-privileged manipulation and
+                    qemu-emulation of Raspbian images.
+
+    Run as the raspbian-qemu script, which imports this module so its
+    bytecode is cached rather than compiled on every run.
+"""
+
+# Only what's needed to parse the command line and run an image is imported
+# here, to keep start up quick.  The rest is imported where it's used.
+import argparse
+import collections
+import contextlib
+import errno
+import io
+import fnmatch
+import functools
+import os
+import re
+import select
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+__version__ = "0.0.10"
+
+# The functions and classes for using the tool from Python rather than the
+# command line.  The rest may change without notice.
+__all__ = ["prep", "unprep", "shrink", "compact_image", "compress_image",
+           "diff_images", "patch_image", "extract", "run_image", "run_many",
+           "snapshot", "build_kernel", "emulator_args", "drive_options",
+           "MACHINES", "CONFIG_PROFILES", "ImageCache", "KernelCache",
+           "ChunkStore", "FilesystemImage", "Ext4Image", "read_partitions",
+           "resize_partition", "data_copy"]
+
+RESIZE2FS = "resize2fs"         # file system resizier
+E2FSCK    = "e2fsck"            # file system checker
+DEBUGFS   = "debugfs"           # file system manipulator
+QEMU      = "qemu-system-arm"   # hardware emulator
+QEMU_IMG  = "qemu-img"          # emulator disk image manipulator
+MAKE      = "make"              # project builder
+PATCH     = "patch"             # patcher
+CCACHE    = "ccache"            # compiler cache
+ZSTD      = "zstd"              # compressor
+
+KERNEL_BINARY = "kernel-qemu"
+
+# Milestones run --timeline records the first time of on the console, as
+# (name, regular expression) in the order they are expected to occur.
+TIMELINE_MILESTONES = (
+    ("kernel",     r"Booting Linux"),
+    ("root-mount", r"VFS: Mounted root"),
+    ("init",       r"Run /sbin/init|INIT: version|systemd\[1\]: "),
+    ("ssh",        r"Started OpenBSD Secure Shell|Started ssh\.service"
+                   r"|Starting OpenBSD Secure Shell server: sshd"),
+    ("getty",      r"login: "),
+    ("shutdown",   r"reboot: |Power down|System halted|Attempted to kill init"),
+)
+
+# How much of the end of an unfinished console line is searched for prompts.
+TIMELINE_PROMPT_SCAN = 1024
+
+# Console output that means a booted image is ready to be snapshotted: the
+# getty on the serial console prompting for a login.
+SNAPSHOT_READY = "login: "
+
+@functools.lru_cache(maxsize=None)
+def find_tool(tool):
+    """Return the absolute path of tool, looked up on PATH like the shell
+    would but without running it, or None if it's not there."""
+    return shutil.which(tool)
+
+def run(cmd, input=None):
+    """Run cmd, feeding it input (if any) and capturing stdout and stderr.
+       Raises CalledProcessError if the return code is non-zero."""
+    cmd = [find_tool(cmd[0]) or cmd[0]] + list(cmd[1:])
+    kwargs = {
+        "stdout": subprocess.PIPE,
+        "stderr": subprocess.PIPE,
+    }
+    if input:
+        kwargs["stdin"] = subprocess.PIPE
+
+    if run.debug:
+        # Don't flood the terminal with large inputs, like chunks of images.
+        shown = repr(input) if input is None or len(input) <= 1024 \
+                else "<%d bytes of input>" % (len(input),)
+        print("cmd:", " ".join(cmd), shown)
+
+    with subprocess.Popen(cmd, **kwargs) as process:
+        try:
+            stdout, stderr = process.communicate(input)
+        except:
+            process.kill()
+            process.wait()
+            raise
+        retcode = process.poll()
+        if retcode:
+            e = subprocess.CalledProcessError(retcode, process.args,
+                                              output=stdout, stderr=stderr)
+            if run.debug:
+                print(e, e.stdout, e.stderr)
+            raise e
+    if run.debug and stderr:
+        print("stderr:", stderr)
+    return stdout
+run.debug = False
+
+def resolve_suffix(suffixed):
+    """Given a suffixed value, return an appropriate integer.
+         * None will return None,
+         * An int will return the same int.
+         * A string without a suffix will return an int of that string.
+         * A string with a suffix of K/M/G will multiply out the base by the
+           appropriate unit.
+       Suffix is case-insensitive.
+    """
+    if suffixed is not None:
+        try:
+            suffixed = int(suffixed)
+        except ValueError:
+            unit_multiplier = {"K": 1024,
+                               "M": 1024**2,
+                               "G": 1024**3}[suffixed[-1].upper()]
+            suffixed = int(suffixed[:-1]) * unit_multiplier
+    return suffixed
+
+FALLOC_FL_KEEP_SIZE  = 0x01   # from linux/falloc.h
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+def data_extents(file, start, end):
+    """Generator which yields (begin, end) tuples for the ranges of file
+    between start and end that contain data, skipping over holes using
+    SEEK_DATA/SEEK_HOLE.  File systems that don't know about holes report
+    the whole range as data."""
+    fd = file.fileno()
+    while start < end:
+        try:
+            begin = os.lseek(fd, start, os.SEEK_DATA)
+        except OSError as e:
+            # ENXIO means there is no more data past start.
+            if e.errno != errno.ENXIO:
+                yield start, end
+            return
+        except AttributeError:
+            yield start, end
+            return
+        if begin >= end:
+            return
+        start = min(os.lseek(fd, begin, os.SEEK_HOLE), end)
+        yield begin, start
+
+def punch_hole(file, offset, length):
+    """Deallocate length bytes of file at offset, leaving a hole that reads
+    back as zeros.  Falls back to writing zeros if the file system or the
+    platform can't punch holes."""
+    import ctypes
+    if not length:
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    fallocate = getattr(libc, "fallocate", None)
+    if fallocate is not None:
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                              ctypes.c_int64, ctypes.c_int64]
+        if not fallocate(file.fileno(),
+                         FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                         offset, length):
+            return
+
+    zeros = bytes(min(length, 4 * 1024 * 1024))
+    file.seek(offset)
+    while length:
+        length -= file.write(zeros[:length])
+
+# Ways data_copy can move data, from fastest to slowest.
+#   reflink         - share the source blocks with FICLONERANGE (btrfs, XFS).
+#   copy_file_range - copy in the kernel, possibly offloaded to the storage.
+#   sendfile        - copy in the kernel through the page cache.
+#   buffered        - read and write through a buffer in user space.
+COPY_STRATEGIES = ("reflink", "copy_file_range", "sendfile", "buffered")
+
+FICLONERANGE = 0x4020940D       # _IOW(0x94, 13, struct file_clone_range)
+
+# Errors which mean a copy strategy isn't available for a pair of files,
+# rather than that something is actually wrong.
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                      errno.EOPNOTSUPP, errno.ENOTTY}
+
+def reflink(source_file, dest_file, begin, end, dest_begin):
+    """Clone the source range begin to end into dest at dest_begin so the
+    two files share blocks.  Returns False if that isn't possible, which it
+    only is for block-aligned ranges on the same reflink-capable file
+    system."""
+    import fcntl
+    clone_range = struct.pack("qQQQ", source_file.fileno(),
+                              begin, end - begin, dest_begin)
+    try:
+        fcntl.ioctl(dest_file.fileno(), FICLONERANGE, clone_range)
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS:
+            raise
+        return False
+    return True
+
+def kernel_copy(strategy, source_file, dest_file, begin, end, dest_begin):
+    """Copy source range begin to end to dest at dest_begin without
+    passing the data through user space, using strategy, which must be
+    copy_file_range or sendfile.  Raises OSError if the strategy isn't
+    supported."""
+    source_fd = source_file.fileno()
+    dest_fd = dest_file.fileno()
+    if strategy == "sendfile":
+        # sendfile writes at the current position of the dest.
+        dest_file.seek(dest_begin)
+    elif not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+
+    while begin < end:
+        if strategy == "sendfile":
+            copied = os.sendfile(dest_fd, source_fd, begin, end - begin)
+        else:
+            copied = os.copy_file_range(source_fd, dest_fd, end - begin,
+                                        begin, dest_begin)
+        if not copied:
+            break
+        begin += copied
+        dest_begin += copied
+
+def data_copy(source, dest, source_offset=0, dest_offset=0, count=None):
+    """Copy count bytes from file source to file dest, optionally
+    skipping source_offset/dest_offset bytes respectively.
+
+    The copy is sparse: only ranges of source holding data are read, and
+    holes or all-zero chunks are left as holes in dest rather than written
+    out.  So copy time depends on the data stored, not the size of source.
+
+    The fastest strategy in COPY_STRATEGIES that works for the files is
+    used, and its name is returned."""
+    count = resolve_suffix(count)
+    source_end = os.path.getsize(source)
+    if count is not None:
+        source_end = min(source_end, source_offset + count)
+    source_end = max(source_end, source_offset)
+    dest_mode = "r+b" if os.path.exists(dest) else "wb"
+    with io.open(source, "rb", 0) as source_file, \
+         io.open(dest, dest_mode, 0) as dest_file:
+        # Anything in dest past its current size is already a hole, only
+        # existing data needs to be punched out.
+        dest_size = os.fstat(dest_file.fileno()).st_size
+        delta = dest_offset - source_offset
+        strategies = iter(COPY_STRATEGIES)
+
+        # Only the buffered copy reads ahead of what it writes, which
+        # overlapping ranges within the same file need.
+        if os.path.samestat(os.fstat(source_file.fileno()),
+                            os.fstat(dest_file.fileno())) \
+           and source_offset < source_end + delta \
+           and dest_offset < source_end:
+            strategies = iter(("buffered",))
+        strategy = next(strategies)
+
+        def zero(begin, end):
+            """Make the dest range matching source begin to end read
+            as zeros."""
+            begin = begin + delta
+            end = min(end + delta, dest_size)
+            if begin < end:
+                punch_hole(dest_file, begin, end - begin)
+
+        buf = bytearray(4 * 1024 * 1024)
+        zeros = bytes(len(buf))
+
+        def buffered_copy(begin, end):
+            """Copy the source range begin to end through buf, leaving
+            holes for any chunks that are all zeros."""
+            source_file.seek(begin)
+            while begin < end:
+                chunk = memoryview(buf)[:min(len(buf), end - begin)]
+                read_count = source_file.readinto(chunk)
+                if not read_count:
+                    break
+                if read_count == len(buf):
+                    all_zeros = buf == zeros
+                else:
+                    all_zeros = buf[:read_count] == zeros[:read_count]
+                if all_zeros:
+                    zero(begin, begin + read_count)
+                else:
+                    dest_file.seek(begin + delta)
+                    dest_file.write(chunk[:read_count])
+                begin += read_count
+
+        # A reflink clones holes and data alike, so when it works it's the
+        # whole copy.
+        position = source_offset
+        if strategy == "reflink":
+            if source_end > source_offset \
+               and reflink(source_file, dest_file, source_offset, source_end,
+                           dest_offset):
+                position = source_end
+            else:
+                strategy = next(strategies)
+
+        for begin, end in data_extents(source_file, position, source_end):
+            zero(position, begin)
+            while strategy != "buffered":
+                try:
+                    kernel_copy(strategy, source_file, dest_file,
+                                begin, end, begin + delta)
+                    break
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED_ERRNOS:
+                        raise
+                    strategy = next(strategies)
+            else:
+                buffered_copy(begin, end)
+            position = end
+        zero(position, source_end)
+
+        dest_file.truncate(source_end + delta)
+
+    if run.debug:
+        print("data_copy:", strategy, source, "->", dest)
+    return strategy
+
+# Compressed images prep can start from, by extension.
+COMPRESSED_EXTENSIONS = (".gz", ".xz", ".zip")
+
+def decompressed_name(image):
+    """Return the name of image with its compression extension removed,
+    ending in .img for zip files, which name their contents after the
+    archive."""
+    base, extension = os.path.splitext(image)
+    if extension == ".zip" and not base.endswith(".img"):
+        base += ".img"
+    return base
+
+@contextlib.contextmanager
+def open_compressed(image):
+    """Context manager yielding a file object of the decompressed contents
+    of image, which is compressed according to its extension.  For zip
+    files, that's the first member that's an image."""
+    import gzip, lzma, zipfile
+    extension = os.path.splitext(image)[1]
+    if extension == ".gz":
+        with gzip.open(image) as decompressed:
+            yield decompressed
+    elif extension == ".xz":
+        with lzma.open(image) as decompressed:
+            yield decompressed
+    elif extension == ".zip":
+        with zipfile.ZipFile(image) as archive:
+            names = fnmatch.filter(archive.namelist(), "*.img") or archive.namelist()
+            if not names:
+                raise ValueError("No image in %s." % (image,))
+            with archive.open(names[0]) as decompressed:
+                yield decompressed
+    else:
+        raise ValueError("Unknown compression for %s." % (image,))
+
+def decompress(image, dest):
+    """Decompress image into the file dest as it streams in, leaving holes
+    for the runs of zeros which make up much of a disk image rather than
+    writing them out."""
+    CHUNK = 64 * 1024
+    zeros = bytes(CHUNK)
+    with open_compressed(image) as decompressed, \
+         io.open(dest, "wb", 0) as dest_file:
+        buf = bytearray(CHUNK)
+        size = 0
+        while True:
+            read_count = decompressed.readinto(buf)
+            if not read_count:
+                break
+            if read_count == CHUNK and buf == zeros:
+                dest_file.seek(CHUNK, os.SEEK_CUR)
+            else:
+                dest_file.write(memoryview(buf)[:read_count])
+            size += read_count
+        dest_file.truncate(size)
+
+# Compressions compress_image() can write, by name, with the extension of
+# the files they write.
+COMPRESSIONS = collections.OrderedDict((
+    ("xz", ".xz"),
+    ("zstd", ".zst"),
+    ("gz", ".gz"),
+))
+
+def compress_chunk(compression, data):
+    """Return data compressed with compression as a complete stream."""
+    if compression == "gz":
+        import gzip
+        return gzip.compress(data, mtime=0)
+    elif compression == "xz":
+        import lzma
+        return lzma.compress(data)
+    elif compression == "zstd":
+        return run([ZSTD, "-q", "-c"], input=data)
+    raise ValueError("Unknown compression %s." % (compression,))
+
+def compress_image(image, dest, compression, jobs=None, index=None,
+                   chunk_size=16 * 1024 * 1024):
+    """Compress image into the file dest with compression, using jobs
+    threads (one per CPU by default).
+
+    The image is compressed in chunks of chunk_size bytes, each on its own
+    into a complete stream.  Streams written one after the other decompress
+    as one, so dest is an ordinary compressed file, but the chunks can be
+    compressed in parallel.  Chunks that are holes or all zeros in image
+    aren't read or compressed again, they all reuse the same stream.
+
+    If index is given, a JSON index of where each chunk's stream starts in
+    dest and in image is written to it, so parts of dest can be decompressed
+    without decompressing everything before them."""
+    import concurrent.futures
+    import json
+    jobs = jobs or os.cpu_count()
+    size = os.path.getsize(image)
+    zeros = bytes(chunk_size)
+
+    @functools.lru_cache(maxsize=None)
+    def compressed_zeros(length):
+        """Return a stream of length compressed zeros."""
+        return compress_chunk(compression, zeros[:length])
+
+    with io.open(image, "rb", 0) as imagefile, open(dest, "wb") as destfile:
+        with_data = set()
+        for begin, end in data_extents(imagefile, 0, size):
+            with_data.update(range(begin // chunk_size, (end - 1) // chunk_size + 1))
+
+        def compress(chunk):
+            """Return the stream for chunk number chunk."""
+            length = min(chunk_size, size - chunk * chunk_size)
+            if chunk in with_data:
+                data = os.pread(imagefile.fileno(), length, chunk * chunk_size)
+                if data != zeros[:length]:
+                    return compress_chunk(compression, data)
+            return compressed_zeros(length)
+
+        # zlib and lzma let other threads run while they compress, and zstd
+        # runs in its own process, so threads are enough to use every CPU.
+        # Only a couple of chunks per thread are read ahead of what's been
+        # written, to bound memory use.
+        entries = []
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            pending = collections.deque()
+
+            def write_next():
+                """Write out the oldest pending chunk's stream."""
+                stream = pending.popleft().result()
+                entries.append((len(entries) * chunk_size, destfile.tell(),
+                                len(stream)))
+                destfile.write(stream)
+
+            for chunk in range((size + chunk_size - 1) // chunk_size):
+                pending.append(pool.submit(compress, chunk))
+                if len(pending) >= 2 * jobs:
+                    write_next()
+            while pending:
+                write_next()
+
+    if index is not None:
+        with open(index, "w") as indexfile:
+            json.dump({"compression": compression,
+                       "size": size,
+                       "chunk_size": chunk_size,
+                       # (offset in image, offset in dest, length in dest)
+                       "chunks": entries,
+                      }, indexfile)
+
+class FilesystemImage:
+    """Wrapper around debugfs to expose operations on an ext[234] filesystem
+    image.
+
+    Used as a context manager, one debugfs session is kept open for all of
+    the operations instead of starting debugfs for each one.  Changes are
+    queued and sent to it in a batch whenever a read needs to see them or
+    the context closes, and dropped if the context closes with an
+    exception.  Batches already sent for a read stay made, so only the
+    changes since the last read are dropped."""
+    IFLAGS_DIRECTORY    = 0x4000
+    IFLAGS_REGULAR_FILE = 0x8000
+    IFLAGS_PERMISSIONS  = 0x01FF
+
+    # debugfs echoes comment lines, so a comment marks the end of the
+    # output of each command in a session.  Its stdout is fully buffered
+    # when it's a pipe, so follow the mark with enough comments to push it
+    # out of the buffer.
+    PADDING = (b"#" * 4095 + b"\n") * 4
+
+    def __init__(self, image, read_only=False):
+        """Create wrapper for image file image."""
+        self.image = image
+        self.read_only = read_only
+        self.session = None
+
+    def __enter__(self):
+        """Start a debugfs session."""
+        cmd = [find_tool(DEBUGFS) or DEBUGFS, "-f", "-", self.image]
+        if not self.read_only:
+            cmd.insert(1, "-w")
+        if run.debug:
+            print("cmd:", " ".join(cmd))
+        self.pending = []
+        self.injects = tempfile.TemporaryDirectory()
+        self.token = os.urandom(8).hex().encode()
+        self.marks = 0
+        self.session = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=None if run.debug
+                                               else subprocess.DEVNULL)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Send any queued changes, unless closing because of an exception,
+        and end the debugfs session."""
+        session, self.session = self.session, None
+        try:
+            batch = self.batch(self.pending) if exc_type is None else b""
+            try:
+                session.communicate(batch)
+            except:
+                session.kill()
+                session.wait()
+                raise
+        finally:
+            self.injects.cleanup()
+        if session.returncode and exc_type is None:
+            raise subprocess.CalledProcessError(session.returncode,
+                                                session.args)
+
+    def batch(self, commands):
+        """Return commands as input for a debugfs session."""
+        if run.debug:
+            for command in commands:
+                print("debugfs:", command)
+        return b"".join(command.encode() + b"\n" for command in commands)
+
+    def request(self, command):
+        """Run command in the session, after any queued changes, and return
+        its output."""
+        self.marks += 1
+        mark = b"# raspbian-qemu %s %d\n" % (self.token, self.marks)
+        commands, self.pending = self.pending + [command], []
+        self.session.stdin.write(self.batch(commands) + mark + self.PADDING)
+        self.session.stdin.flush()
+
+        output = bytearray()
+        searched = 0
+        while True:
+            # Only search what's new, but from far enough back to find a
+            # mark split across reads.
+            mark_at = output.find(mark, max(0, searched - len(mark) + 1))
+            if mark_at >= 0:
+                break
+            searched = len(output)
+            chunk = self.session.stdout.read1(64 * 1024)
+            if not chunk:
+                raise subprocess.CalledProcessError(self.session.wait(),
+                                                    self.session.args)
+            output += chunk
+
+        # Skip over the end of the previous padding, the echo of any queued
+        # commands, and the echo of command itself.
+        echo = b"debugfs: " + command.encode() + b"\n"
+        echo_at = output.find(echo, 0, mark_at)
+        if echo_at < 0:
+            raise ValueError("debugfs didn't echo %r." % (command,))
+        return bytes(output[echo_at + len(echo):mark_at])
+
+    def debugfs(self, commands, *, write=False):
+        """Run the list of debugfs commands, opening the image for writing
+        if write is True.  Returns the output.
+
+        Without a session, this runs debugfs.  In a session, commands which
+        write are queued and return nothing, and others are run right away
+        and must be a single command."""
+        if self.session is None:
+            cmd = [DEBUGFS, self.image]
+            if write:
+                cmd.insert(1, "-w")
+            if len(commands) == 1:
+                return run(cmd + ["-R", commands[0]])
+            return run(cmd + ["-f", "-"], input="\n".join(commands).encode())
+
+        if write:
+            self.pending += commands
+            return b""
+        command, = commands
+        return self.request(command)
+
+    def cat(self, filespec):
+        """Return the contents of filespec."""
+        return self.debugfs(["cat " + filespec])
+
+    def rm(self, filespec):
+        """Remove the file filespec."""
+        return self.debugfs(["rm " + filespec], write=True)
+
+    def ls(self, path, filename_match="*"):
+        """Return a list of TarInfo objects for the files in path."""
+        import tarfile
+        lines = self.debugfs(["ls -p " + path]).splitlines()
+        for line in lines:
+            if not line:
+                continue
+            ignore, inode, iflags, uid, gid, filename, size, ignore = line.split(b"/", maxsplit=7)
+            file = tarfile.TarInfo(filename.decode())
+            iflags = int(iflags, 8)
+            if iflags & self.IFLAGS_REGULAR_FILE:
+                file.type = tarfile.REGTYPE
+            elif iflags & self.IFLAGS_DIRECTORY:
+                file.type = tarfile.DIRTYPE
+            else:
+                print("%4X" % (iflags,))
+                raise NotImplementedError
+            file.mode = iflags & self.IFLAGS_PERMISSIONS
+            file.uid = int(uid)
+            file.gid = int(gid)
+            if size:
+                file.size = int(size)
+            if filename not in (b".", b"..") \
+               and fnmatch.fnmatch(file.name, filename_match):
+                yield file
+
+    def setstat_commands(self, filespec, uid=None, gid=None, mode=None, directory=False):
+        """Return the debugfs commands for setstat()."""
+        debugfs_cmds = []
+        if uid is not None:
+            debugfs_cmds.append("set_inode_field " + " ".join([filespec, "uid", str(uid)]))
+        if gid is not None:
+            debugfs_cmds.append("set_inode_field " + " ".join([filespec, "gid", str(gid)]))
+        if mode is not None:
+            if directory:
+                i_mode = self.IFLAGS_DIRECTORY | mode
+            else:
+                i_mode = self.IFLAGS_REGULAR_FILE | mode
+            debugfs_cmds.append("set_inode_field " + " ".join([filespec, "mode", str(i_mode)]))
+        return debugfs_cmds
+
+    def setstat(self, filespec, uid=None, gid=None, mode=None, directory=False):
+        """Set any combination of uid, gid, and mode for file filespec.  If
+        filespec represents a directory, directory must be passed in as True."""
+        debugfs_cmds = self.setstat_commands(filespec, uid, gid, mode, directory)
+        if debugfs_cmds:
+            self.debugfs(debugfs_cmds, write=True)
+
+    def mkdir(self, filespec, uid=None, gid=None, mode=None):
+        """Make a directory filespec with optional stats."""
+        debugfs_cmds = ["mkdir " + filespec]
+        debugfs_cmds += self.setstat_commands(filespec, uid, gid, mode,
+                                              directory=True)
+        self.debugfs(debugfs_cmds, write=True)
+
+    def write(self, filespec, contents, uid=None, gid=None, mode=None):
+        """Write contents to the file filespec with optional stats."""
+        directory = os.path.dirname(filespec)
+        filename  = os.path.basename(filespec)
+
+        # In a session the file to inject has to outlive this call, since
+        # the write is only queued.
+        if self.session is None:
+            inject = tempfile.NamedTemporaryFile()
+        else:
+            inject = tempfile.NamedTemporaryFile(dir=self.injects.name,
+                                                 delete=False)
+        with inject:
+            inject.write(contents)
+            inject.flush()
+            #NOTE: rm of a missing file is a NOP and it's required for
+            #      overwriting.
+            debugfs_cmds = ["cd " + directory,
+                            "rm " + filename,
+                            "write " + inject.name + " "+ filename,
+                           ]
+            debugfs_cmds += self.setstat_commands(filespec, uid, gid, mode)
+
+            self.debugfs(debugfs_cmds, write=True)
+
+class Ext4Image:
+    """Native, read-only reader for an ext[234] filesystem image, offering
+    the same cat() and ls() as FilesystemImage without running debugfs.
+
+    Must be used as a context manager, which maps the image into memory.
+    Inodes are only read as they're needed, and blocks go through an LRU
+    cache.  Reads the file system as it is on disk, like debugfs, so a
+    journal that needs recovery is not replayed."""
+    MAGIC           = 0xEF53
+    ROOT_INODE      = 2
+    INCOMPAT_FILETYPE = 0x0002
+    INCOMPAT_RECOVER = 0x0004
+    INCOMPAT_64BIT  = 0x0080
+    BLOCK_UNINIT    = 0x0002
+    EXTENTS_FL      = 0x00080000
+    INLINE_DATA_FL  = 0x10000000
+    EXTENT_MAGIC    = 0xF30A
+    EXTENT_UNWRITTEN = 32768
+    XATTR_MAGIC     = b"\x00\x00\x02\xEA"
+    XATTR_SYSTEM    = 7
+
+    # The tarfile type for each file type in the inode's mode.
+    FILE_TYPES = {0x1000: "FIFOTYPE",
+                  0x2000: "CHRTYPE",
+                  0x4000: "DIRTYPE",
+                  0x6000: "BLKTYPE",
+                  0x8000: "REGTYPE",
+                  0xA000: "SYMTYPE",
+                 }
+
+    Inode = collections.namedtuple("Inode", ("mode", "uid", "gid", "size",
+                                             "flags", "block"))
+
+    # The bits of each byte of a bitmap as "0"s and "1"s, lowest bit first.
+    BITS = [format(byte, "08b")[::-1] for byte in range(256)]
+
+    def __init__(self, image):
+        """Create reader for image file (or filespec) image."""
+        self.image = image
+
+    def __enter__(self):
+        """Map the image and read its superblock and group descriptors."""
+        import mmap
+        image, self.offset = split_filespec(self.image)
+        with open(image, "rb") as imagefile:
+            self.map = mmap.mmap(imagefile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        superblock = self.read(1024, 1024)
+        (blocks_count,) = struct.unpack_from("<I", superblock, 0x04)
+        (first_data_block, log_block_size) = struct.unpack_from("<2I", superblock, 0x14)
+        (self.blocks_per_group,) = struct.unpack_from("<I", superblock, 0x20)
+        (self.inodes_per_group,) = struct.unpack_from("<I", superblock, 0x28)
+        (magic,) = struct.unpack_from("<H", superblock, 0x38)
+        (rev_level,) = struct.unpack_from("<I", superblock, 0x4C)
+        (inode_size,) = struct.unpack_from("<H", superblock, 0x58)
+        (self.feature_incompat,) = struct.unpack_from("<I", superblock, 0x60)
+        (desc_size,) = struct.unpack_from("<H", superblock, 0xFE)
+        if magic != self.MAGIC:
+            self.map.close()
+            raise ValueError("%s is not an ext[234] filesystem." % (self.image,))
+
+        self.block_size = 1024 << log_block_size
+        self.inode_size = inode_size if rev_level else 128
+        if self.feature_incompat & self.INCOMPAT_64BIT:
+            (blocks_count_hi,) = struct.unpack_from("<I", superblock, 0x150)
+            blocks_count |= blocks_count_hi << 32
+        else:
+            desc_size = 32
+        self.blocks_count = blocks_count
+        self.first_data_block = first_data_block
+        self.desc_size = desc_size
+        self.descriptors = (first_data_block + 1) * self.block_size
+
+        self.block = functools.lru_cache(maxsize=1024)(self.block)
+        self.inode = functools.lru_cache(maxsize=256)(self.inode)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.map.close()
+
+    def read(self, offset, count):
+        """Return count bytes at offset within the filesystem."""
+        offset += self.offset
+        return self.map[offset:offset + count]
+
+    def block(self, number):
+        """Return the contents of block number."""
+        return self.read(number * self.block_size, self.block_size)
+
+    def group_descriptor(self, group):
+        """Return the raw group descriptor of block group group."""
+        return self.read(self.descriptors + group * self.desc_size,
+                         self.desc_size)
+
+    def inode(self, number):
+        """Return the Inode for inode number."""
+        group, index = divmod(number - 1, self.inodes_per_group)
+        descriptor = self.group_descriptor(group)
+        (table,) = struct.unpack_from("<I", descriptor, 0x08)
+        if self.desc_size >= 64:
+            (table_hi,) = struct.unpack_from("<I", descriptor, 0x28)
+            table |= table_hi << 32
+
+        raw = self.read(table * self.block_size + index * self.inode_size,
+                        self.inode_size)
+        mode, uid, size = struct.unpack_from("<2HI", raw, 0x00)
+        gid, = struct.unpack_from("<H", raw, 0x18)
+        flags, = struct.unpack_from("<I", raw, 0x20)
+        size_hi, = struct.unpack_from("<I", raw, 0x6C)
+        uid_hi, gid_hi = struct.unpack_from("<2H", raw, 0x78)
+        block = raw[0x28:0x28 + 60]
+        if flags & self.INLINE_DATA_FL:
+            block += self.inline_data_tail(raw)
+        return self.Inode(mode, uid | uid_hi << 16, gid | gid_hi << 16,
+                          size | size_hi << 32, flags, block)
+
+    def inline_data_tail(self, raw):
+        """Return the inline data of the raw inode raw that didn't fit in
+        its block map, which is kept in its system.data extended attribute
+        in the space after the inode."""
+        if len(raw) <= 128 + 4:
+            return b""
+        (extra_size,) = struct.unpack_from("<H", raw, 0x80)
+        start = 128 + extra_size
+        if raw[start:start + 4] != self.XATTR_MAGIC:
+            return b""
+        # Entries follow the magic, with their values at offsets from the
+        # first entry.  The list ends with four zero bytes.
+        start += 4
+        at = start
+        while at + 16 <= len(raw) and raw[at:at + 4] != bytes(4):
+            name_len, name_index, value_offs, value_inum, value_size = \
+                struct.unpack_from("<2BHII", raw, at)
+            name = raw[at + 16:at + 16 + name_len]
+            if name_index == self.XATTR_SYSTEM and name == b"data" and not value_inum:
+                return raw[start + value_offs:start + value_offs + value_size]
+            at += (16 + name_len + 3) & ~3
+        return b""
+
+    def extents(self, node):
+        """Generator yielding (logical, physical, count) block runs for the
+        extent tree node."""
+        magic, entries, ignore, depth = struct.unpack_from("<4H", node, 0)
+        if magic != self.EXTENT_MAGIC:
+            raise ValueError("Bad extent tree in %s." % (self.image,))
+        for entry in range(entries):
+            at = 12 + entry * 12
+            if depth:
+                logical, leaf, leaf_hi = struct.unpack_from("<2IH", node, at)
+                yield from self.extents(self.block(leaf | leaf_hi << 32))
+            else:
+                logical, count, start_hi, start = struct.unpack_from("<I2HI", node, at)
+                # Unwritten extents read back as zeros, so leave them holes.
+                if count <= self.EXTENT_UNWRITTEN:
+                    yield logical, start | start_hi << 32, count
+
+    def block_map(self, block):
+        """Generator yielding (logical, physical, count) block runs for an
+        ext2/3 style direct/indirect block map."""
+        pointers = self.block_size // 4
+        def walk(number, depth, logical):
+            """Walk pointer block number, depth levels above the data."""
+            if not depth:
+                yield logical, number, 1
+                return
+            span = pointers ** (depth - 1)
+            for index, child in enumerate(struct.unpack("<%dI" % pointers,
+                                                        self.block(number))):
+                if child:
+                    yield from walk(child, depth - 1, logical + index * span)
+
+        numbers = struct.unpack("<15I", block)
+        logical = 0
+        for depth, number in zip([0] * 12 + [1, 2, 3], numbers):
+            if number:
+                yield from walk(number, depth, logical)
+            logical += pointers ** depth
+
+    def free_ranges(self):
+        """Generator yielding (offset, length) byte ranges within the file
+        system of blocks its block bitmaps mark as free.  Groups whose
+        bitmap was never initialized are skipped rather than worked out.
+        Raises ValueError if the journal needs recovery, since the bitmaps
+        may not be up to date until it's replayed."""
+        if self.feature_incompat & self.INCOMPAT_RECOVER:
+            raise ValueError("%s needs journal recovery, run e2fsck on it first."
+                             % (self.image,))
+        groups = -(-(self.blocks_count - self.first_data_block)
+                   // self.blocks_per_group)
+        run_start = run_end = None
+        for group in range(groups):
+            descriptor = self.group_descriptor(group)
+            (bitmap,) = struct.unpack_from("<I", descriptor, 0x00)
+            (flags,) = struct.unpack_from("<H", descriptor, 0x12)
+            if self.desc_size >= 64:
+                (bitmap_hi,) = struct.unpack_from("<I", descriptor, 0x20)
+                bitmap |= bitmap_hi << 32
+            if flags & self.BLOCK_UNINIT:
+                continue
+
+            first = self.first_data_block + group * self.blocks_per_group
+            count = min(self.blocks_per_group, self.blocks_count - first)
+            bits = "".join(self.BITS[byte] for byte
+                           in self.block(bitmap)[:-(-count // 8)])[:count]
+            for free in re.finditer("0+", bits):
+                start, end = first + free.start(), first + free.end()
+                if start != run_end:
+                    if run_start is not None:
+                        yield (run_start * self.block_size,
+                               (run_end - run_start) * self.block_size)
+                    run_start = start
+                run_end = end
+        if run_start is not None:
+            yield (run_start * self.block_size,
+                   (run_end - run_start) * self.block_size)
+
+    def contents(self, inode):
+        """Return the contents of the Inode inode."""
+        if inode.flags & self.INLINE_DATA_FL:
+            return inode.block[:inode.size]
+        if inode.mode & 0xF000 == 0xA000 and inode.size < 60:
+            # A fast symlink, with its target where the block map would be.
+            return inode.block[:inode.size]
+        if inode.flags & self.EXTENTS_FL:
+            runs = self.extents(inode.block)
+        else:
+            runs = self.block_map(inode.block)
+
+        data = bytearray(inode.size)
+        for logical, physical, count in runs:
+            begin = logical * self.block_size
+            if begin >= inode.size:
+                continue
+            length = min(count * self.block_size, inode.size - begin)
+            data[begin:begin + length] = self.read(physical * self.block_size,
+                                                   length)
+        return bytes(data)
+
+    def entries(self, number):
+        """Generator yielding (name, inode number) for each entry in the
+        directory with inode number.  Hash tree (dir_index) directories are
+        read linearly, which their format is designed to allow."""
+        inode = self.inode(number)
+        if inode.flags & self.INLINE_DATA_FL:
+            # Inline directories start with their parent's inode number
+            # in place of the . and .. entries.
+            (parent,) = struct.unpack_from("<I", inode.block, 0)
+            yield ".", number
+            yield "..", parent
+            directory = inode.block[4:inode.size]
+        else:
+            directory = self.contents(inode)
+        wide_names = not self.feature_incompat & self.INCOMPAT_FILETYPE
+        at = 0
+        while at + 8 <= len(directory):
+            child, rec_len, name_len = struct.unpack_from("<IHB", directory, at)
+            if wide_names:
+                name_len, = struct.unpack_from("<H", directory, at + 6)
+            if rec_len < 8:
+                raise ValueError("Bad directory entry in %s." % (self.image,))
+            # Empty entries, hash tree index nodes and checksum tails all
+            # have an inode of 0.
+            if child:
+                yield directory[at + 8:at + 8 + name_len].decode(errors="surrogateescape"), child
+            at += rec_len
+
+    def lookup(self, filespec):
+        """Return the inode number of filespec or None if it doesn't exist."""
+        number = self.ROOT_INODE
+        for name in filespec.split("/"):
+            if not name:
+                continue
+            number = dict(self.entries(number)).get(name)
+            if number is None:
+                return None
+        return number
+
+    def cat(self, filespec):
+        """Return the contents of filespec, empty if it doesn't exist."""
+        number = self.lookup(filespec)
+        if number is None:
+            return b""
+        return self.contents(self.inode(number))
+
+    def ls(self, path, filename_match="*"):
+        """Return a list of TarInfo objects for the files in path."""
+        import tarfile
+        number = self.lookup(path)
+        if number is None:
+            return
+        for filename, child in self.entries(number):
+            if filename in (".", "..") \
+               or not fnmatch.fnmatch(filename, filename_match):
+                continue
+            inode = self.inode(child)
+            file = tarfile.TarInfo(filename)
+            file.type = getattr(tarfile, self.FILE_TYPES.get(inode.mode & 0xF000, "REGTYPE"))
+            file.mode = inode.mode & FilesystemImage.IFLAGS_PERMISSIONS
+            file.uid = inode.uid
+            file.gid = inode.gid
+            if not file.isdir():
+                file.size = inode.size
+            yield file
+
+def fat_free_ranges(filespec):
+    """Return a list of (offset, length) byte ranges within the FAT file
+    system filespec of the clusters its first FAT marks as free, or None if
+    filespec isn't a FAT file system."""
+    image, offset = split_filespec(filespec)
+    with open(image, "rb") as imagefile:
+        imagefile.seek(offset)
+        boot = imagefile.read(512)
+        if len(boot) < 512 or boot[510:512] != b"\x55\xAA":
+            return None
+        (sector_size, cluster_sectors, reserved, fats, root_entries,
+         sectors) = struct.unpack_from("<HBHBHH", boot, 0x0B)
+        (fat_sectors,) = struct.unpack_from("<H", boot, 0x16)
+        if not sectors:
+            (sectors,) = struct.unpack_from("<I", boot, 0x20)
+        if not fat_sectors:
+            (fat_sectors,) = struct.unpack_from("<I", boot, 0x24)
+        if sector_size not in (512, 1024, 2048, 4096) \
+           or cluster_sectors not in (1, 2, 4, 8, 16, 32, 64, 128) \
+           or not fats or not fat_sectors:
+            return None
+
+        root_sectors = -(-root_entries * 32 // sector_size)
+        data_start = reserved + fats * fat_sectors + root_sectors
+        clusters = (sectors - data_start) // cluster_sectors
+        imagefile.seek(offset + reserved * sector_size)
+        fat = imagefile.read(fat_sectors * sector_size)
+
+    # The FAT type follows from the number of clusters alone.
+    if clusters < 4085:
+        def entry(number):
+            """Return FAT12 entry number."""
+            (pair,) = struct.unpack_from("<H", fat, number * 3 // 2)
+            return pair >> 4 if number & 1 else pair & 0xFFF
+    elif clusters < 65525:
+        entries = struct.unpack_from("<%dH" % (clusters + 2,), fat)
+        entry = entries.__getitem__
+    else:
+        entries = struct.unpack_from("<%dI" % (clusters + 2,), fat)
+        entry = lambda number: entries[number] & 0x0FFFFFFF
+
+    cluster_size = cluster_sectors * sector_size
+    ranges = []
+    for number in range(2, clusters + 2):
+        if entry(number):
+            continue
+        start = (data_start * sector_size) + (number - 2) * cluster_size
+        if ranges and sum(ranges[-1]) == start:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + cluster_size)
+        else:
+            ranges.append((start, cluster_size))
+    return ranges
+
+def compact_image(image):
+    """Punch holes in image over the blocks that the (FAT or ext[234]) file
+    systems in its partitions don't use, so stale data in free space isn't
+    copied, checksummed or compressed along with the image from then on.
+    Returns the number of bytes deallocated."""
+    with disk_stage(), io.open(image, "r+b", 0) as imagefile:
+        image_size = os.fstat(imagefile.fileno()).st_size
+        allocated = os.fstat(imagefile.fileno()).st_blocks
+        for partition in read_partitions(image):
+            if partition.kind == "extended":
+                continue
+            filespec = offset_filespec(image, partition.start)
+            ranges = fat_free_ranges(filespec)
+            if ranges is None:
+                with contextlib.ExitStack() as stack:
+                    try:
+                        filesystem = stack.enter_context(Ext4Image(filespec))
+                    except ValueError:
+                        # Neither FAT nor ext[234], like swap, so leave it.
+                        continue
+                    ranges = list(filesystem.free_ranges())
+
+            partition_end = min(partition.start + partition.size, image_size)
+            for offset, length in ranges:
+                start = partition.start + offset
+                end = min(start + length, partition_end)
+                # Only ranges holding data need punching, and skipping holes
+                # keeps the zero-writing fallback from filling them in.
+                for begin, data_end in data_extents(imagefile, start, end):
+                    punch_hole(imagefile, begin, data_end - begin)
+        return (allocated - os.fstat(imagefile.fileno()).st_blocks) * 512
+
+@contextlib.contextmanager
+def umask(mask):
+    """Context manager which sets umask to mask for its duration and then
+    restores the previous mask."""
+    saved_mask = os.umask(mask)
+    yield
+    os.umask(saved_mask)
+
+SECTOR_SIZE = 512
+
+PARTITION_TABLE_STRUCTURES = ("MBRPartition", "MBR", "GPTHeader", "GPTEntry")
+
+@functools.lru_cache(maxsize=None)
+def define_partition_tables():
+    """Define the ctypes structures in PARTITION_TABLE_STRUCTURES as module
+    globals.  ctypes is slow to import, so this waits until a partition
+    table is actually read or written."""
+    global MBRPartition, MBR, GPTHeader, GPTEntry
+    import ctypes
+
+    class MBRPartition(ctypes.LittleEndianStructure):
+        """https://en.wikipedia.org/wiki/Master_boot_record#Partition_table_entries"""
+        _pack_ = 1
+        _fields_ = [("status",    ctypes.c_ubyte),
+                    ("chs_begin", ctypes.c_ubyte * 3),
+                    ("type",      ctypes.c_ubyte),
+                    ("chs_end",   ctypes.c_ubyte * 3),
+                    ("lba_begin", ctypes.c_uint32),
+                    ("lba_size",  ctypes.c_uint32),
+                   ]
+        EXTENDED_TYPES = (0x05, 0x0F, 0x85)
+        GPT_PROTECTIVE = 0xEE
+
+    class MBR(ctypes.LittleEndianStructure):
+        """https://en.wikipedia.org/wiki/Master_boot_record#Sector_layout
+        Also the layout of an EBR in the chain of logical partitions."""
+        _pack_ = 1
+        _fields_ = [("skip",       ctypes.c_ubyte * 446),
+                    ("partitions", MBRPartition * 4),
+                    ("signature",  ctypes.c_ubyte * 2),
+                   ]
+        SIGNATURE = b"\x55\xAA"
+
+    class GPTHeader(ctypes.LittleEndianStructure):
+        """https://en.wikipedia.org/wiki/GUID_Partition_Table#Partition_table_header_(LBA_1)"""
+        _pack_ = 1
+        _fields_ = [("signature",     ctypes.c_ubyte * 8),
+                    ("revision",      ctypes.c_uint32),
+                    ("header_size",   ctypes.c_uint32),
+                    ("header_crc",    ctypes.c_uint32),
+                    ("reserved",      ctypes.c_uint32),
+                    ("current_lba",   ctypes.c_uint64),
+                    ("backup_lba",    ctypes.c_uint64),
+                    ("first_usable",  ctypes.c_uint64),
+                    ("last_usable",   ctypes.c_uint64),
+                    ("disk_guid",     ctypes.c_ubyte * 16),
+                    ("entries_lba",   ctypes.c_uint64),
+                    ("entry_count",   ctypes.c_uint32),
+                    ("entry_size",    ctypes.c_uint32),
+                    ("entries_crc",   ctypes.c_uint32),
+                   ]
+        SIGNATURE = b"EFI PART"
+
+    class GPTEntry(ctypes.LittleEndianStructure):
+        """https://en.wikipedia.org/wiki/GUID_Partition_Table#Partition_entries_(LBA_2-33)"""
+        _pack_ = 1
+        _fields_ = [("type_guid",   ctypes.c_ubyte * 16),
+                    ("unique_guid", ctypes.c_ubyte * 16),
+                    ("first_lba",   ctypes.c_uint64),
+                    ("last_lba",    ctypes.c_uint64),
+                    ("attributes",  ctypes.c_uint64),
+                    ("name",        ctypes.c_ubyte * 72),
+                   ]
+
+    assert ctypes.sizeof(MBRPartition) == 16, "Partition definition error"
+    assert ctypes.sizeof(MBR) == SECTOR_SIZE, "MBR definition error"
+    assert ctypes.sizeof(GPTHeader) == 92, "GPT header definition error"
+    assert ctypes.sizeof(GPTEntry) == 128, "GPT entry definition error"
+
+def __getattr__(name):
+    """Define the partition table structures when one is first looked up
+    from outside the module."""
+    if name in PARTITION_TABLE_STRUCTURES:
+        define_partition_tables()
+        return globals()[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+class Partition(collections.namedtuple("Partition", ("number", "start", "size",
+                                                     "kind", "entry"))):
+    """A partition in an image as found by read_partitions().
+        number - partition number, as Linux and parted number them.
+        start  - offset of the partition in the image in bytes.
+        size   - size of the partition in bytes.
+        kind   - "primary", "extended", or "logical" for MBR partitions,
+                 "gpt" for GPT partitions.
+        entry  - offset in the image of the partition's table entry.
+    """
+
+def read_partitions(image):
+    """Return a list of the Partitions in image, in partition number order.
+    Reads MBR partition tables, including logical partitions in an extended
+    partition, and falls back to GPT if there's a protective MBR."""
+    import ctypes
+    import mmap
+    define_partition_tables()
+    with open(image, "rb") as imagefile, \
+         mmap.mmap(imagefile.fileno(), 0, access=mmap.ACCESS_READ) as disk:
+        def table(lba):
+            """Return the MBR or EBR at sector lba."""
+            mbr = MBR.from_buffer_copy(disk, lba * SECTOR_SIZE)
+            if bytes(mbr.signature) != MBR.SIGNATURE:
+                raise ValueError("Invalid partition table in %s." % (image,))
+            return mbr
+
+        def entry_offset(lba, index):
+            """Return offset in image of entry index in table at lba."""
+            return lba * SECTOR_SIZE + MBR.partitions.offset \
+                   + index * ctypes.sizeof(MBRPartition)
+
+        partitions = []
+        for index, primary in enumerate(table(0).partitions):
+            if primary.type == MBRPartition.GPT_PROTECTIVE:
+                return read_gpt_partitions(image, disk)
+            if not primary.lba_size:
+                continue
+            kind = "extended" if primary.type in MBRPartition.EXTENDED_TYPES \
+                   else "primary"
+            partitions.append(Partition(index + 1,
+                                        primary.lba_begin * SECTOR_SIZE,
+                                        primary.lba_size * SECTOR_SIZE,
+                                        kind, entry_offset(0, index)))
+
+            if kind == "extended":
+                # Logical partitions are a linked list of EBRs, each with
+                # the partition relative to the EBR and the link to the next
+                # EBR relative to the extended partition.
+                ebr_lba = primary.lba_begin
+                for number in range(5, 5 + 128):
+                    logical, link = table(ebr_lba).partitions[:2]
+                    if logical.lba_size:
+                        partitions.append(Partition(number,
+                                                    (ebr_lba + logical.lba_begin) * SECTOR_SIZE,
+                                                    logical.lba_size * SECTOR_SIZE,
+                                                    "logical",
+                                                    entry_offset(ebr_lba, 0)))
+                    if not link.lba_size:
+                        break
+                    ebr_lba = primary.lba_begin + link.lba_begin
+
+    return sorted(partitions)
+
+def read_gpt_partitions(image, disk):
+    """Return a list of the Partitions in the GPT in the mmap disk of
+    image."""
+    define_partition_tables()
+    header = GPTHeader.from_buffer_copy(disk, SECTOR_SIZE)
+    if bytes(header.signature) != GPTHeader.SIGNATURE:
+        raise ValueError("Invalid GPT in %s." % (image,))
+
+    partitions = []
+    for index in range(header.entry_count):
+        offset = header.entries_lba * SECTOR_SIZE + index * header.entry_size
+        entry = GPTEntry.from_buffer_copy(disk, offset)
+        if any(entry.type_guid):
+            partitions.append(Partition(index + 1,
+                                        entry.first_lba * SECTOR_SIZE,
+                                        (entry.last_lba - entry.first_lba + 1) * SECTOR_SIZE,
+                                        "gpt", offset))
+    return partitions
+
+def lba_to_chs(lba):
+    """Return the 3 byte MBR CHS address for sector lba, using the usual
+    255 head, 63 sector geometry and capping at the largest address for
+    sectors CHS can't reach."""
+    HEADS, SECTORS = 255, 63
+    cylinder, remainder = divmod(lba, HEADS * SECTORS)
+    head, sector = divmod(remainder, SECTORS)
+    if cylinder > 1023:
+        cylinder, head, sector = 1023, HEADS - 1, SECTORS - 1
+    sector += 1
+    return (head, sector | (cylinder >> 2) & 0xC0, cylinder & 0xFF)
+
+def resize_partition(image, number):
+    """Grow (or shrink) partition number in image's partition table so it
+    ends at the last sector of image, the same as
+    parted image -- resizepart number -1s.  A logical partition's extended
+    partition is resized too.  For a GPT, the backup table is then
+    appended to image (see resize_gpt_partition())."""
+    import ctypes
+    partitions = {partition.number: partition
+                  for partition in read_partitions(image)}
+    sectors = os.path.getsize(image) // SECTOR_SIZE
+
+    resizing = [partitions[number]]
+    if resizing[0].kind == "gpt":
+        resize_gpt_partition(image, resizing[0], sectors)
+        return
+    if resizing[0].kind == "logical":
+        resizing += [partition for partition in partitions.values()
+                     if partition.kind == "extended"]
+
+    with open(image, "r+b") as imagefile:
+        for partition in resizing:
+            imagefile.seek(partition.entry)
+            entry = MBRPartition.from_buffer_copy(imagefile.read(ctypes.sizeof(MBRPartition)))
+            entry.lba_size = sectors - partition.start // SECTOR_SIZE
+            entry.chs_end[:] = lba_to_chs(sectors - 1)
+            imagefile.seek(partition.entry)
+            imagefile.write(bytes(entry))
+
+def resize_gpt_partition(image, partition, sectors):
+    """Resize the GPT partition in image so it ends at sector sectors - 1,
+    and append the backup GPT after it.  Both headers, with their CRCs, and
+    the protective MBR are updated to match."""
+    import ctypes
+    import zlib
+    define_partition_tables()
+    with open(image, "r+b") as imagefile:
+        imagefile.seek(partition.entry)
+        entry = GPTEntry.from_buffer_copy(imagefile.read(ctypes.sizeof(GPTEntry)))
+        entry.last_lba = sectors - 1
+        imagefile.seek(partition.entry)
+        imagefile.write(bytes(entry))
+
+        imagefile.seek(SECTOR_SIZE)
+        header = GPTHeader.from_buffer_copy(imagefile.read(ctypes.sizeof(GPTHeader)))
+        imagefile.seek(header.entries_lba * SECTOR_SIZE)
+        entries = imagefile.read(header.entry_count * header.entry_size)
+        entries_sectors = -(-len(entries) // SECTOR_SIZE)
+
+        def write_header(header, current_lba, backup_lba, entries_lba):
+            """Write header at current_lba with its CRC worked out."""
+            header.current_lba = current_lba
+            header.backup_lba = backup_lba
+            header.entries_lba = entries_lba
+            header.header_crc = 0
+            header.header_crc = zlib.crc32(bytes(header))
+            imagefile.seek(current_lba * SECTOR_SIZE)
+            imagefile.write(bytes(header).ljust(SECTOR_SIZE, b"\0"))
+
+        backup_lba = sectors + entries_sectors
+        header.header_size = ctypes.sizeof(GPTHeader)
+        header.last_usable = sectors - 1
+        header.entries_crc = zlib.crc32(entries)
+        write_header(header, 1, backup_lba, header.entries_lba)
+        imagefile.seek(sectors * SECTOR_SIZE)
+        imagefile.write(entries.ljust(entries_sectors * SECTOR_SIZE, b"\0"))
+        write_header(header, backup_lba, 1, sectors)
+
+        # The protective MBR covers the whole disk, as far as it can.
+        imagefile.seek(MBR.partitions.offset)
+        protective = MBRPartition.from_buffer_copy(imagefile.read(ctypes.sizeof(MBRPartition)))
+        protective.lba_size = min(backup_lba, 0xFFFFFFFF)
+        protective.chs_end[:] = lba_to_chs(backup_lba)
+        imagefile.seek(MBR.partitions.offset)
+        imagefile.write(bytes(protective))
+
+def offset_filespec(image, offset):
+    """Return a filespec which e2fsprogs tools, and so FilesystemImage, treat
+    as the file system starting offset bytes into the file image."""
+    return "%s?offset=%d" % (image, offset)
+
+def split_filespec(filespec):
+    """Return the image file and offset of a filespec which might have been
+    made by offset_filespec().  Only the last ?offset= is taken as one, so
+    image file names can contain ? themselves."""
+    image, option, offset = filespec.rpartition("?offset=")
+    if not option or not offset.isdigit():
+        return filespec, 0
+    return image, int(offset)
+
+def grow_filesystem_image(filespec, count):
+    """Add count bytes of space to the end of the image file containing the
+    file system filespec.  The file system itself is not resized."""
+    image, _ = split_filespec(filespec)
+    with open(image, "ab") as imagefile:
+        imagefile.seek(0, io.SEEK_END)
+        imagefile.truncate(imagefile.tell() + resolve_suffix(count))
+
+def filesystem_blocks(filespec):
+    """Return the block count and block size of the ext[234] file system
+    filespec, read straight from its superblock."""
+    image, offset = split_filespec(filespec)
+    with open(image, "rb") as imagefile:
+        imagefile.seek(offset + 1024)
+        superblock = imagefile.read(1024)
+    blocks, = struct.unpack_from("<I", superblock, 0x04)
+    log_block_size, = struct.unpack_from("<I", superblock, 0x18)
+    feature_incompat, = struct.unpack_from("<I", superblock, 0x60)
+    if feature_incompat & 0x80:     # INCOMPAT_64BIT
+        blocks_hi, = struct.unpack_from("<I", superblock, 0x150)
+        blocks |= blocks_hi << 32
+    return blocks, 1024 << log_block_size
+
+@contextlib.contextmanager
+def disk_stage():
+    """Context manager around a stage that reads or writes a whole image,
+    like copying it or checking its file system.  If disk_stage.limit is
+    set, it's a semaphore shared by processes working on images at once
+    (see prep_many()) so only so many of these stages hit the disk at a
+    time, instead of thrashing it.  Stages must not be nested."""
+    if disk_stage.limit is None:
+        yield
+    else:
+        with disk_stage.limit:
+            yield
+disk_stage.limit = None
+
+def resize2fs(filespec, size=None):
+    """Resize the file system filespec to size blocks, or if size is None
+    to fill the rest of its image file.
+
+    resize2fs ignores the offset of a filespec both when sizing the file
+    system and when trimming the image file to the new size afterwards,
+    which would cut off the end of the file system.  So with an offset,
+    resize a (sparse) copy of just the file system and copy it back."""
+    image, offset = split_filespec(filespec)
+    size = [] if size is None else [str(size)]
+    if not offset:
+        run([RESIZE2FS, filespec] + size)
+        return
+
+    with tempfile.NamedTemporaryFile() as window:
+        data_copy(image, window.name, source_offset=offset)
+        run([RESIZE2FS, window.name] + size)
+        data_copy(window.name, image, dest_offset=offset)
+
+def resize_filesystem(filespec):
+    """Check and resize the file system filespec to fill the rest of its
+    image file.
+
+    resize2fs requires the last fsck to be after the last mount, so fsck it
+    first, but assume everything will go well since the image should be
+    valid.  The fsck after the resize is run read-only and is intended to
+    blow up the script if the resize caused damage of any sort."""
+    image, offset = split_filespec(filespec)
+
+    with disk_stage():
+        run([E2FSCK, "-p", "-f", filespec])
+        # At an offset resize2fs works on a copy, so skip it when the file
+        # system already fills the image.
+        blocks, block_size = filesystem_blocks(filespec)
+        if not offset or blocks != (os.path.getsize(image) - offset) // block_size:
+            resize2fs(filespec)
+        run([E2FSCK, "-n", "-f", filespec])
+
+def shrink_filesystem(filespec, headroom=None):
+    """Check and shrink the file system filespec to the smallest size
+    resize2fs can fit its files into plus headroom bytes (can use K,M,G
+    suffixes), then truncate its image file to end with the file system.
+    A file system already that small is left alone rather than grown."""
+    image, offset = split_filespec(filespec)
+
+    with disk_stage():
+        run([E2FSCK, "-p", "-f", filespec])
+        blocks, block_size = filesystem_blocks(filespec)
+        estimate = run([RESIZE2FS, "-P", filespec])
+        minimum = int(re.search(rb"minimum size of the filesystem: (\d+)",
+                                estimate).group(1))
+        target = minimum - (-resolve_suffix(headroom or 0) // block_size)
+        if target < blocks:
+            resize2fs(filespec, target)
+            blocks, block_size = filesystem_blocks(filespec)
+        with open(image, "r+b") as imagefile:
+            imagefile.truncate(offset + blocks * block_size)
+        run([E2FSCK, "-n", "-f", filespec])
+
+@contextlib.contextmanager
+def root_parition(source_image, dest_image=None, *, read_only=False,
+                  keep_root=False, in_place=False):
+    """Context manager which extracts the root partition of a raspbian
+    dest_image into a temporary file, yields the filename, and then --
+    if read_only is False, creates a copy of the raspbian dest_image with
+    the root partition replaced.
+
+    If in_place is True, the root partition is not extracted but the
+    yielded filespec addresses it directly at its offset in dest_image, so
+    only the blocks that actually change get written.  keep_root
+    overrides in_place since there'd be no root partition to keep."""
+    if dest_image is None:
+        dest_image = source_image
+
+    # Find the start of the root partition, which we assume is the last
+    # and second partition.
+    root = read_partitions(source_image)[-1]
+    assert root.number == 2, "Unexpected partition layout."
+    root_start = root.start
+
+    if in_place and not keep_root:
+        if read_only:
+            yield offset_filespec(source_image, root_start)
+            return
+
+        if source_image != dest_image:
+            with disk_stage():
+                data_copy(source_image, dest_image)
+        yield offset_filespec(dest_image, root_start)
+    else:
+        with open("root.img", "wb") if keep_root \
+             else tempfile.NamedTemporaryFile() as root_image:
+            # Extract the root partition to the file root_image
+            with disk_stage():
+                # A GPT's backup table follows the root partition.
+                data_copy(source_image, root_image.name, source_offset=root_start,
+                          count=root.size if root.kind == "gpt" else None)
+
+            yield root_image.name
+
+            if read_only:
+                return
+
+            # Copy everything before the root partition from the source, then
+            # append the altered root partition.  No need to copy if we"re
+            # injecting a new root into the src.  The image ends with the
+            # root partition, which may have shrunk.
+            with disk_stage():
+                if source_image != dest_image:
+                    data_copy(source_image, dest_image, count=root_start)
+                data_copy(root_image.name, dest_image, dest_offset=root_start)
+                os.truncate(dest_image,
+                            root_start + os.path.getsize(root_image.name))
+
+    # Resize after reinjecting so the partition ends with the image.
+    resize_partition(dest_image, root.number)
+
+def image_digest(image):
+    """Return a SHA256 digest of the contents of image.  Chunks that are
+    holes or all zeros are skipped, so the digest doesn't depend on how
+    sparse the file is and holes cost nothing to hash."""
+    import hashlib
+    CHUNK = 4 * 1024 * 1024
+    digest = hashlib.sha256(str(os.path.getsize(image)).encode())
+    with disk_stage(), open(image, "rb") as imagefile:
+        zeros = bytes(CHUNK)
+        chunks = set()
+        for begin, end in data_extents(imagefile, 0, os.path.getsize(image)):
+            chunks.update(range(begin // CHUNK, (end - 1) // CHUNK + 1))
+        for chunk in sorted(chunks):
+            imagefile.seek(chunk * CHUNK)
+            data = imagefile.read(CHUNK)
+            if data != zeros[:len(data)]:
+                digest.update(b"%d:" % (chunk,))
+                digest.update(hashlib.sha256(data).digest())
+    return digest.hexdigest()
+
+# A delta written by diff_images() starts with a header of the magic, the
+# block size, and the base and target images' sizes and image_digest()s.
+# Records follow, each an offset and length in the target and a kind.
+# DELTA_DATA records are followed by the CRC32 and length of the data's
+# zlib compressed form, then the compressed data.  DELTA_ZERO records are
+# ranges that read as zeros, and DELTA_END ends the delta.
+DELTA_MAGIC = b"RQDELTA1"
+DELTA_HEADER = struct.Struct("<8sIQQ32s32s")
+DELTA_RECORD = struct.Struct("<QQB")
+DELTA_DATA_HEADER = struct.Struct("<II")
+DELTA_DATA, DELTA_ZERO, DELTA_END = range(3)
+
+def diff_images(base, target, delta, block_size=64 * 1024):
+    """Write the blocks of block_size bytes in which image target differs
+    from image base to the file delta, for patch_image() to turn base into
+    target.  Blocks that are holes in both images aren't read, and blocks
+    target has zeroed are recorded without their data.  Returns the number
+    of bytes of target recorded."""
+    import zlib
+    block_size = resolve_suffix(block_size)
+    base_size = os.path.getsize(base)
+    target_size = os.path.getsize(target)
+    header = DELTA_HEADER.pack(DELTA_MAGIC, block_size, base_size, target_size,
+                               bytes.fromhex(image_digest(base)),
+                               bytes.fromhex(image_digest(target)))
+    zeros = bytes(block_size)
+    # Runs of data are written out at this size, to bound memory use.
+    MAX_RUN = 4 * 1024 * 1024
+    recorded = 0
+
+    with disk_stage(), io.open(base, "rb", 0) as basefile, \
+         io.open(target, "rb", 0) as targetfile, open(delta, "wb") as deltafile:
+        deltafile.write(header)
+
+        # Blocks that are holes in both images are zeros in both.
+        blocks = set()
+        for imagefile in (basefile, targetfile):
+            for begin, end in data_extents(imagefile, 0, target_size):
+                blocks.update(range(begin // block_size,
+                                    (end - 1) // block_size + 1))
+
+        run_kind = run_offset = None
+        run_data = []
+        def flush():
+            """Write out the run of changed blocks so far."""
+            length = sum(len(data) for data in run_data) \
+                     if run_kind == DELTA_DATA else run_data[0]
+            deltafile.write(DELTA_RECORD.pack(run_offset, length, run_kind))
+            if run_kind == DELTA_DATA:
+                data = b"".join(run_data)
+                compressed = zlib.compress(data)
+                deltafile.write(DELTA_DATA_HEADER.pack(zlib.crc32(data),
+                                                       len(compressed)))
+                deltafile.write(compressed)
+            return length
+
+        for block in sorted(blocks):
+            offset = block * block_size
+            data = os.pread(targetfile.fileno(), block_size, offset)
+            original = os.pread(basefile.fileno(), len(data), offset)
+            if data == original + zeros[:len(data) - len(original)]:
+                continue
+            kind = DELTA_ZERO if data == zeros[:len(data)] else DELTA_DATA
+            if run_kind is not None:
+                if kind == run_kind and offset == run_end \
+                   and (kind == DELTA_ZERO or offset - run_offset < MAX_RUN):
+                    if kind == DELTA_DATA:
+                        run_data.append(data)
+                    else:
+                        run_data[0] += len(data)
+                    run_end += len(data)
+                    continue
+                recorded += flush()
+            run_kind, run_offset, run_end = kind, offset, offset + len(data)
+            run_data = [data] if kind == DELTA_DATA else [len(data)]
+        if run_kind is not None:
+            recorded += flush()
+        deltafile.write(DELTA_RECORD.pack(0, 0, DELTA_END))
+    return recorded
+
+def read_delta(deltafile):
+    """Return the header fields of the delta in the open file deltafile and
+    a generator yielding (offset, length, kind, data) for each of its
+    records, with data None except for DELTA_DATA records.  Raises
+    ValueError if the delta is corrupt or cut short."""
+    import zlib
+    header = deltafile.read(DELTA_HEADER.size)
+    if len(header) != DELTA_HEADER.size or not header.startswith(DELTA_MAGIC):
+        raise ValueError("%s is not a delta." % (deltafile.name,))
+
+    def records():
+        """Generator yielding the records of the delta."""
+        while True:
+            record = deltafile.read(DELTA_RECORD.size)
+            if len(record) != DELTA_RECORD.size:
+                raise ValueError("%s is cut short." % (deltafile.name,))
+            offset, length, kind = DELTA_RECORD.unpack(record)
+            if kind == DELTA_END:
+                return
+            data = None
+            if kind == DELTA_DATA:
+                crc, size = DELTA_DATA_HEADER.unpack(deltafile.read(DELTA_DATA_HEADER.size))
+                try:
+                    data = zlib.decompress(deltafile.read(size))
+                except zlib.error:
+                    data = b""
+                if len(data) != length or zlib.crc32(data) != crc:
+                    raise ValueError("%s is corrupt at offset %d."
+                                     % (deltafile.name, offset))
+            elif kind != DELTA_ZERO:
+                raise ValueError("%s is corrupt at offset %d."
+                                 % (deltafile.name, offset))
+            yield offset, length, kind, data
+
+    return DELTA_HEADER.unpack(header)[1:], records()
+
+def patch_image(image, delta, dest=None):
+    """Apply the delta written by diff_images() to image, turning it into
+    the delta's target.  If dest is given, image is first copied to dest
+    and dest is patched instead.  Ranges the delta zeroes are punched out,
+    so the result is as sparse as the target was.
+
+    Raises ValueError before anything is written if image isn't the
+    delta's base or the delta is corrupt, and afterwards if the patched
+    image doesn't match the target's digest."""
+    with open(delta, "rb") as deltafile:
+        (block_size, base_size, target_size,
+         base_digest, target_digest), records = read_delta(deltafile)
+        if os.path.getsize(image) != base_size \
+           or bytes.fromhex(image_digest(image)) != base_digest:
+            raise ValueError("%s is not the image %s was made from."
+                             % (image, delta))
+        # Validate every record before touching the image: read_delta()
+        # decompresses and checks the data's CRC, and each range must lie
+        # within the target.  The records are read again to apply them.
+        for offset, length, kind, data in records:
+            if offset + length > target_size:
+                raise ValueError("%s is corrupt at offset %d, past the end of"
+                                 " its target." % (delta, offset))
+
+        if dest is not None:
+            with disk_stage():
+                data_copy(image, dest)
+            image = dest
+
+        # Pages of data that are all zeros are punched out too.
+        PAGE = 4096
+        zeros = bytes(PAGE)
+        deltafile.seek(0)
+        header, records = read_delta(deltafile)
+        with disk_stage(), io.open(image, "r+b", 0) as imagefile:
+            for offset, length, kind, data in records:
+                if kind == DELTA_ZERO:
+                    punch_hole(imagefile, offset, length)
+                    continue
+                data = memoryview(data)
+                for at in range(0, length, PAGE):
+                    page = data[at:at + PAGE]
+                    if page == zeros[:len(page)]:
+                        punch_hole(imagefile, offset + at, len(page))
+                    else:
+                        os.pwrite(imagefile.fileno(), page, offset + at)
+            imagefile.truncate(target_size)
+
+    if bytes.fromhex(image_digest(image)) != target_digest:
+        raise ValueError("%s doesn't match the target of %s after patching."
+                         % (image, delta))
+
+class ImageCache:
+    """A directory of prepped images, each named by a key identifying how it
+    was made, limited to max_size bytes of disk by evicting the least
+    recently used images."""
+    DEFAULT_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", "~/.cache"),
+                                "raspbian-qemu")
+    SUFFIX = ".img"
+
+    def __init__(self, path, max_size):
+        """Create cache in directory path, making it if needed."""
+        self.path = os.path.expanduser(path)
+        self.max_size = resolve_suffix(max_size)
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+    def filespec(self, key):
+        """Return the name of the cached image for key."""
+        return os.path.join(self.path, key + self.SUFFIX)
+
+    def fetch(self, key, dest):
+        """Copy the image cached for key to dest, returning False if there
+        isn't one.
+
+        Copies are reflinks where possible.  Hard links are never used
+        since running an image modifies it, which would alter the cache."""
+        cached = self.filespec(key)
+        if not os.path.exists(cached):
+            return False
+        os.utime(cached)
+        data_copy(cached, dest)
+        if run.debug:
+            print("cache: hit", key)
+        return True
+
+    def store(self, key, image):
+        """Add a copy of image to the cache for key and then evict images
+        over the size limit."""
+        with tempfile.NamedTemporaryFile(dir=self.path, delete=False) as copy:
+            try:
+                data_copy(image, copy.name)
+                os.replace(copy.name, self.filespec(key))
+            except:
+                os.unlink(copy.name)
+                raise
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used images until the images use no more
+        than max_size bytes of disk."""
+        images = []
+        for entry in os.listdir(self.path):
+            if entry.endswith(self.SUFFIX):
+                filespec = os.path.join(self.path, entry)
+                stat = os.stat(filespec)
+                images.append((stat.st_mtime, stat.st_blocks * 512, filespec))
+
+        used = sum(size for mtime, size, filespec in images)
+        for mtime, size, filespec in sorted(images):
+            if used <= self.max_size:
+                break
+            if run.debug:
+                print("cache: evicting", filespec)
+            os.unlink(filespec)
+            used -= size
+
+class ChunkStore:
+    """A directory storing images as content-defined chunks, each unique
+    chunk once and compressed, with a manifest per image listing where its
+    chunks go.  Images that are mostly the same, like variants prepped from
+    the same release, share most of their chunks.
+
+    Chunk boundaries are chosen page by page: a chunk ends after a page
+    whose CRC matches CHUNK_MASK, once it has at least MIN_PAGES pages, or
+    when it reaches MAX_PAGES.  A change only moves the boundaries around
+    it, so the rest of an image still matches the chunks already stored.
+    Pages of zeros end chunks and aren't stored, so they come back as holes.
+    (File systems change images a block at a time rather than inserting
+    bytes, so a boundary at any byte isn't needed.)"""
+    DEFAULT_PATH = os.path.join(os.environ.get("XDG_DATA_HOME", "~/.local/share"),
+                                "raspbian-qemu", "store")
+    PAGE       = 4096
+    MIN_PAGES  = 4
+    MAX_PAGES  = 64
+    CHUNK_MASK = 0xF            # an average of 16 pages, 64K, per chunk
+
+    def __init__(self, path):
+        """Create store in directory path, making it if needed."""
+        self.path = os.path.expanduser(path)
+        self.chunks = os.path.join(self.path, "chunks")
+        self.manifests = os.path.join(self.path, "manifests")
+        os.makedirs(self.chunks, mode=0o700, exist_ok=True)
+        os.makedirs(self.manifests, mode=0o700, exist_ok=True)
+
+    def chunk_filespec(self, digest):
+        """Return the name of the stored chunk with hex SHA256 digest."""
+        return os.path.join(self.chunks, digest[:2], digest)
+
+    def manifest_filespec(self, name):
+        """Return the name of the manifest of image name."""
+        if not name or "/" in name or name.startswith("."):
+            raise ValueError("Invalid image name %r." % (name,))
+        return os.path.join(self.manifests, name + ".json")
+
+    def split(self, imagefile):
+        """Generator yielding (offset, data) for the chunks of the data in
+        the open file imagefile, leaving out pages of zeros."""
+        import zlib
+        zeros = bytes(self.PAGE)
+        size = os.fstat(imagefile.fileno()).st_size
+        for begin, end in data_extents(imagefile, 0, size):
+            begin -= begin % self.PAGE
+            start, pages = begin, []
+            for offset in range(begin, end, 4 * 1024 * 1024):
+                buf = os.pread(imagefile.fileno(),
+                               min(4 * 1024 * 1024, end - offset), offset)
+                for at in range(0, len(buf), self.PAGE):
+                    page = buf[at:at + self.PAGE]
+                    if page == zeros[:len(page)]:
+                        if pages:
+                            yield start, b"".join(pages)
+                        pages = []
+                        continue
+                    if not pages:
+                        start = offset + at
+                    pages.append(page)
+                    if len(pages) == self.MAX_PAGES \
+                       or (len(pages) >= self.MIN_PAGES
+                           and zlib.crc32(page) & self.CHUNK_MASK == self.CHUNK_MASK):
+                        yield start, b"".join(pages)
+                        pages = []
+            if pages:
+                yield start, b"".join(pages)
+
+    def store_chunk(self, digest, data):
+        """Store data as the chunk with digest unless it's already stored.
+        Returns the number of bytes of disk the chunk took."""
+        import zlib
+        filespec = self.chunk_filespec(digest)
+        if os.path.exists(filespec):
+            return 0
+        compressed = zlib.compress(data)
+        os.makedirs(os.path.dirname(filespec), mode=0o700, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.chunks, delete=False) as chunk:
+            try:
+                chunk.write(compressed)
+                chunk.close()
+                os.replace(chunk.name, filespec)
+            except:
+                os.unlink(chunk.name)
+                raise
+        return len(compressed)
+
+    def add(self, image, name=None, jobs=None):
+        """Store image as name (by default its file name), compressing new
+        chunks in jobs threads (one per CPU by default).  Returns the number
+        of bytes of data in image and how many bytes of it were new to the
+        store, compressed."""
+        import concurrent.futures
+        import hashlib
+        import json
+        name = name or os.path.basename(image)
+        manifest_filespec = self.manifest_filespec(name)
+        jobs = jobs or os.cpu_count()
+        chunks = []
+        data_size = stored = 0
+        with disk_stage(), io.open(image, "rb", 0) as imagefile, \
+             concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            size = os.fstat(imagefile.fileno()).st_size
+            # zlib lets other threads run while it compresses.  Only a few
+            # chunks per thread are kept waiting, to bound memory use.
+            pending = collections.deque()
+            for offset, data in self.split(imagefile):
+                digest = hashlib.sha256(data).hexdigest()
+                chunks.append((offset, len(data), digest))
+                data_size += len(data)
+                pending.append(pool.submit(self.store_chunk, digest, data))
+                if len(pending) >= 4 * jobs:
+                    stored += pending.popleft().result()
+            stored += sum(future.result() for future in pending)
+
+        with tempfile.NamedTemporaryFile("w", dir=self.manifests,
+                                         delete=False) as manifest:
+            try:
+                json.dump({"size": size, "chunks": chunks}, manifest)
+                manifest.close()
+                os.replace(manifest.name, manifest_filespec)
+            except:
+                os.unlink(manifest.name)
+                raise
+        return data_size, stored
+
+    def manifest(self, name):
+        """Return the manifest of image name, a dict of its "size" and
+        "chunks", a list of (offset, length, digest) lists."""
+        import json
+        try:
+            with open(self.manifest_filespec(name)) as manifest:
+                return json.load(manifest)
+        except FileNotFoundError:
+            raise ValueError("No image %s in %s." % (name, self.path))
+
+    def images(self):
+        """Return a sorted list of the names of the images stored."""
+        return sorted(entry[:-len(".json")] for entry in os.listdir(self.manifests)
+                      if entry.endswith(".json"))
+
+    def rebuild(self, name, dest, jobs=None):
+        """Write image name to dest, writing its chunks in jobs threads (one
+        per CPU by default) and leaving everything else a hole.  Raises
+        ValueError if a chunk is missing or corrupt."""
+        import concurrent.futures
+        import hashlib
+        import zlib
+        manifest = self.manifest(name)
+
+        with disk_stage(), open(dest, "wb") as destfile, \
+             concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+            destfile.truncate(manifest["size"])
+
+            def write(chunk):
+                """Write chunk, an (offset, length, digest) list, to dest."""
+                offset, length, digest = chunk
+                try:
+                    with open(self.chunk_filespec(digest), "rb") as chunkfile:
+                        data = zlib.decompress(chunkfile.read())
+                except (OSError, zlib.error) as e:
+                    raise ValueError("Chunk %s of %s is unreadable: %s"
+                                     % (digest, name, e))
+                if len(data) != length or hashlib.sha256(data).hexdigest() != digest:
+                    raise ValueError("Chunk %s of %s is corrupt." % (digest, name))
+                os.pwrite(destfile.fileno(), data, offset)
+
+            for written in pool.map(write, manifest["chunks"]):
+                pass
+
+    def remove(self, name):
+        """Remove image name from the store.  Its chunks stay until gc()."""
+        try:
+            os.unlink(self.manifest_filespec(name))
+        except FileNotFoundError:
+            raise ValueError("No image %s in %s." % (name, self.path))
+
+    def gc(self):
+        """Delete the chunks no stored image uses, returning how many were
+        deleted and the bytes of disk freed.  Must not run while images are
+        being added, which could be using chunks that look unused."""
+        used = set()
+        for name in self.images():
+            used.update(digest for offset, length, digest
+                        in self.manifest(name)["chunks"])
+        deleted = freed = 0
+        for directory, subdirectories, files in os.walk(self.chunks):
+            for entry in files:
+                if entry not in used:
+                    filespec = os.path.join(directory, entry)
+                    freed += os.stat(filespec).st_blocks * 512
+                    os.unlink(filespec)
+                    deleted += 1
+        return deleted, freed
+
+def tool_version(tool, cache=os.path.join(ImageCache.DEFAULT_PATH,
+                                         "tool-versions.json")):
+    """Return the first line of tool's --version output.  Versions are kept
+    in the JSON file cache by the tool's path and modification time, so
+    each installed binary is only run once."""
+    import json
+    path = find_tool(tool) or tool
+    mtime = os.stat(path).st_mtime_ns
+    cache = os.path.expanduser(cache)
+    try:
+        with open(cache) as cachefile:
+            versions = json.load(cachefile)
+    except (FileNotFoundError, ValueError):
+        versions = {}
+
+    if versions.get(path, [None])[0] != mtime:
+        version = run([path, "--version"]).decode(errors="replace")
+        versions[path] = [mtime, version.splitlines()[0] if version else ""]
+        os.makedirs(os.path.dirname(cache), mode=0o700, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(cache),
+                                         delete=False) as cachefile:
+            json.dump(versions, cachefile)
+        os.replace(cachefile.name, cache)
+    return versions[path][1]
+
+def prep_cache_key(source_image, grow_root, public_key, hosts_keys,
+                   compact=False):
+    """Return the ImageCache key for prepping source_image with the given
+    options using this version of the tool."""
+    import hashlib
+    key = hashlib.sha256()
+    key.update(__version__.encode() + b"\0")
+    key.update(image_digest(source_image).encode() + b"\0")
+    key.update(str(resolve_suffix(grow_root)).encode() + b"\0")
+    key.update(b"compact\0" if compact else b"\0")
+    for filespec in (public_key, hosts_keys):
+        if filespec is not None:
+            with open(filespec, "rb") as file:
+                key.update(hashlib.sha256(file.read()).digest())
+        key.update(b"\0")
+    return key.hexdigest()
+
+def prep(source_image, dest_image, grow_root, public_key, hosts_keys, keep_root,
+         in_place=False, cache=None, compact=False):
+    """Prep an image for use in qemu starting with source_image and writing
+    out dest_image (they may be the same).
+    Optionally:
+        - grow the root partition by grow_root bytes
+        - add a public key to the user pi's authorized_keys
+        - add the hostkeys from a previously extracted tarball
+        - edit the root partition in place (see root_parition())
+        - reuse a previously prepped image from an ImageCache cache
+        - punch holes over the file systems' free space (see compact_image())
+
+    source_image may be compressed (see COMPRESSED_EXTENSIONS), in which
+    case it's decompressed straight into dest_image (by default source_image
+    without the extension) and prepped there in place.
+    """
+    import tarfile
+    compressed = source_image.endswith(COMPRESSED_EXTENSIONS)
+    if compressed and dest_image is None:
+        dest_image = decompressed_name(source_image)
+
+    if cache is not None:
+        key = prep_cache_key(source_image, grow_root, public_key, hosts_keys,
+                             compact)
+        if cache.fetch(key, dest_image or source_image):
+            return
+        prep(source_image, dest_image, grow_root, public_key, hosts_keys,
+             keep_root, in_place, compact=compact)
+        cache.store(key, dest_image or source_image)
+        return
+
+    if compressed:
+        with disk_stage():
+            decompress(source_image, dest_image)
+        source_image, dest_image = dest_image, None
+        in_place = True
+
+    with root_parition(source_image, dest_image, keep_root=keep_root,
+                       in_place=in_place) as root_image:
+        # Grow the root partition
+        if grow_root:
+            grow_filesystem_image(root_image, grow_root)
+
+        # Resize the filesystem to the new size and check it.
+        resize_filesystem(root_image)
+
+        with FilesystemImage(root_image) as rootfs:
+            # http://embedonix.com/articles/linux/emulating-raspberry-pi-on-linux/
+            # The disk is vda rather than sda on machines with virtio.
+            rootfs.write("/etc/udev/rules.d/90-qemu-sda.rules",
+                         b'KERNEL=="sda|vda", SYMLINK+="mmcblk0"\n'
+                         b'KERNEL=="sda?|vda?", SYMLINK+="mmcblk0p%n"\n'
+                         b'KERNEL=="sda2|vda2", SYMLINK+="root"\n')
+
+            # Comment out all lines in ld.so.preload
+            preload = rootfs.cat("/etc/ld.so.preload")
+            preload = b"".join([line if line.startswith(b"#") else b"#" + line
+                                for line in preload.splitlines(keepends=True)
+                               ])
+            rootfs.write("/etc/ld.so.preload",
+                         preload, uid=0, gid=0, mode=0o644)
+
+            if public_key is not None:
+                AUTHORIZED_KEYS = "/home/pi/.ssh/authorized_keys"
+                with open(public_key, "rb") as public_key_file:
+                    new_key = public_key_file.read()
+                keys = rootfs.cat(AUTHORIZED_KEYS)
+                if new_key not in keys:
+                    keys += new_key
+                rootfs.mkdir("/home/pi/.ssh", uid=1000, gid=1000, mode=0o700)
+                rootfs.write(AUTHORIZED_KEYS, keys, uid=1000, gid=1000, mode=0o600)
+
+            if hosts_keys is not None:
+                # Inject all of the host keys from the tarfile into the image
+                # in /etc/ssh.  Then alter the initscript not to regenerate them
+                # but leave the script there since it also enables ssh and self-
+                # destructs.
+                with tarfile.open(hosts_keys, "r") as tar:
+                    for member in tar:
+                        hostkey = tar.extractfile(member)
+                        rootfs.write(os.path.join("/etc/ssh/", member.name),
+                                     hostkey.read(),
+                                     uid=member.uid, gid=member.gid,
+                                     mode=member.mode)
+
+                REGEN_HOSTKEYS_INITSCRIPT = "/etc/init.d/regenerate_ssh_host_keys"
+                initscript = rootfs.cat(REGEN_HOSTKEYS_INITSCRIPT)
+                initscript = b"".join([line for line in initscript.splitlines(keepends=True)
+                                       if b"ssh-keygen" not in line
+                                      ])
+                rootfs.write(REGEN_HOSTKEYS_INITSCRIPT, initscript,
+                             uid=0, gid=0, mode=0o755)
+
+    if compact:
+        compact_image(dest_image or source_image)
+
+def shrink(source_image, dest_image, headroom=None, keep_root=False,
+           in_place=False):
+    """Shrink the root file system and partition of source_image down to
+    what its files need plus headroom bytes, and write the image, cut off
+    at the new end of the partition, to dest_image (they may be the same).
+    """
+    with root_parition(source_image, dest_image, keep_root=keep_root,
+                       in_place=in_place) as root_image:
+        shrink_filesystem(root_image, headroom)
+
+class PrepJob(collections.namedtuple("PrepJob", ("image", "dest", "log",
+                                                 "error", "duration"))):
+    """Result of one prep run by prep_many().
+        image    - image prepped.
+        dest     - image written, or None if it was image.
+        log      - file the prep's output was written to.
+        error    - description of what went wrong, or None if it worked.
+        duration - seconds the prep took.
+    """
+
+def read_prep_manifest(manifest):
+    """Return a list of (image, dest) pairs from the file manifest, which
+    has an image and optionally a dest on each line.  Blank lines and
+    lines starting with # are ignored."""
+    jobs = []
+    with open(manifest) as manifestfile:
+        for line in manifestfile:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) > 2:
+                raise ValueError("%s: too many fields in %r" % (manifest, line))
+            jobs.append((fields[0], fields[1] if len(fields) == 2 else None))
+    return jobs
+
+def set_disk_stage_limit(limit):
+    """Set the disk_stage() limit in a prep_many() worker process."""
+    disk_stage.limit = limit
+
+def prep_job(image, dest, log, options):
+    """Run prep() for prep_many() in a worker process, writing its output to
+    log.  Returns the error, if any, and how long it took."""
+    import traceback
+    started = time.time()
+    error = None
+    with open(log, "w") as logfile, contextlib.redirect_stdout(logfile), \
+         contextlib.redirect_stderr(logfile):
+        try:
+            prep(image, dest, **options)
+        except Exception as e:
+            traceback.print_exc()
+            error = "%s: %s" % (type(e).__name__, e)
+            if isinstance(e, subprocess.CalledProcessError) and e.stderr:
+                print(e.stderr.decode(errors="replace"))
+    return error, time.time() - started
+
+def prep_many(images, jobs, disk_jobs, log_dir, reportfunc=print, **options):
+    """Prep each (image, dest) pair in images like prep() with options, in
+    up to jobs processes at once.  Only disk_jobs of them run a stage that
+    reads or writes a whole image at a time (see disk_stage()).  Each prep's
+    output goes to a log file in log_dir.  Calls reportfunc with a message
+    as each prep ends and returns a list of PrepJobs in the order of
+    images."""
+    import concurrent.futures
+    import multiprocessing
+    os.makedirs(log_dir, exist_ok=True)
+
+    # Fork so the workers have this module, however it was loaded, and
+    # inherit the semaphore.
+    context = multiprocessing.get_context("fork")
+    limit = context.Semaphore(disk_jobs)
+    started = time.time()
+    with concurrent.futures.ProcessPoolExecutor(jobs, mp_context=context,
+                                                initializer=set_disk_stage_limit,
+                                                initargs=(limit,)) as pool:
+        futures = collections.OrderedDict()
+        for number, (image, dest) in enumerate(images, 1):
+            name = os.path.splitext(os.path.basename(dest or image))[0]
+            log = os.path.join(log_dir, "%s.%d.log" % (name, number))
+            futures[pool.submit(prep_job, image, dest, log, options)] = (image, dest, log)
+
+        # A worker that dies takes its prep (and the pool) with it, which
+        # only shows when the result is asked for, so that's a failed prep
+        # too rather than a crash.
+        results = {}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[future] = future.result()
+            except Exception as e:
+                results[future] = ("%s: %s" % (type(e).__name__, e),
+                                   time.time() - started)
+            reportfunc("%s: %s" % (futures[future][0], results[future][0] or "done"))
+        return [PrepJob(*job, *results[future]) for future, job in futures.items()]
+
+def unprep(source_image, dest_image, keep_root, in_place=False):
+    """Un-Prep source_image and write it to dest_image (the maybe be the same)
+    so the image can then be written to an SD card and run on actual Raspberry
+    Pi hardware again.
+    NOTE: This does not undo any private or host keys added with prep.
+    """
+    with root_parition(source_image, dest_image, keep_root=keep_root,
+                       in_place=in_place) as root_image:
+        with FilesystemImage(root_image) as rootfs:
+            rootfs.rm("/etc/udev/rules.d/90-qemu-sda.rules")
+
+            # Uncomment all lines in ld.so.preload
+            preload = rootfs.cat("/etc/ld.so.preload")
+            preload = b"".join([line.lstrip(b"#")
+                                for line in preload.splitlines(keepends=True)])
+            rootfs.write("/etc/ld.so.preload", preload, uid=0, gid=0, mode=0o644)
+
+class Machine(collections.namedtuple("Machine", ("name", "cpu", "memory",
+                                                 "smp", "kernel", "root",
+                                                 "defconfig", "virtio"))):
+    """An emulated machine to run images on.
+        name      - qemu -machine to emulate.
+        cpu       - qemu -cpu to emulate.
+        memory    - megabytes of RAM.
+        smp       - number of CPUs.
+        kernel    - kernel binary, as built by build-kernel for the machine.
+        root      - the root partition's device as the kernel sees it.
+        defconfig - kernel configuration build_kernel() starts from.
+        virtio    - True for paravirtual disk and network devices.
+    """
+
+# As of mid-2016 qemu does not have a direct raspi machine.  versatilepb is
+# the closest to it with the caveat that its hardware has a max of 256M of
+# RAM and one CPU.  The kernel must be patched to allow the arm1176 CPU to be
+# configured with the versatilepb board.  See build_kernel().
+#
+# virt is a machine made for emulation rather than any real board.  Its
+# cortex-a7 runs Raspbian's armhf binaries, and it takes several CPUs, more
+# RAM and virtio devices, which are much faster under emulation, at the cost
+# of being further from the real hardware.
+MACHINES = collections.OrderedDict((
+    ("versatilepb", Machine("versatilepb", "arm1176", 256, 1, KERNEL_BINARY,
+                            "/dev/sda2", "versatile_defconfig", False)),
+    ("virt", Machine("virt", "cortex-a7", 1024, min(4, os.cpu_count() or 1),
+                     KERNEL_BINARY + "-virt", "/dev/vda2",
+                     "multi_v7_defconfig", True)),
+))
+
+def drive_options(cache=None, aio=None, discard=False):
+    """Return the extra qemu -drive options for the image: the host cache
+    mode and asynchronous IO method to use when not None and, if discard is
+    True, sending writes to a temporary file thrown away on exit."""
+    options = []
+    if cache is not None:
+        options.append("cache=" + cache)
+    if aio is not None:
+        options.append("aio=" + aio)
+    if discard:
+        options.append("snapshot=on")
+    return options
+
+def emulator_args(image, display, ssh_port, *, image_format="raw",
+                  serial="mon:stdio", machine=MACHINES["versatilepb"],
+                  drive=()):
+    """Return the qemu-system-arm command line to run image, which is in
+    image_format, on machine with the console on the qemu character device
+    serial and any extra drive options from drive_options().
+    Optionally with a display window and/or an ssh port redirect."""
+    drive = "".join("," + option for option in drive)
+    args = [find_tool(QEMU) or QEMU,
+
+            "-kernel", machine.kernel,
+
+            # panic   - don't pause forever after a panic but reboot
+            #           immediately. poweroff ends init which panics the kernel.
+            #           This combined with -no-reboot below will cause qemu
+            #           to exit cleanly in these situations.
+            # console - redirect console to serial port, which -serial below
+            #           sends to stdout.
+            # root    - The image disk shows up as /dev/sda (or /dev/vda with
+            #           virtio), which we map to /dev/mmcblk0 with udev rules
+            #           and symlinks with one of the prep steps but the kernel
+            #           needs it as sda before those kick in.
+            # https://www.kernel.org/doc/Documentation/kernel-parameters.txt
+            "-append", "panic=-1 console=ttyAMA0,115200 root=%s rootfstype=ext4 rw"
+                       % (machine.root,),
+
+            "-machine", machine.name,
+            "-cpu", machine.cpu,
+            "-m", str(machine.memory),
+
+            # Send the serial (and thus the console) to stdout
+            # but multiplex it with the monitor so Ctrl-A c will
+            # enter the monitor and Ctrl-C will go to the guest
+            # instead of interrupting qemu itself.
+            "-serial", serial,
+
+            # Used in conjunction with panic above, this makes qemu exit
+            # cleanly when the init process is killed.  It also cleanly
+            # exits when reboot is called, with no panic.
+            "-no-reboot",
+           ]
+
+    if machine.smp > 1:
+        # Emulate each CPU in its own host thread.
+        args += ["-smp", str(machine.smp), "-accel", "tcg,thread=multi"]
+
+    hostfwd=",hostfwd=tcp:127.0.0.1:%d-:22" % (ssh_port) if ssh_port else ""
+    if machine.virtio:
+        # The image is the "SD card" as above, on a paravirtual disk.
+        args += ["-drive", "file=" + image + ",if=none,id=sd,format=" + image_format + drive,
+                 "-device", "virtio-blk-device,drive=sd",
+                 "-netdev", "user,id=user.0" + hostfwd,
+                 "-device", "virtio-net-device,netdev=user.0",
+                ]
+    else:
+        # Use the raw raspibian image as the "SD card".  It's actually
+        # attached as a disk and we symlink /dev/mmcblk0 to /dev/sda
+        # in the udev rules set in prep.
+        args += ["-drive", "file=" + image + ",index=0,media=disk,format=" + image_format + drive,
+                 "-net", "type=user,id=user.0" + hostfwd,
+                 "-net", "type=nic,id=smc91c111.0,model=smc91c111",
+                ]
+
+    if not display:
+        args += ["-display", "none"]
+
+    return args
+
+def run_image(image, display, audio, ssh_port, promptfunc,
+              overlay=None, commit_overlay=False, from_snapshot=None,
+              timeline=None, milestones=TIMELINE_MILESTONES,
+              machine=MACHINES["versatilepb"], drive=()):
+    """Run an image, in qemu-system-arm emulating machine with the extra
+    drive options drive (see drive_options()).
+    Optionally with a display window and/or an ssh port redirect.
+
+    If overlay is a directory, boot from a temporary qcow2 overlay created
+    in it and backed by image, so image is not written to and any number
+    of emulators can share it.  The overlay is discarded when the emulator
+    exits unless commit_overlay is True, in which case its changes are
+    written back into image if the emulator exited cleanly.
+
+    If from_snapshot is the path of a snapshot made by snapshot(), resume
+    from the state saved in it instead of booting.  Each run starts over
+    from that state, and image is not written to.
+
+    If timeline is a file name, record the console output and milestones
+    in it (see record_timeline()).
+
+    Returns the exit status of the emulator when there's an overlay or a
+    timeline, otherwise qemu replaces this process."""
+    if not audio:
+        os.environ["QEMU_AUDIO_DRV"] = "none"
+
+    def emulate(args, replace):
+        """Run the emulator with args, replacing this process if replace
+        is True and it isn't needed afterwards."""
+        promptfunc()
+        if timeline is not None:
+            return record_timeline(args, timeline, milestones)
+        if replace:
+            os.execvp(args[0], args)
+        return subprocess.call(args)
+
+    if from_snapshot is not None:
+        return emulate(emulator_args(from_snapshot, display, ssh_port,
+                                     image_format="qcow2", machine=machine,
+                                     drive=drive)
+                       + ["-loadvm", snapshot_tag(image, machine)], True)
+
+    if overlay is None:
+        return emulate(emulator_args(image, display, ssh_port, machine=machine,
+                                     drive=drive), True)
+
+    with tempfile.TemporaryDirectory(dir=overlay) as overlay_dir:
+        overlay_image = os.path.join(overlay_dir, "overlay.qcow2")
+        run([QEMU_IMG, "create", "-q", "-f", "qcow2",
+             "-b", os.path.abspath(image), "-F", "raw", overlay_image])
+        returncode = emulate(emulator_args(overlay_image, display, ssh_port,
+                                           image_format="qcow2", machine=machine,
+                                           drive=drive), False)
+        if commit_overlay and returncode == 0:
+            run([QEMU_IMG, "commit", "-q", overlay_image])
+        elif commit_overlay:
+            # The guest may have been half way through writing anything.
+            print("ERROR: emulator exited with %d, not committing the overlay"
+                  " into %s." % (returncode, image), file=sys.stderr)
+    return returncode
+
+def record_timeline(args, timeline, milestones=TIMELINE_MILESTONES):
+    """Run the emulator with args, passing its console through to stdout
+    and timing each line of it from when the emulator started.  The first
+    time each of milestones, a sequence of (name, regular expression),
+    matches the console is recorded too.  On exit all of that is written
+    to the file timeline as JSON, and the exit status is returned."""
+    import json
+    milestones = [(name, re.compile(pattern)) for name, pattern in milestones]
+    reached = {}
+    lines = []
+
+    def check(line, when):
+        """Record the milestones first reached with line at when."""
+        for name, pattern in milestones:
+            if name not in reached and pattern.search(line):
+                reached[name] = when
+
+    started = time.time()
+    with subprocess.Popen(args, stdout=subprocess.PIPE) as process:
+        # The unfinished line so far, in pieces so a long one isn't copied
+        # again with each read, and its last TIMELINE_PROMPT_SCAN bytes.
+        partial = []
+        tail = b""
+        partial_started = None
+        while True:
+            data = os.read(process.stdout.fileno(), 4096)
+            if not data:
+                break
+            now = round(time.time() - started, 3)
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+
+            if not partial:
+                partial_started = now
+            *complete, rest = data.split(b"\n")
+            if complete:
+                complete[0] = b"".join(partial) + complete[0]
+                partial, tail = [], b""
+            for line in complete:
+                line = line.decode(errors="replace").rstrip("\r")
+                lines.append((partial_started, line))
+                check(line, partial_started)
+                partial_started = now
+            if rest:
+                partial.append(rest)
+                tail = (tail + rest)[-TIMELINE_PROMPT_SCAN:]
+                # Prompts like the login one are never finished with a
+                # newline, so look for them at the end of the line so far.
+                if len(reached) < len(milestones):
+                    check(tail.decode(errors="replace"), partial_started)
+        returncode = process.wait()
+
+    if partial:
+        partial = b"".join(partial).decode(errors="replace")
+        lines.append((partial_started, partial))
+    with open(timeline, "w") as f:
+        json.dump({"args": args,
+                   "started": started,
+                   "duration": round(time.time() - started, 3),
+                   "returncode": returncode,
+                   "milestones": reached,
+                   "lines": lines,
+                  }, f)
+        f.write("\n")
+    return returncode
+
+def snapshot_path(image):
+    """Return the default file to keep image's snapshot in."""
+    return image + ".snapshot.qcow2"
+
+def snapshot_tag(image, machine=MACHINES["versatilepb"]):
+    """Return the name the booted state of image on machine is saved under
+    in its snapshot.  It changes whenever image, the machine or its kernel
+    does, so a stale snapshot is never resumed."""
+    import hashlib
+    digest = hashlib.sha256()
+    digest.update(repr(machine).encode())
+    for path in (image, machine.kernel):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        digest.update(repr((path, stat.st_size, stat.st_mtime_ns)).encode())
+    return "raspbian-qemu-" + digest.hexdigest()[:16]
+
+def snapshot_valid(image, path, machine=MACHINES["versatilepb"]):
+    """Return True if path is a snapshot of image as it is now on
+    machine."""
+    if not os.path.isfile(path):
+        return False
+    snapshots = run([QEMU_IMG, "snapshot", "-l", path]).decode()
+    return snapshot_tag(image, machine) in snapshots.split()
+
+def snapshot(image, path, ready, timeout=None, machine=MACHINES["versatilepb"]):
+    """Boot image in qemu-system-arm on machine until ready appears on its console
+    and save the emulator's state then into a qcow2 overlay of image at
+    path, for run_image() to resume from.  Gives up with TimeoutError if
+    ready has not appeared after timeout seconds, and raises
+    CalledProcessError if the emulator exits with a non-zero status."""
+    os.environ["QEMU_AUDIO_DRV"] = "none"
+    tag = snapshot_tag(image, machine)
+    ready = ready.encode()
+    prompt = b"(qemu) "
+
+    # Build the snapshot beside path and only move it into place once it's
+    # complete so an interrupted snapshot is never used.
+    partial = path + ".partial"
+    run([QEMU_IMG, "create", "-q", "-f", "qcow2",
+         "-b", os.path.abspath(image), "-F", "raw", partial])
+    try:
+        args = emulator_args(partial, False, None, image_format="qcow2",
+                             machine=machine)
+        with subprocess.Popen(args, stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE) as process:
+            output = None
+            deadline = None if timeout is None else time.time() + timeout
+
+            def send(command, until):
+                """Send command to the emulator and read its output until
+                until appears, copying the output to stdout."""
+                nonlocal output
+                process.stdin.write(command)
+                process.stdin.flush()
+                output = b""
+                while until not in output:
+                    wait = None if deadline is None else deadline - time.time()
+                    if wait is not None and wait <= 0:
+                        raise TimeoutError("%r did not appear on the console" % (until,))
+                    if not select.select([process.stdout], [], [], wait)[0]:
+                        continue
+                    data = os.read(process.stdout.fileno(), 4096)
+                    if not data:
+                        raise ValueError("Unexpected EOF from the emulator.")
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.flush()
+                    output += data
+
+            try:
+                send(b"", ready)
+                # Ctrl-A c switches the console over to the monitor, which
+                # prompts again once it has finished each command.
+                send(b"\x01c", prompt)
+                send(b"savevm " + tag.encode() + b"\n", prompt)
+                process.stdin.write(b"quit\n")
+                process.stdin.close()
+                process.wait()
+            except:
+                process.kill()
+                raise
+        # A failed save may only show in the exit status.
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, args)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.unlink(partial)
+
+def free_port(exclude=()):
+    """Return a TCP port on localhost which is currently free and not in
+    exclude."""
+    import socket
+    while True:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        if port not in exclude:
+            return port
+
+class Instance(collections.namedtuple("Instance", ("number", "ssh_port",
+                                                   "log", "returncode",
+                                                   "duration"))):
+    """Result of one emulator run by run_many().
+        number     - instance number, counting from 1.
+        ssh_port   - localhost port redirected to the instance's ssh port.
+        log        - file the instance's console was written to.
+        returncode - exit status of the emulator.
+        duration   - seconds the emulator ran for.
+    """
+
+def run_many(image, count, jobs, log_dir, overlay=None, reportfunc=print,
+             machine=MACHINES["versatilepb"], drive=()):
+    """Run count instances of image in qemu-system-arm emulating machine
+    with the extra drive options drive (see drive_options()), no more than
+    jobs at a time.  Each runs from its own overlay (see run_image()) made
+    in overlay and removed as soon as the instance exits, has an ssh port
+    redirect from a free port, and has its console written to a log file
+    in log_dir.  Calls reportfunc with a message as each instance starts
+    and ends, and returns a list of Instances."""
+    os.environ["QEMU_AUDIO_DRV"] = "none"
+    os.makedirs(log_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(image))[0]
+
+    waiting = list(range(1, count + 1))
+    running = {}
+    finished = []
+    try:
+        while waiting or running:
+            while waiting and len(running) < jobs:
+                number = waiting.pop(0)
+                overlay_dir = tempfile.TemporaryDirectory(dir=overlay)
+                overlay_image = os.path.join(overlay_dir.name, "overlay.qcow2")
+                try:
+                    run([QEMU_IMG, "create", "-q", "-f", "qcow2",
+                         "-b", os.path.abspath(image), "-F", "raw", overlay_image])
+
+                    # An instance that has just started might not have
+                    # bound its port yet, so don't hand it out again.
+                    ssh_port = free_port(exclude=[info[1] for info in running.values()])
+                    log = os.path.join(log_dir, "%s.%d.log" % (name, number))
+                    args = emulator_args(overlay_image, False, ssh_port,
+                                         image_format="qcow2",
+                                         serial="file:" + log, machine=machine,
+                                         drive=drive)
+                    process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                               stdout=subprocess.DEVNULL)
+                except BaseException:
+                    overlay_dir.cleanup()
+                    raise
+                running[process] = (number, ssh_port, log, time.time(), overlay_dir)
+                reportfunc("instance %d: started, ssh port %d, console in %s"
+                           % (number, ssh_port, log))
+
+            time.sleep(0.1)
+            for process in [process for process in running
+                            if process.poll() is not None]:
+                number, ssh_port, log, started, overlay_dir = running.pop(process)
+                # The overlay is only of use to its instance, so free the
+                # space now rather than once the whole fleet is done.
+                overlay_dir.cleanup()
+                instance = Instance(number, ssh_port, log, process.returncode,
+                                    time.time() - started)
+                finished.append(instance)
+                reportfunc("instance %d: exited with %d after %.1fs"
+                           % (number, instance.returncode, instance.duration))
+    finally:
+        for process, (*_, overlay_dir) in running.items():
+            process.terminate()
+            process.wait()
+            overlay_dir.cleanup()
+
+    return sorted(finished)
+
+def extract(source_image, what, dest, keep_root=False, in_place=False):
+    """Extract data from source_image into file dest.
+    Data extracted is chosen by what, which can be:
+        - "hostkeys" to extract all ssh host keys into a tarfile.
+    """
+    import tarfile
+    with root_parition(source_image, read_only=True, keep_root=keep_root,
+                       in_place=in_place) as root_image:
+        with Ext4Image(root_image) as rootfs:
+            extracted = io.BytesIO()
+            if what == "hostkeys":
+                SSHDIR = "/etc/ssh/"
+                with tarfile.open(fileobj=extracted, mode="w") as tar:
+                    tartime = time.time()
+                    for member in rootfs.ls(SSHDIR, "ssh_host_*"):
+                        contents = rootfs.cat(os.path.join(SSHDIR, member.name))
+                        if member.size != len(contents):
+                            raise ValueError("file size does not match"
+                                             " contents size for "
+                                             "" + os.path.join(SSHDIR, member.name))
+                        member.mtime = tartime
+                        tar.addfile(member, io.BytesIO(contents))
+
+                    if not tar.getnames():
+                        raise FileNotFoundError("No host keys found in %s."
+                                                " Aborting." % (source_image,))
+            else:
+                raise NotImplementedError
+
+        open(dest, "wb").write(extracted.getvalue())
+
+@contextlib.contextmanager
+def in_directory(path):
+    """Context manager which changes to directory path and back to the
+    original directory on context close."""
+    current_path = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(current_path)
+
+ARM_PATCH_URL = "https://raw.githubusercontent.com/dhruvvyas90/qemu-rpi-kernel/master/tools/linux-arm.patch"
+# Where build_kernel() caches the patch, in the kernel source.
+ARM_PATCH_FILE = "raspbian-qemu-linux-arm.patch"
+def fetch_arm_patch(cachefilespec):
+    """Fetch the contents of a kernel patch which allows the ARM1176 processor
+    to be configured with the versatilepb board.
+
+    Will cache into cachefilespec, returning its contents if it exists.
+
+    Use version for 4.x at:
+      https://github.com/dhruvvyas90/qemu-rpi-kernel/blob/master/tools/linux-arm.patch
+
+    Cannot embed it here as its providence and license is unclear.
+    Trail includes:
+      https://www.raspberrypi.org/forums/viewtopic.php?f=2&t=4341
+      http://thoronir.net/raspi-dev/linux-arm.patch
+      https://gist.github.com/flatbird/fafb233f2843e99427e8
+      https://www.raspberrypi.org/forums/viewtopic.php?t=23046
+      https://github.com/johnlane/rpi-utils/tree/master/kernel
+      https://web.archive.org/web/20120626224432/http://xecdesign.com/compiling-a-kernel/
+      https://github.com/rimmington/qemu-rpi-kernel/commit/162fbe91a1d1b11e34a3af9326e06816aac67e1f
+    """
+    import urllib.request
+    if os.path.exists(cachefilespec):
+        with open(cachefilespec, "rb") as cachefile:
+            return cachefile.read()
+    else:
+        with urllib.request.urlopen(ARM_PATCH_URL) as response:
+            patch = response.read()
+            with open(cachefilespec, "wb") as cachefile:
+                cachefile.write(patch)
+            return patch
+
+TOOLCHAIN="arm-linux-gnueabihf"
+
+CONFIGS = [
+    'CONFIG_CROSS_COMPILE="{toolchain}"'.format(toolchain=TOOLCHAIN),
+    "CONFIG_CPU_V6=y",
+    "CONFIG_ARM_ERRATA_411920=y",
+    "CONFIG_ARM_ERRATA_364296=y",
+    "CONFIG_AEABI=y",
+    "CONFIG_OABI_COMPAT=y",
+    "CONFIG_PCI=y",
+    "CONFIG_SCSI=y",
+    "CONFIG_SCSI_SYM53C8XX_2=y",
+    "CONFIG_BLK_DEV_SD=y",
+    "CONFIG_BLK_DEV_SR=y",
+    "CONFIG_DEVTMPFS=y",
+    "CONFIG_DEVTMPFS_MOUNT=y",
+    "CONFIG_TMPFS=y",
+    "CONFIG_INPUT_EVDEV=y",
+    "CONFIG_EXT3_FS=y",
+    "CONFIG_EXT4_FS=y",
+    "CONFIG_VFAT_FS=y",
+    "CONFIG_NLS_CODEPAGE_437=y",
+    "CONFIG_NLS_ISO8859_1=y",
+    "CONFIG_FONT_8x16=y",
+    "CONFIG_LOGO=y",
+    "CONFIG_VFP=y",
+    "CONFIG_CGROUPS=y",
+    # To make ttyAMA0 work.
+    # See https://github.com/dhruvvyas90/qemu-rpi-kernel/issues/7
+    "CONFIG_FHANDLE=y",
+
+    # Initramfs.  This is not actually needed, but makes the kernel a bit
+    # more flexible when trying out various arm machines in qemu.  So,
+    # keeping it in for handy experimentation.
+    "CONFIG_BLK_DEV_INITRD=y",
+    "CONFIG_INITRAMFS_SOURCE=""",
+    "CONFIG_INITRAMFS_ROOT_UID=0",
+    "CONFIG_INITRAMFS_ROOT_GID=0",
+
+    # Raspbian tries to load these modules, compile them into the kernel.
+    "CONFIG_IPV6=y",
+    "CONFIG_IPV6_SIT=y",                #?
+    "CONFIG_IPV6_NDISC_NODETYPE=y",     #?
+    "CONFIG_AUTOFS4_FS=y",
+]
+
+# A trimmed down CONFIGS for the shortest time from reset to userspace
+# under emulation: only what's needed to mount the image and start
+# Raspbian's init, with the extras versatile_defconfig and CONFIGS add that
+# make the kernel bigger or slower to boot turned off.  Later settings
+# override earlier ones, so these win over versatile_defconfig.
+FASTBOOT_CONFIGS = [
+    'CONFIG_CROSS_COMPILE="{toolchain}"'.format(toolchain=TOOLCHAIN),
+    "CONFIG_CPU_V6=y",
+    "CONFIG_ARM_ERRATA_411920=y",
+    "CONFIG_ARM_ERRATA_364296=y",
+    "CONFIG_AEABI=y",
+    "CONFIG_VFP=y",
+    "CONFIG_PCI=y",
+    "CONFIG_SCSI=y",
+    "CONFIG_SCSI_SYM53C8XX_2=y",
+    "CONFIG_BLK_DEV_SD=y",
+    "CONFIG_DEVTMPFS=y",
+    "CONFIG_DEVTMPFS_MOUNT=y",
+    "CONFIG_TMPFS=y",
+    "CONFIG_EXT4_FS=y",
+    # The boot partition is in Raspbian's fstab.
+    "CONFIG_VFAT_FS=y",
+    "CONFIG_NLS_CODEPAGE_437=y",
+    "CONFIG_NLS_ISO8859_1=y",
+    # systemd needs these.
+    "CONFIG_CGROUPS=y",
+    "CONFIG_FHANDLE=y",
+    "CONFIG_AUTOFS4_FS=y",
+
+    "# CONFIG_OABI_COMPAT is not set",
+    "# CONFIG_BLK_DEV_INITRD is not set",
+    "# CONFIG_BLK_DEV_SR is not set",
+    "# CONFIG_LOGO is not set",
+    "# CONFIG_FRAMEBUFFER_CONSOLE is not set",
+    "# CONFIG_SOUND is not set",
+    "# CONFIG_USB_SUPPORT is not set",
+    "# CONFIG_MTD is not set",
+    "# CONFIG_NFS_FS is not set",
+    "# CONFIG_ROOT_NFS is not set",
+    "# CONFIG_IPV6 is not set",
+]
+
+# What the virt machine's kernel needs on top of multi_v7_defconfig, which
+# already covers most of what CONFIGS adds for versatilepb.  Profiles don't
+# apply to it.
+VIRT_CONFIGS = [
+    'CONFIG_CROSS_COMPILE="{toolchain}"'.format(toolchain=TOOLCHAIN),
+    "CONFIG_ARCH_VIRT=y",
+    "CONFIG_SMP=y",
+    "CONFIG_VFP=y",
+    "CONFIG_NEON=y",
+    "CONFIG_VIRTIO=y",
+    "CONFIG_VIRTIO_MMIO=y",
+    "CONFIG_VIRTIO_BLK=y",
+    "CONFIG_VIRTIO_NET=y",
+    "CONFIG_DEVTMPFS=y",
+    "CONFIG_DEVTMPFS_MOUNT=y",
+    "CONFIG_TMPFS=y",
+    "CONFIG_EXT4_FS=y",
+    "CONFIG_VFAT_FS=y",
+    "CONFIG_NLS_CODEPAGE_437=y",
+    "CONFIG_NLS_ISO8859_1=y",
+    "CONFIG_CGROUPS=y",
+    "CONFIG_FHANDLE=y",
+    "CONFIG_AUTOFS4_FS=y",
+    "CONFIG_IPV6=y",
+]
+
+# The CONFIGS build-kernel can build with, by name.
+CONFIG_PROFILES = collections.OrderedDict((
+    ("compat", CONFIGS),
+    ("fastboot", FASTBOOT_CONFIGS),
+))
+
+class KernelCache(ImageCache):
+    """A directory of built kernels, each named by a key identifying how it
+    was built, limited to max_size bytes of disk by evicting the least
+    recently used kernels."""
+    DEFAULT_PATH = os.path.join(ImageCache.DEFAULT_PATH, "kernels")
+    SUFFIX = ".zImage"
+
+def kernel_cache_key(linux_path, arm_patch, configs=CONFIGS):
+    """Return the KernelCache key for building the kernel checked out in
+    linux_path, with any uncommitted changes, patched with arm_patch (if
+    not empty) and configured with configs, using this version of the tool
+    and the installed toolchain.  Returns None if linux_path is not a git
+    checkout, as then there's no cheap way to identify the source."""
+    import hashlib
+    git = ["git", "-C", linux_path]
+    try:
+        head = run(git + ["rev-parse", "HEAD"])
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return None
+    # The files arm_patch changes are left out, as build_kernel() patches
+    # them whether or not a previous build already has.
+    patched = re.findall(rb"^\+\+\+ [^/\s]+/(\S+)", arm_patch, re.MULTILINE)
+    exclude = [":(exclude)" + path.decode() for path in patched]
+    diff = run(git + ["diff", "--binary", "HEAD", "--", "."] + exclude)
+    untracked = run(git + ["ls-files", "-z", "--others", "--exclude-standard",
+                           "--", ".", ":(exclude)" + ARM_PATCH_FILE] + exclude)
+    toolchain = tool_version(TOOLCHAIN + "-gcc").encode()
+
+    key = hashlib.sha256()
+    key.update(__version__.encode() + b"\0")
+    key.update(head.strip() + b"\0")
+    key.update(hashlib.sha256(diff).digest())
+    for name in sorted(untracked.split(b"\0")[:-1]):
+        with open(os.path.join(linux_path, os.fsdecode(name)), "rb") as f:
+            key.update(name + b"\0" + hashlib.sha256(f.read()).digest())
+    key.update(hashlib.sha256(arm_patch).digest())
+    key.update("\n".join(configs).encode() + b"\0")
+    key.update(toolchain + b"\0")
+    return key.hexdigest()
+
+def build_kernel(linux_path, cache=None, jobs=None, incremental=False,
+                 ccache=False, profile="compat", machine=MACHINES["versatilepb"]):
+    """Given a checkout of https://github.com/raspberrypi/linux.git,
+    patch, configure with the CONFIG_PROFILES profile (or VIRT_CONFIGS for
+    virtio machines), and build the kernel binary for machine that will boot
+    the raspibian distribution under qemu.  Optionally:
+        - reuse a kernel built from the same source and configuration from
+          a KernelCache cache
+        - run jobs compiles at once instead of one per CPU
+        - keep the previous build's objects if it was configured the same
+        - compile through ccache
+
+    Returns an OrderedDict of the seconds taken by each stage of the build.
+
+    This function and some above variables based on:
+        https://github.com/dhruvvyas90/qemu-rpi-kernel/blob/master/tools/build-kernel-qemu
+    """
+    timings = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def timed(stage):
+        """Add the time taken by the with block to stage's timing."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            timings[stage] = timings.get(stage, 0) + time.time() - started
+
+    def make(target):
+        """Convenience function to run make with parallel and
+        cross-compile options."""
+        args = [MAKE, "-j", str(jobs or os.cpu_count()),
+                "ARCH=arm", "CROSS_COMPILE=" + TOOLCHAIN + "-"]
+        if ccache:
+            # Only the compiler is wrapped, as ccache can't run the rest of
+            # the toolchain that CROSS_COMPILE prefixes.
+            args.append("CC=%s %s-gcc" % (CCACHE, TOOLCHAIN))
+        with timed(target):
+            run(args + [target])
+
+    def configure():
+        """Write a .config for the emulated machine."""
+        make(machine.defconfig)
+        with open(".config", "a") as dotconfig:
+            for config in configs:
+                dotconfig.write(config)
+                dotconfig.write("\n")
+        make("olddefconfig")
+
+    configs = VIRT_CONFIGS if machine.virtio else CONFIG_PROFILES[profile]
+    # Only versatilepb needs patching to take the ARM1176.
+    arm_patch = b""
+    if not machine.virtio:
+        with in_directory(linux_path):
+            arm_patch = fetch_arm_patch(ARM_PATCH_FILE)
+
+    key = None
+    if cache is not None:
+        with timed("cache"):
+            key = kernel_cache_key(linux_path, arm_patch,
+                                   [machine.defconfig] + configs)
+            if key is not None and cache.fetch(key, machine.kernel):
+                return timings
+
+    with in_directory(linux_path):
+        if arm_patch:
+            with timed("patch"):
+                try:
+                    run([PATCH, "-p1", "--forward", "--reject-file=-"],
+                        input=arm_patch)
+                except subprocess.CalledProcessError:
+                    # We might be double-patching the kernel in which case it
+                    # will return non-zero.  So ignore that.
+                    pass
+
+        previous_config = None
+        if incremental and os.path.exists(".config"):
+            with open(".config", "rb") as dotconfig:
+                previous_config = dotconfig.read()
+            configure()
+            with open(".config", "rb") as dotconfig:
+                if dotconfig.read() != previous_config:
+                    previous_config = None
+        if previous_config is None:
+            make("distclean")
+            configure()
+        make("bzImage")
+    data_copy(os.path.join(linux_path, "arch/arm/boot/zImage"), machine.kernel)
+    if key is not None:
+        with timed("cache"):
+            cache.store(key, machine.kernel)
+    return timings
+
+def check_dependencies(dependencies):
+    """Check that all of the tools in dependencies are available.
+
+    Dependencies are checked below on a per-action basis so an action with its
+    dependencies met, can be used even if you don"t have the dependencies for
+    other actions.
+
+    This is redundant for a packaged install but allows the script to give
+    better error messages if the script is deployed without a package.
+
+    Tools are looked up on PATH without running them, and run() then uses
+    the paths found (see find_tool())."""
+    missing = [tool for tool in dependencies if find_tool(tool) is None]
+
+    for tool in missing:
+        print(tool, "is required, but missing.", file=sys.stderr)
+
+    if missing:
+        sys.exit("Aborting.")
+
+def check_image(image, *, check_write=False):
+    """Check that the image file exists and optinally if writeable."""
+    if not os.path.isfile(image):
+        sys.exit("ERROR: image %s not found. Aborting." % (image,))
+    if check_write and not os.access(image, os.W_OK):
+        sys.exit("ERROR: image %s is not writable. Aborting." % (image,))
+
+def check_not_overwritten(image):
+    """Check that image, which was not named on the command line, doesn't
+    already exist and so won't be overwritten."""
+    if os.path.exists(image):
+        sys.exit("ERROR: %s already exists. Name it as the destination to"
+                 " overwrite it. Aborting." % (image,))
+
+def check_public_key(public_key):
+    """Check that the public_key file exists."""
+    if public_key is None:
+        return
+
+    if not os.path.exists(public_key):
+        sys.exit("ERROR: public key %s not found. Aborting." % (public_key,))
+
+    with open(public_key) as keyfile:
+        if "PRIVATE KEY" in keyfile.read():
+            sys.exit("ERROR: public key %s appears to be a private key. Did you forget the .pub extension?  Aborting." % (public_key,))
+
+def check_host_keys(host_keys):
+    """Check the host key modes to make sure we're not injecting
+       a security hole.
+    """
+    import tarfile
+    if host_keys is None:
+        return
+
+    with tarfile.open(host_keys, "r") as tar:
+        for member in tar:
+            if member.uid != 0 or member.gid != 0:
+                sys.exit("ERROR: Refusing to inject host key"
+                         " %r with improper ownership of %d:%d."
+                         " Aborting." % (member.name, member.uid, member.gid))
+
+            if (member.name.endswith(".pub") and member.mode & 0o033) \
+               or (not member.name.endswith(".pub") and member.mode & 0o077):
+                sys.exit("ERROR: Refusing to inject host key"
+                         " %r with improper mode of %03o."
+                         " Aborting." % (member.name, member.mode))
+
+def check_kernel_source(source):
+    """Check that the kernel source directory exists, is in fact a directory,
+    and has at least a Makefile in it."""
+    if not os.path.isdir(source):
+        sys.exit("source must be a directory.")
+
+    if not os.path.exists(os.path.join(source, "Makefile")):
+        sys.exit("source doesn't seem to be a kernel checkout.")
+
+
+def main(argv):
+    """Command line argument parsing, checking, and dispatch."""
+    parser = argparse.ArgumentParser(prog=argv[0])
+
+    parser.add_argument("--version", action="version",
+                        version="%(prog)s " + __version__)
+    parser.add_argument("--debug", help="Enable extended debug output to stderr",
+                        action="store_true")
+    parser.add_argument("--script", help="Disable any user prompts and delays",
+                        action="store_true")
+    # Keep the extracted root parition for spelunking.
+    parser.add_argument("--keep-root", help=argparse.SUPPRESS,
+                        action="store_true")
+    parser.add_argument("--in-place", action="store_true",
+                        help="Edit the root partition where it sits in the image"
+                             " instead of extracting it to a temporary file")
+
+    action_parser = parser.add_subparsers(dest="action",
+                                          title="actions",
+                                          help="Specific action to perform")
+    # http://bugs.python.org/issue9253#msg186387
+    action_parser.required = True
+
+    extract_parser = action_parser.add_parser("extract", help="Extract artifacts from a Raspbian image.")
+    extract_parser.add_argument("image", help="Raspbian image to extract from.")
+    extract_parser.add_argument("what", help="What to extract from the image.",
+                                choices=("hostkeys",))
+    extract_parser.add_argument("dest", help="Optional name of file to extract to.")
+
+    prep_parser = action_parser.add_parser("prep", help="Prepare a Raspbian image to run under emulation.")
+    prep_parser.add_argument("image", help="Raspbian image to prep to run in qemu.")
+    prep_parser.add_argument("dest", nargs="?", help="Optional name of new image.")
+    prep_parser.add_argument("--grow-root", help="How much space to add to the root partition. (can use K,M,G suffixes)")
+    prep_parser.add_argument("--add-public-key", help="Add a public key to user pi's authorized_keys")
+    prep_parser.add_argument("--set-host-keys", help="Inject a set of hosts keys from a tar file")
+    prep_parser.add_argument("--cache", nargs="?", const=ImageCache.DEFAULT_PATH,
+                             help="Reuse identically prepped images from a cache directory."
+                                  " (default: %s)" % (ImageCache.DEFAULT_PATH,))
+    prep_parser.add_argument("--cache-size", default="16G",
+                             help="Disk space the cache may use. (can use K,M,G suffixes)")
+    prep_parser.add_argument("--compact", action="store_true",
+                             help="Punch holes over the file systems' free space when done.")
+
+    prep_many_parser = action_parser.add_parser("prep-many", help="Prepare many Raspbian images to run under emulation at once.")
+    prep_many_parser.add_argument("images", nargs="*", metavar="IMAGE[=DEST]",
+                                  help="Raspbian image to prep, optionally followed by = and the name of the new image.")
+    prep_many_parser.add_argument("--manifest",
+                                  help="File listing more images to prep, one per line, each optionally followed by the name of the new image.")
+    prep_many_parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                                  help="Most images to prep at once. (default: %(default)s, the number of CPUs)")
+    prep_many_parser.add_argument("--disk-jobs", type=int, default=2,
+                                  help="Most preps to be copying or checking a whole image at once. (default: %(default)s)")
+    prep_many_parser.add_argument("--log-dir", default=".",
+                                  help="Directory to write each prep's output to. (default: %(default)s)")
+    prep_many_parser.add_argument("--grow-root", help="How much space to add to each root partition. (can use K,M,G suffixes)")
+    prep_many_parser.add_argument("--add-public-key", help="Add a public key to user pi's authorized_keys")
+    prep_many_parser.add_argument("--set-host-keys", help="Inject a set of hosts keys from a tar file")
+    prep_many_parser.add_argument("--cache", nargs="?", const=ImageCache.DEFAULT_PATH,
+                                  help="Reuse identically prepped images from a cache directory."
+                                       " (default: %s)" % (ImageCache.DEFAULT_PATH,))
+    prep_many_parser.add_argument("--compact", action="store_true",
+                                  help="Punch holes over each image's free space when done.")
+    prep_many_parser.add_argument("--cache-size", default="16G",
+                                  help="Disk space the cache may use. (can use K,M,G suffixes)")
+
+    shrink_parser = action_parser.add_parser("shrink", help="Shrink the root partition of a Raspbian image to what its files need.")
+    shrink_parser.add_argument("image", help="Raspbian image to shrink.")
+    shrink_parser.add_argument("dest", nargs="?", help="Optional name of new image.")
+    shrink_parser.add_argument("--headroom",
+                               help="Free space to leave in the root partition. (can use K,M,G suffixes)")
+
+    diff_parser = action_parser.add_parser("diff", help="Write the blocks two images differ in to a delta file.")
+    diff_parser.add_argument("base", help="Image the delta will be applied to.")
+    diff_parser.add_argument("image", help="Image the delta turns base into.")
+    diff_parser.add_argument("delta", help="Name of delta file to write.")
+    diff_parser.add_argument("--block-size", default="64K",
+                             help="Size of blocks to compare. (can use K,M,G suffixes, default: %(default)s)")
+
+    patch_parser = action_parser.add_parser("patch", help="Apply a delta file made by diff to an image.")
+    patch_parser.add_argument("image", help="Image to patch, the base the delta was made from.")
+    patch_parser.add_argument("delta", help="Delta file to apply.")
+    patch_parser.add_argument("dest", nargs="?", help="Optional name of new image.")
+
+    store_parser = action_parser.add_parser("store", help="Keep many images in a deduplicating chunk store.")
+    store_parser.add_argument("--store", default=ChunkStore.DEFAULT_PATH,
+                              help="Store directory. (default: %(default)s)")
+    store_parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                              help="Threads to compress or write chunks with. (default: %(default)s, the number of CPUs)")
+    store_action_parser = store_parser.add_subparsers(dest="store_action",
+                                                      title="store actions")
+    store_action_parser.required = True
+    store_add_parser = store_action_parser.add_parser("add", help="Add an image to the store.")
+    store_add_parser.add_argument("image", help="Image to add.")
+    store_add_parser.add_argument("name", nargs="?", help="Name to store it as. (default: its file name)")
+    store_rebuild_parser = store_action_parser.add_parser("rebuild", help="Write out a stored image.")
+    store_rebuild_parser.add_argument("name", help="Name of the stored image.")
+    store_rebuild_parser.add_argument("dest", help="Image file to write.")
+    store_remove_parser = store_action_parser.add_parser("remove", help="Remove an image from the store.")
+    store_remove_parser.add_argument("name", help="Name of the stored image.")
+    store_action_parser.add_parser("list", help="List the stored images.")
+    store_action_parser.add_parser("gc", help="Delete chunks no stored image uses.")
+
+    compact_parser = action_parser.add_parser("compact", help="Punch holes over the free space of a Raspbian image's file systems.")
+    compact_parser.add_argument("image", help="Raspbian image to compact.")
+
+    unprep_parser = action_parser.add_parser("unprep", help='Unprep a previous-prepped Raspbian image so it can be run on actual hardware.')
+    unprep_parser.add_argument("image", help="Name of image to unprep to run on actual hardware.")
+    unprep_parser.add_argument("dest", nargs="?", help="Optional name of new image.")
+    unprep_parser.add_argument("--compress", choices=COMPRESSIONS,
+                               help="Write the unprepped image compressed, in parallel, to IMAGE"
+                                    " (or DEST) with the compression's extension added.  The"
+                                    " uncompressed DEST isn't kept.")
+    unprep_parser.add_argument("--compress-index", action="store_true",
+                               help="Also write a JSON index of the compressed image's"
+                                    " independently compressed chunks, adding .index to its name.")
+    unprep_parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                               help="Threads to compress with. (default: %(default)s, the number of CPUs)")
+
+    run_parser = action_parser.add_parser("run", help="Run a prepped Raspbian image under emulation.")
+    run_parser.add_argument("image", help="Name of image to run")
+    run_parser.add_argument("--with-display", action="store_true",
+                            help="Do not suppress the creation of a graphical window.")
+    run_parser.add_argument("--with-audio", action="store_true",
+                            help="Do not suppress audio support in QEMU.")
+    run_parser.add_argument("--with-ssh-port", type=int,
+                            help="Redirect localhost:port to the emulated machine's ssh port.")
+    run_parser.add_argument("--overlay", nargs="?", const=tempfile.gettempdir(),
+                            metavar="DIR",
+                            help="Leave the image untouched by running from a temporary"
+                                 " copy-on-write overlay in DIR (default: %s)."
+                                 " Use /dev/shm to keep it in memory." % (tempfile.gettempdir(),))
+    run_parser.add_argument("--commit-overlay", action="store_true",
+                            help="Write the changes in the overlay back into the image on exit.")
+
+    run_parser.add_argument("--timeline", metavar="FILE",
+                            help="Write the time of each console line and of boot milestones"
+                                 " to FILE as JSON when the emulator exits.")
+    run_parser.add_argument("--milestone", action="append", default=[],
+                            metavar="NAME=PATTERN",
+                            help="Record in the timeline when the regular expression PATTERN"
+                                 " first matches the console as milestone NAME, replacing"
+                                 " any default milestone of that name.  (can be repeated,"
+                                 " defaults: %s)" % (", ".join(name for name, pattern
+                                                               in TIMELINE_MILESTONES),))
+    run_parser.add_argument("--from-snapshot", nargs="?", const="", metavar="FILE",
+                            help="Resume from the state saved by the snapshot action in FILE"
+                                 " (default: IMAGE.snapshot.qcow2) instead of booting,"
+                                 " taking the snapshot first if it is missing or stale.")
+    run_parser.add_argument("--ready", default=SNAPSHOT_READY,
+                            help="Console output that means the emulated machine is ready"
+                                 " when --from-snapshot has to take the snapshot."
+                                 " (default: %(default)r)")
+
+    snapshot_parser = action_parser.add_parser("snapshot", help="Boot a prepped Raspbian image and save the running state to resume from.")
+    snapshot_parser.add_argument("image", help="Name of image to snapshot")
+    snapshot_parser.add_argument("dest", nargs="?",
+                                 help="File to save the snapshot in. (default: IMAGE.snapshot.qcow2)")
+    snapshot_parser.add_argument("--ready", default=SNAPSHOT_READY,
+                                 help="Console output that means the emulated machine is ready."
+                                      " (default: %(default)r)")
+    snapshot_parser.add_argument("--timeout", type=float,
+                                 help="Seconds to wait for the machine to be ready. (default: forever)")
+
+    many_parser = action_parser.add_parser("run-many", help="Run many instances of a prepped Raspbian image under emulation at once.")
+    many_parser.add_argument("image", help="Name of image to run")
+    many_parser.add_argument("count", type=int, help="Number of instances to run.")
+    many_parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                             help="Most instances to run at once. (default: %(default)s, the number of CPUs)")
+    many_parser.add_argument("--log-dir", default=".",
+                             help="Directory to write each instance's console log to. (default: %(default)s)")
+    many_parser.add_argument("--overlay", metavar="DIR",
+                             help="Directory for the instances' overlays. (default: %s)"
+                                  % (tempfile.gettempdir(),))
+
+    kernel_parser = action_parser.add_parser("build-kernel", help="Build an emulation kernel from source.")
+    kernel_parser.add_argument("source", help="path of https://github.com/raspberrypi/linux.git checkout")
+    kernel_parser.add_argument("--cache", nargs="?", const=KernelCache.DEFAULT_PATH,
+                               help="Reuse kernels built from the same git revision, patch,"
+                                    " configuration and toolchain from a cache directory."
+                                    " (default: %s)" % (KernelCache.DEFAULT_PATH,))
+    kernel_parser.add_argument("--cache-size", default="1G",
+                               help="Disk space the cache may use. (can use K,M,G suffixes)")
+    kernel_parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                               help="Number of compiles to run at once. (default: %(default)s, the number of CPUs)")
+    kernel_parser.add_argument("--incremental", action="store_true",
+                               help="Keep the previous build if the configuration comes out the same"
+                                    " instead of cleaning the source directory.")
+    kernel_parser.add_argument("--ccache", action="store_true",
+                               help="Compile through ccache.")
+    kernel_parser.add_argument("--profile", choices=CONFIG_PROFILES,
+                               help="Kernel configuration to build for versatilepb: compat has"
+                                    " extras for experimenting, fastboot is trimmed to boot"
+                                    " quickest. (default: compat)")
+    kernel_parser.add_argument("--machine", choices=MACHINES, default="versatilepb",
+                               help="Machine to build the kernel for. (default: %(default)s)")
+
+    for disk_parser in (run_parser, many_parser):
+        disk_parser.add_argument("--disk-cache", choices=("none", "writeback", "unsafe"),
+                                 help="Host caching of the image: none bypasses the host's page"
+                                      " cache, writeback uses it, unsafe also ignores flushes"
+                                      " from the emulated machine.  (default: qemu's)")
+        disk_parser.add_argument("--disk-aio", choices=("threads", "native", "io_uring"),
+                                 help="How qemu does asynchronous IO on the image.  native needs"
+                                      " --disk-cache=none. (default: qemu's)")
+    run_parser.add_argument("--discard", action="store_true",
+                            help="Send writes to the image to a temporary file thrown away on exit.")
+
+    for machine_parser in (run_parser, snapshot_parser, many_parser):
+        machine_parser.add_argument("--machine", choices=MACHINES, default="versatilepb",
+                                    help="Machine to emulate.  virt is faster and bigger but needs"
+                                         " its own kernel from build-kernel --machine=virt."
+                                         " (default: %(default)s)")
+        machine_parser.add_argument("--smp", type=int,
+                                    help="Number of CPUs to emulate. (default: 1 for versatilepb,"
+                                         " %d for virt)" % (MACHINES["virt"].smp,))
+        machine_parser.add_argument("--memory", type=int, metavar="MB",
+                                    help="Megabytes of RAM to emulate. (default: 256 for"
+                                         " versatilepb, %d for virt)" % (MACHINES["virt"].memory,))
+
+    args = parser.parse_args(argv[1:])
+
+    run.debug = args.debug
+
+    if args.action in ("run", "run-many", "snapshot"):
+        machine = MACHINES[args.machine]
+        if not machine.virtio and ((args.smp or 1) > 1 or (args.memory or 256) > 256):
+            parser.error("versatilepb can only have 1 CPU and 256M of RAM")
+        machine = machine._replace(smp=args.smp or machine.smp,
+                                   memory=args.memory or machine.memory)
+    if args.action in ("run-many", "prep-many") and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.action == "prep-many" and args.disk_jobs < 1:
+        parser.error("--disk-jobs must be at least 1")
+    if args.action in ("run", "run-many"):
+        if args.disk_aio == "native" and args.disk_cache != "none":
+            parser.error("--disk-aio=native needs --disk-cache=none")
+        drive = drive_options(args.disk_cache, args.disk_aio,
+                              args.action == "run" and args.discard)
+    def size_option(option, value):
+        """Return the size given to option as value, which can use K,M,G
+        suffixes, with a usage error if it isn't one."""
+        try:
+            return resolve_suffix(value)
+        except (KeyError, IndexError, ValueError):
+            parser.error("%s must be a number of bytes, optionally with a K, M"
+                         " or G suffix, not %r" % (option, value))
+
+    if args.action == "shrink":
+        size_option("--headroom", args.headroom)
+    if args.action == "diff" and size_option("--block-size", args.block_size) < 1:
+        parser.error("--block-size must be at least 1 byte")
+    if args.action == "prep" and args.cache is not None and args.keep_root:
+        # A cached prep never extracts the root partition to keep.
+        parser.error("--keep-root can't be used with --cache")
+    if args.action == "unprep" and args.compress_index and args.compress is None:
+        parser.error("--compress-index requires --compress")
+    if args.action == "build-kernel":
+        machine = MACHINES[args.machine]
+        if machine.virtio and args.profile is not None:
+            parser.error("--profile only applies to --machine=versatilepb")
+
+    if args.action in ("prep", "unprep", "shrink", "compact", "diff", "patch",
+                       "run", "run-many", "snapshot", "extract"):
+        if args.action == "run":
+            # An overlay leaves the image alone, unless it's committed.
+            need_writeable = ((args.overlay is None or args.commit_overlay)
+                              and args.from_snapshot is None and not args.discard)
+        elif args.action in ("run-many", "snapshot", "diff"):
+            need_writeable = False
+        elif args.action == "compact":
+            need_writeable = True
+        else:
+            need_writeable = args.dest is None and args.action != "extract" \
+                             and not (args.action == "prep"
+                                      and args.image.endswith(COMPRESSED_EXTENSIONS))
+        check_image(args.image, check_write=need_writeable)
+        if args.action == "prep" and args.dest is None \
+           and args.image.endswith(COMPRESSED_EXTENSIONS):
+            check_not_overwritten(decompressed_name(args.image))
+    elif args.action == "prep-many":
+        images = [(image, dest or None)
+                  for image, equals, dest in (image.partition("=")
+                                              for image in args.images)]
+        if args.manifest is not None:
+            try:
+                images += read_prep_manifest(args.manifest)
+            except (OSError, ValueError) as e:
+                sys.exit("ERROR: %s" % (e,))
+        if not images:
+            parser.error("no images to prep")
+        dests = [dest or (decompressed_name(image)
+                          if image.endswith(COMPRESSED_EXTENSIONS) else image)
+                 for image, dest in images]
+        if len(set(dests)) != len(dests):
+            parser.error("more than one prep would write the same image")
+        for image, dest in images:
+            check_image(image, check_write=dest is None
+                        and not image.endswith(COMPRESSED_EXTENSIONS))
+            if dest is None and image.endswith(COMPRESSED_EXTENSIONS):
+                check_not_overwritten(decompressed_name(image))
+
+    # Any image manipulation we do might contain sensitive files like host
+    # keys. Make sure only we can read files produced.
+    with umask(0o077):
+        if args.action == "prep":
+            if args.add_public_key is not None:
+                if "~" in args.add_public_key:
+                    args.add_public_key = os.path.expanduser(args.public_key)
+            check_dependencies([RESIZE2FS, E2FSCK, DEBUGFS])
+            check_public_key(args.add_public_key)
+            check_host_keys(args.set_host_keys)
+            cache = None
+            if args.cache is not None:
+                cache = ImageCache(args.cache, args.cache_size)
+            prep(args.image, args.dest,
+                 args.grow_root, args.add_public_key, args.set_host_keys,
+                 args.keep_root, args.in_place, cache, args.compact)
+        elif args.action == "prep-many":
+            if args.add_public_key is not None:
+                args.add_public_key = os.path.expanduser(args.add_public_key)
+            check_dependencies([RESIZE2FS, E2FSCK, DEBUGFS])
+            check_public_key(args.add_public_key)
+            check_host_keys(args.set_host_keys)
+            cache = None
+            if args.cache is not None:
+                cache = ImageCache(args.cache, args.cache_size)
+            prepped = prep_many(images, args.jobs, args.disk_jobs, args.log_dir,
+                                grow_root=args.grow_root,
+                                public_key=args.add_public_key,
+                                hosts_keys=args.set_host_keys,
+                                keep_root=False, in_place=args.in_place,
+                                cache=cache, compact=args.compact)
+            width = max(len(job.image) for job in prepped)
+            print()
+            print("%-*s %9s  %s" % (width, "image", "seconds", "result"))
+            for job in prepped:
+                print("%-*s %9.1f  %s" % (width, job.image, job.duration,
+                                          job.error or "ok (%s)" % (job.dest or job.image,)))
+            if any(job.error for job in prepped):
+                sys.exit("ERROR: not all images were prepped, see the logs in %s."
+                         % (args.log_dir,))
+        elif args.action == "unprep":
+            check_dependencies([DEBUGFS] + ([ZSTD] if args.compress == "zstd" else []))
+            if args.compress is None:
+                unprep(args.image, args.dest, args.keep_root, args.in_place)
+            else:
+                compressed = (args.dest or args.image) + COMPRESSIONS[args.compress]
+                index = compressed + ".index" if args.compress_index else None
+                if args.dest is None:
+                    unprep(args.image, None, args.keep_root, args.in_place)
+                    compress_image(args.image, compressed, args.compress,
+                                   args.jobs, index)
+                else:
+                    with tempfile.NamedTemporaryFile(dir=os.path.dirname(args.dest) or ".") as image:
+                        unprep(args.image, image.name, args.keep_root, args.in_place)
+                        compress_image(image.name, compressed, args.compress,
+                                       args.jobs, index)
+        elif args.action == "shrink":
+            check_dependencies([RESIZE2FS, E2FSCK])
+            shrink(args.image, args.dest, args.headroom, args.keep_root,
+                   args.in_place)
+        elif args.action == "diff":
+            check_image(args.base)
+            recorded = diff_images(args.base, args.image, args.delta,
+                                   args.block_size)
+            print("Recorded %.1fM of changes in %.1fM."
+                  % (recorded / 1024**2, os.path.getsize(args.delta) / 1024**2))
+        elif args.action == "patch":
+            try:
+                patch_image(args.image, args.delta, args.dest)
+            except (OSError, ValueError) as e:
+                sys.exit("ERROR: %s" % (e,))
+        elif args.action == "store":
+            store = ChunkStore(args.store)
+            try:
+                if args.store_action == "add":
+                    check_image(args.image)
+                    data_size, stored = store.add(args.image, args.name, args.jobs)
+                    print("Stored %.1fM of data as %.1fM of new chunks."
+                          % (data_size / 1024**2, stored / 1024**2))
+                elif args.store_action == "rebuild":
+                    store.rebuild(args.name, args.dest, args.jobs)
+                elif args.store_action == "remove":
+                    store.remove(args.name)
+                elif args.store_action == "list":
+                    for name in store.images():
+                        print(name)
+                elif args.store_action == "gc":
+                    deleted, freed = store.gc()
+                    print("Deleted %d chunks, freeing %.1fM."
+                          % (deleted, freed / 1024**2))
+            except (OSError, ValueError) as e:
+                sys.exit("ERROR: %s" % (e,))
+        elif args.action == "compact":
+            try:
+                freed = compact_image(args.image)
+            except ValueError as e:
+                sys.exit("ERROR: %s" % (e,))
+            print("Freed %.1fM." % (freed / 1024**2,))
+        elif args.action == "extract":
+            try:
+                extract(args.image, args.what, args.dest, args.keep_root,
+                        args.in_place)
+            except FileNotFoundError as e:
+                sys.exit(e)
+
+    if args.action == "run":
+        if args.commit_overlay and args.overlay is None:
+            parser.error("--commit-overlay requires --overlay")
+        if args.from_snapshot is not None and args.overlay is not None:
+            parser.error("--from-snapshot and --overlay cannot be used together")
+        if args.discard and (args.commit_overlay or args.from_snapshot is not None):
+            parser.error("--discard cannot be used with --commit-overlay or --from-snapshot")
+        if args.overlay is None and args.from_snapshot is None:
+            check_dependencies([QEMU])
+        else:
+            check_dependencies([QEMU, QEMU_IMG])
+        if args.from_snapshot is not None:
+            args.from_snapshot = args.from_snapshot or snapshot_path(args.image)
+            try:
+                if not snapshot_valid(args.image, args.from_snapshot, machine):
+                    print("Taking snapshot %s" % (args.from_snapshot,))
+                    snapshot(args.image, args.from_snapshot, args.ready,
+                             machine=machine)
+            except FileNotFoundError as e:
+                sys.exit(e)
+        milestones = collections.OrderedDict(TIMELINE_MILESTONES)
+        for milestone in args.milestone:
+            name, equals, pattern = milestone.partition("=")
+            if not equals:
+                parser.error("--milestone must be NAME=PATTERN: %r" % (milestone,))
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                parser.error("bad --milestone pattern %r: %s" % (pattern, e))
+            milestones[name] = pattern
+        def prompt():
+            """Prompt on how to get out of the emulator, and pause if
+            args.script is not true."""
+            print("Use Ctrl-a, then 'c' to get into the monitor.  Then 'quit' to exit.")
+            if not args.script and os.isatty(sys.stdin.fileno()):
+                time.sleep(3)
+
+        sys.exit(run_image(args.image,
+                           args.with_display, args.with_audio, args.with_ssh_port,
+                           prompt, args.overlay, args.commit_overlay,
+                           args.from_snapshot, args.timeline, milestones.items(),
+                           machine, drive))
+    elif args.action == "snapshot":
+        check_dependencies([QEMU, QEMU_IMG])
+        try:
+            snapshot(args.image, args.dest or snapshot_path(args.image),
+                     args.ready, args.timeout, machine)
+        except FileNotFoundError as e:
+            sys.exit(e)
+        except (TimeoutError, subprocess.CalledProcessError) as e:
+            sys.exit("ERROR: %s" % (e,))
+    elif args.action == "run-many":
+        check_dependencies([QEMU, QEMU_IMG])
+        instances = run_many(args.image, args.count, args.jobs, args.log_dir,
+                             args.overlay, machine=machine, drive=drive)
+        if any(instance.returncode for instance in instances):
+            sys.exit("ERROR: not all instances exited cleanly.")
+    elif args.action == "build-kernel":
+        check_dependencies([PATCH, MAKE])
+        # These we don't run directly but are run through make in the kernel
+        # build.
+        check_dependencies(["bc", "gcc", "arm-linux-gnueabihf-gcc"])
+        if args.ccache:
+            check_dependencies([CCACHE])
+        check_kernel_source(args.source)
+        try:
+            cache = None
+            if args.cache is not None:
+                cache = KernelCache(args.cache, args.cache_size)
+            timings = build_kernel(args.source, cache, args.jobs,
+                                   args.incremental, args.ccache,
+                                   args.profile or "compat", machine)
+        except subprocess.CalledProcessError as e:
+            print("ERROR: build-kernel failed", file=sys.stderr)
+            print(e.stderr.decode(), file=sys.stderr)
+            sys.exit("Aborting.")
+        for stage, seconds in timings.items():
+            print("%-20s %8.1fs" % (stage, seconds))
+        print("%s is %d bytes" % (machine.kernel, os.path.getsize(machine.kernel)))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -35,7 +35,6 @@ import contextlib
 from ctypes import LittleEndianStructure, c_ubyte, c_uint, sizeof
 import gzip
 import hashlib
-import importlib.machinery
 import io
 import os
 import socket
@@ -49,14 +48,15 @@ TOOL = "../raspbian-qemu"
 # Prevent next imports from creating __pycache__ directory
 sys.dont_write_bytecode = True
 
-# import the tool so we can access it directly as a module for some unit tests.
-raspiqemu = importlib.machinery.SourceFileLoader('raspiqemu', TOOL).load_module()
+# import the tool's module so we can access it directly for some unit tests.
+sys.path.insert(0, os.path.dirname(TOOL))
+import raspbian_qemu as raspiqemu
 
 def read_mbr(image):
     """Read an MBR with ctypes and return it.  Not for general use.  Works
     with the MBRs in the Raspbian images we test, not tested with anything
-    else.  Mostly used as a fun second opinion to parted which is used in
-    the tool under testing.
+    else.  Mostly used as a fun second opinion to read_partitions() which
+    is used in the tool under testing.
     """
     class Partition(LittleEndianStructure):
         """https://en.wikipedia.org/wiki/Master_boot_record#Partition_table_entries"""
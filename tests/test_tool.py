@@ -26,16 +26,22 @@
 """
 
 import contextlib
+import fnmatch
+import gzip
+import json
+import lzma
 import os
 import subprocess
 import sys
 import tarfile
 import tempfile
+import time
 import unittest
+import zipfile
 
 # Prevent next imports from creating __pycache__ directory
 sys.dont_write_bytecode = True
-from test_common import TestImageBase, read_mbr, raspiqemu
+from test_common import TestImageBase, read_mbr, raspiqemu, TOOL
 import xwrappers
 
 OTHERIMG  = "other.img"
@@ -88,6 +94,19 @@ class TestPrep(TestImageBase):
         self.callTool(["--keep-root", "prep", self.TESTIMG])
         self.assertPrepped(self.TESTIMG)
 
+    def test_simple_prep_in_place(self):
+        """Simple prep with --in-place."""
+        self.callTool(["--in-place", "prep", self.TESTIMG])
+        self.assertPrepped(self.TESTIMG)
+
+    def test_grow_root_in_place(self):
+        """Prep with growing root and --in-place."""
+        root_before = read_mbr(self.TESTIMG).partitions[1].size
+        self.callTool(["--in-place", "prep", "--grow-root=1M", self.TESTIMG])
+        root_after = read_mbr(self.TESTIMG).partitions[1].size
+        self.assertEqual(root_after, root_before + 1024**2)
+        self.assertPrepped(self.TESTIMG)
+
     def test_prep_missing_source(self):
         """Prep with missing source file."""
         with self.assertRaises(subprocess.CalledProcessError):
@@ -99,6 +118,62 @@ class TestPrep(TestImageBase):
         self.callTool(["prep", self.TESTIMG])
         self.assertPrepped(self.TESTIMG)
 
+    def test_prep_many(self):
+        """Prep several images at once, from arguments and a manifest."""
+        manifest_dest = "manifest.img"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest = os.path.join(tmpdir, "manifest")
+            with open(manifest, "w") as manifestfile:
+                manifestfile.write("# Comments are ignored.\n")
+                manifestfile.write("%s %s\n" % (self.TESTIMG, manifest_dest))
+            try:
+                self.callTool(["prep-many", self.TESTIMG + "=" + OTHERIMG,
+                               "--manifest", manifest, "--log-dir", tmpdir])
+                self.assertEqual(len(fnmatch.filter(os.listdir(tmpdir), "*.log")), 2)
+                self.assertPrepped(OTHERIMG)
+                self.assertPrepped(manifest_dest)
+                self.assertUnPrepped(self.TESTIMG)
+            finally:
+                for image in (OTHERIMG, manifest_dest):
+                    if os.path.exists(image):
+                        os.unlink(image)
+
+    def test_prep_compressed(self):
+        """Prep straight from a compressed image."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            archives = {"gz": "test.img.gz",
+                        "xz": os.path.join(tmpdir, "test.img.xz"),
+                        "zip": os.path.join(tmpdir, "test.zip")}
+            with open(self.TESTIMG, "rb") as image, \
+                 lzma.open(archives["xz"], "wb") as compressed:
+                compressed.write(image.read())
+            with zipfile.ZipFile(archives["zip"], "w") as archive:
+                archive.write(self.TESTIMG)
+            for kind, archive in archives.items():
+                with self.subTest(kind=kind):
+                    self.callTool(["prep", archive, OTHERIMG])
+                    try:
+                        self.assertPrepped(OTHERIMG)
+                        self.assertOnlyUserReadable(OTHERIMG)
+                    finally:
+                        os.unlink(OTHERIMG)
+
+    def test_prep_compressed_exists(self):
+        """Prep from a compressed image won't overwrite an image it wasn't
+        given as the destination."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            archive = os.path.join(tmpdir, "test.img.xz")
+            existing = os.path.join(tmpdir, "test.img")
+            with open(self.TESTIMG, "rb") as image, \
+                 lzma.open(archive, "wb") as compressed:
+                compressed.write(image.read())
+            with open(existing, "wb") as image:
+                image.write(b"EXISTING")
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.callTool(["prep", archive])
+            with open(existing, "rb") as image:
+                self.assertEqual(image.read(), b"EXISTING")
+
     def test_prep_to_dest(self):
         """Prep to a different dest file."""
         with self.assertImageNotAltered(self.TESTIMG):
@@ -107,11 +182,81 @@ class TestPrep(TestImageBase):
             self.assertOnlyUserReadable(OTHERIMG)
             os.unlink(OTHERIMG)
 
+    def test_prep_compact(self):
+        """Prep with --compact, then compact again, leaving less allocated."""
+        self.callTool(["prep", "--compact", self.TESTIMG, OTHERIMG])
+        try:
+            self.assertPrepped(OTHERIMG)
+            self.assertLess(os.stat(OTHERIMG).st_blocks * 512,
+                            os.path.getsize(OTHERIMG))
+            self.callTool(["compact", OTHERIMG])
+            self.assertPrepped(OTHERIMG)
+        finally:
+            os.unlink(OTHERIMG)
+
+    def test_prep_cache(self):
+        """Prep twice with --cache, the second prep coming from the cache."""
+        with tempfile.TemporaryDirectory() as cachedir:
+            with self.assertImageNotAltered(self.TESTIMG):
+                for attempt in range(2):
+                    self.callTool(["prep", "--cache=" + cachedir,
+                                   "--set-host-keys=" + self.HOSTKEYSTAR,
+                                   self.TESTIMG, OTHERIMG])
+                    self.assertEqual(len(os.listdir(cachedir)), 1)
+            cached, = os.listdir(cachedir)
+            with open(os.path.join(cachedir, cached), "rb") as cachedfile, \
+                 open(OTHERIMG, "rb") as otherfile:
+                self.assertEqual(cachedfile.read(), otherfile.read())
+        self.assertPrepped(OTHERIMG)
+        os.unlink(OTHERIMG)
+
+    def test_prep_cache_compact(self):
+        """--compact is part of the cache key, so a cached uncompacted prep
+        isn't handed out for a prep with --compact."""
+        with tempfile.TemporaryDirectory() as cachedir:
+            try:
+                self.callTool(["prep", "--cache=" + cachedir,
+                               self.TESTIMG, OTHERIMG])
+                allocated = os.stat(OTHERIMG).st_blocks
+                for attempt in range(2):
+                    self.callTool(["prep", "--cache=" + cachedir, "--compact",
+                                   self.TESTIMG, OTHERIMG])
+                    self.assertEqual(len(os.listdir(cachedir)), 2)
+                    self.assertLess(os.stat(OTHERIMG).st_blocks, allocated)
+            finally:
+                if os.path.exists(OTHERIMG):
+                    os.unlink(OTHERIMG)
+
     def test_simple_unprep(self):
         """Simple unprep."""
         self.callTool(["unprep", self.TESTIMG])
         self.assertUnPrepped(self.TESTIMG)
 
+    def test_unprep_in_place_to_dest(self):
+        """Unprep to a different dest file with --in-place."""
+        with self.assertImageNotAltered(self.TESTIMG):
+            self.callTool(["--in-place", "unprep", self.TESTIMG, OTHERIMG])
+            self.assertUnPrepped(OTHERIMG)
+            self.assertOnlyUserReadable(OTHERIMG)
+            os.unlink(OTHERIMG)
+
+    def test_unprep_compress(self):
+        """Unprep to a compressed dest file, with an index."""
+        self.callTool(["unprep", "--compress=gz", "--compress-index",
+                       self.TESTIMG, OTHERIMG])
+        self.assertFalse(os.path.exists(OTHERIMG))
+        try:
+            with gzip.open(OTHERIMG + ".gz") as compressed, \
+                 open(OTHERIMG, "wb") as image:
+                image.write(compressed.read())
+            self.assertUnPrepped(OTHERIMG)
+            with open(OTHERIMG + ".gz.index") as index:
+                self.assertEqual(json.load(index)["compression"], "gz")
+        finally:
+            for filename in (OTHERIMG, OTHERIMG + ".gz", OTHERIMG + ".gz.index"):
+                if os.path.exists(filename):
+                    os.unlink(filename)
+
     def test_simple_unprep_keep_root(self):
         """Simple unprep. with --keep-root"""
         self.callTool(["--keep-root", "unprep", self.TESTIMG])
@@ -140,6 +285,21 @@ class TestPrep(TestImageBase):
         # Make sure that as well as growing the root, it was prepped too.
         self.assertPrepped(self.TESTIMG)
 
+    def test_shrink(self):
+        """Shrink a grown root back down, to a dest file and in place."""
+        self.callTool(["prep", "--grow-root=4M", self.TESTIMG])
+        grown = os.path.getsize(self.TESTIMG)
+        for options, image in (([], OTHERIMG), (["--in-place"], None)):
+            with self.subTest(options=options):
+                self.callTool(options + ["shrink", "--headroom=64K", self.TESTIMG]
+                              + ([image] if image else []))
+                image = image or self.TESTIMG
+                root = read_mbr(image).partitions[1]
+                self.assertLess(os.path.getsize(image), grown - 3 * 1024**2)
+                self.assertEqual(root.begin + root.size, os.path.getsize(image))
+                self.assertPrepped(image)
+        os.unlink(OTHERIMG)
+
     def prep_with_public_key(self, pubkey):
         """prep an image adding a public key with the contents of pubkey."""
         with tempfile.NamedTemporaryFile() as keyfile:
@@ -343,6 +503,67 @@ class TestRun(TestImageBase):
         """run --with-ssh-port."""
         self.runImage(self.TESTIMG, growmode=self.MAGIC_GROW_MODE_SSH)
 
+    def test_overlay(self):
+        """run --overlay leaves the image alone."""
+        with self.assertImageNotAltered(self.TESTIMG):
+            self.runImage(self.TESTIMG, options=["--overlay"])
+
+    def test_discard(self):
+        """run --discard leaves the image alone, with any disk cache mode."""
+        with self.assertImageNotAltered(self.TESTIMG):
+            self.runImage(self.TESTIMG, options=["--discard", "--disk-cache", "unsafe"])
+
+    def test_timeline(self):
+        """run --timeline records the console and boot milestones."""
+        with tempfile.NamedTemporaryFile() as timeline:
+            info = self.runImage(self.TESTIMG,
+                                 options=["--timeline", timeline.name,
+                                          "--milestone", "version=" + self.MAGIC_VERSION])
+            recorded = json.load(timeline)
+        self.assertEqual(recorded["returncode"], 0)
+        milestones = recorded["milestones"]
+        self.assertLessEqual(milestones["kernel"], milestones["version"])
+        self.assertLessEqual(milestones["version"], recorded["duration"])
+        console = "\n".join(line for when, line in recorded["lines"])
+        self.assertIn(info.version, console)
+
+    def test_snapshot(self):
+        """snapshot saves a booted image that run --from-snapshot resumes,
+        and is taken again once the image changes."""
+        self.callTool(["prep", self.TESTIMG,
+                       "--grow-root", str(self.MAGIC_GROW_MODE_SLEEP * 512)])
+        snapshot = raspiqemu.snapshot_path(self.TESTIMG)
+        try:
+            with self.assertImageNotAltered(self.TESTIMG):
+                self.callTool(["snapshot", self.TESTIMG,
+                               "--ready", self.MAGIC_VERSION, "--timeout", "600"])
+                self.assertTrue(raspiqemu.snapshot_valid(self.TESTIMG, snapshot))
+
+                # The resumed image sleeps forever, so quit from the monitor.
+                run = subprocess.run([TOOL, "--script", "run", self.TESTIMG,
+                                      "--from-snapshot"],
+                                     input=b"\x01cquit\n",
+                                     stdout=subprocess.DEVNULL, timeout=60)
+                self.assertEqual(run.returncode, 0)
+
+            os.utime(self.TESTIMG)
+            self.assertFalse(raspiqemu.snapshot_valid(self.TESTIMG, snapshot))
+        finally:
+            if os.path.exists(snapshot):
+                os.unlink(snapshot)
+
+    def test_run_many(self):
+        """run-many boots each instance and logs its console separately."""
+        with tempfile.TemporaryDirectory() as log_dir:
+            with self.assertImageNotAltered(self.TESTIMG):
+                self.callTool(["run-many", self.TESTIMG, "3",
+                               "--jobs", "2", "--log-dir", log_dir])
+            logs = sorted(os.listdir(log_dir))
+            self.assertEqual(len(logs), 3)
+            for log in logs:
+                with open(os.path.join(log_dir, log), errors="replace") as f:
+                    self.assertIn(self.MAGIC_VERSION, f.read())
+
     @unittest.skipUnless(xwrappers.have_xvfb(), "requires Xvfb")
     @unittest.skipUnless(xwrappers.have_xtrace(), "requires xtrace")
     def test_with_display(self):
@@ -365,5 +586,35 @@ class TestRun(TestImageBase):
         machine boots."""
         self.runImage(self.TESTIMG, options=["--with-audio"])
 
+class TestStartup(unittest.TestCase):
+    """Check that starting the tool stays quick."""
+    LAZY_MODULES = ("ctypes", "hashlib", "json", "mmap", "socket", "tarfile",
+                    "urllib.request")
+    # A generous bound on run --help, in seconds, to catch start up
+    # growing heavy again without failing on a slow or busy machine.
+    START_UP_LIMIT = 1.0
+
+    def test_lazy_imports(self):
+        """run --help doesn't import modules only some actions use."""
+        output = subprocess.run([sys.executable, "-X", "importtime",
+                                 TOOL, "run", "--help"],
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True,
+                                check=True).stderr
+        imported = [line.rpartition("|")[2].strip() for line in output.splitlines()]
+        for module in self.LAZY_MODULES:
+            self.assertNotIn(module, imported)
+
+    def test_start_up_time(self):
+        """run --help takes less than START_UP_LIMIT at best."""
+        def start():
+            """Return how long run --help took."""
+            started = time.perf_counter()
+            subprocess.run([TOOL, "run", "--help"], stdout=subprocess.DEVNULL,
+                           check=True)
+            return time.perf_counter() - started
+        self.assertLess(min(start() for attempt in range(3)), self.START_UP_LIMIT)
+
 if __name__ == "__main__":
     unittest.main(failfast=True)
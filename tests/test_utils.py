@@ -26,14 +26,22 @@
                  raspbian-qemu.
 """
 
+import contextlib
+import gzip
+import io
+import json
+import lzma
 import os
+import struct
+import subprocess
 import sys
 import tempfile
 import unittest
+import zlib
 
 # Prevent next imports from creating __pycache__ directory
 sys.dont_write_bytecode = True
-from test_common import raspiqemu
+from test_common import TestImageBase, read_mbr, raspiqemu
 
 class TestDataCopy(unittest.TestCase):
     """Unit test data_copy() and related functions."""
@@ -95,6 +103,81 @@ class TestDataCopy(unittest.TestCase):
         raspiqemu.data_copy(self.source, self.dest, count=5)
         self.assertEqual(self.dest_contents, self.SOURCE[:5])
 
+    def test_sparse_copy(self):
+        """File copy keeps holes in the source as holes in the dest."""
+        MIB = 1024**2
+        with open(self.source, "wb") as sourcefile:
+            sourcefile.truncate(16 * MIB)
+            sourcefile.seek(8 * MIB)
+            sourcefile.write(self.SOURCE.encode())
+        os.unlink(self.dest)
+
+        raspiqemu.data_copy(self.source, self.dest)
+        with open(self.source, "rb") as sourcefile, \
+             open(self.dest, "rb") as destfile:
+            self.assertEqual(destfile.read(), sourcefile.read())
+        self.assertLess(os.stat(self.dest).st_blocks * 512, MIB)
+
+    def test_sparse_copy_over_data(self):
+        """File copy of a hole over existing data zeros out that data."""
+        with open(self.source, "wb") as sourcefile:
+            sourcefile.truncate(len(self.SOURCE))
+        raspiqemu.data_copy(self.source, self.dest, dest_offset=2)
+        self.assertEqual(self.dest_contents,
+                         self.DEST[:2] + "\0" * len(self.SOURCE))
+
+    def test_decompress_sparse(self):
+        """Runs of zeros in a compressed image are left as holes."""
+        image = os.path.join(self.tmpdir.name, "image.gz")
+        with gzip.open(image, "wb") as compressed:
+            compressed.write(b"DATA" + bytes(8 * 1024**2) + b"DATA")
+        dest = os.path.join(self.tmpdir.name, "image")
+        raspiqemu.decompress(image, dest)
+        with open(dest, "rb") as destfile:
+            self.assertEqual(destfile.read(), b"DATA" + bytes(8 * 1024**2) + b"DATA")
+        self.assertLess(os.stat(dest).st_blocks * 512, 1024**2)
+
+    def test_compress_image(self):
+        """Chunked compression decompresses whole and chunk by chunk."""
+        image = os.path.join(self.tmpdir.name, "image")
+        contents = b"DATA" + bytes(3 * 1024**2) + os.urandom(1024**2) + b"DATA"
+        with open(image, "wb") as imagefile:
+            imagefile.write(contents)
+        index = image + ".index"
+        for compression, decompress in (("gz", gzip.decompress),
+                                        ("xz", lzma.decompress)):
+            with self.subTest(compression=compression):
+                dest = image + raspiqemu.COMPRESSIONS[compression]
+                raspiqemu.compress_image(image, dest, compression, jobs=2,
+                                         index=index, chunk_size=1024**2)
+                with open(dest, "rb") as destfile:
+                    compressed = destfile.read()
+                self.assertEqual(decompress(compressed), contents)
+                with open(index) as indexfile:
+                    chunks = json.load(indexfile)["chunks"]
+                self.assertEqual(len(chunks), 5)
+                for offset, compressed_offset, length in chunks:
+                    self.assertEqual(decompress(compressed[compressed_offset:
+                                                           compressed_offset + length]),
+                                     contents[offset:offset + 1024**2])
+
+    def test_copy_strategies(self):
+        """File copies with offsets work the same with every strategy."""
+        saved_strategies = raspiqemu.COPY_STRATEGIES
+        try:
+            for index, strategy in enumerate(saved_strategies):
+                with self.subTest(strategy=strategy):
+                    raspiqemu.COPY_STRATEGIES = saved_strategies[index:]
+                    with open(self.dest, "w") as destfile:
+                        destfile.write(self.DEST)
+                    used = raspiqemu.data_copy(self.source, self.dest,
+                                               source_offset=2, dest_offset=3)
+                    self.assertIn(used, raspiqemu.COPY_STRATEGIES)
+                    self.assertEqual(self.dest_contents,
+                                     self.DEST[:3] + self.SOURCE[2:])
+        finally:
+            raspiqemu.COPY_STRATEGIES = saved_strategies
+
     def test_suffixes(self):
         """Suffix conversion."""
         counts = ((5, "5"),
@@ -110,5 +193,958 @@ class TestDataCopy(unittest.TestCase):
             for case in (sizestr.upper(), sizestr.lower()):
                 self.assertEqual(raspiqemu.resolve_suffix(case), sizeint)
 
+class TestDelta(unittest.TestCase):
+    """Unit test diff_images() and patch_image()."""
+    BLOCK = 64 * 1024
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.base = os.path.join(self.tmpdir.name, "base")
+        self.target = os.path.join(self.tmpdir.name, "target")
+        self.delta = os.path.join(self.tmpdir.name, "delta")
+        self.base_contents = os.urandom(8 * self.BLOCK)
+        with open(self.base, "wb") as base:
+            base.write(self.base_contents)
+            base.truncate(16 * self.BLOCK)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_target(self, contents, size):
+        """Write contents to the target image, padded to size with a hole."""
+        with open(self.target, "wb") as target:
+            target.write(contents)
+            target.truncate(size)
+
+    def read(self, image):
+        """Return the contents of image."""
+        with open(image, "rb") as imagefile:
+            return imagefile.read()
+
+    def test_round_trip(self):
+        """Changed, zeroed, grown and shrunk images patch back exactly."""
+        changed = bytearray(self.base_contents)
+        changed[self.BLOCK + 5:self.BLOCK + 10] = b"12345"
+        changed[3 * self.BLOCK:5 * self.BLOCK] = bytes(2 * self.BLOCK)
+        for size in (16 * self.BLOCK, 20 * self.BLOCK + 100, 6 * self.BLOCK):
+            with self.subTest(size=size):
+                self.write_target(changed[:size], size)
+                recorded = raspiqemu.diff_images(self.base, self.target, self.delta)
+                self.assertLess(recorded, 4 * self.BLOCK)
+                dest = os.path.join(self.tmpdir.name, "dest")
+                raspiqemu.patch_image(self.base, self.delta, dest)
+                self.assertEqual(self.read(dest), self.read(self.target))
+                # The zeroed blocks and the hole are left as holes.
+                self.assertLess(os.stat(dest).st_blocks * 512, 7 * self.BLOCK)
+
+    def test_in_place(self):
+        """Patch the base image itself."""
+        self.write_target(b"new" + self.base_contents[3:], 16 * self.BLOCK)
+        raspiqemu.diff_images(self.base, self.target, self.delta)
+        raspiqemu.patch_image(self.base, self.delta)
+        self.assertEqual(self.read(self.base), self.read(self.target))
+
+    def test_wrong_base(self):
+        """Refuse to patch an image the delta wasn't made from."""
+        self.write_target(b"new" + self.base_contents[3:], 16 * self.BLOCK)
+        raspiqemu.diff_images(self.base, self.target, self.delta)
+        with self.assertRaises(ValueError):
+            raspiqemu.patch_image(self.target, self.delta)
+
+    def test_corrupt_delta(self):
+        """A corrupt delta is refused before the image is touched."""
+        self.write_target(bytes(self.BLOCK) + os.urandom(self.BLOCK),
+                          16 * self.BLOCK)
+        raspiqemu.diff_images(self.base, self.target, self.delta)
+        with open(self.delta, "r+b") as delta:
+            delta.seek(-100, os.SEEK_END)
+            delta.write(b"corrupt")
+        with self.assertRaises(ValueError):
+            raspiqemu.patch_image(self.base, self.delta)
+        self.assertEqual(self.read(self.base)[:len(self.base_contents)],
+                         self.base_contents)
+
+    def test_out_of_range(self):
+        """A delta writing outside its target is refused before the image
+        is touched."""
+        self.write_target(b"new" + self.base_contents[3:], 16 * self.BLOCK)
+        raspiqemu.diff_images(self.base, self.target, self.delta)
+        with open(self.delta, "r+b") as delta:
+            delta.seek(raspiqemu.DELTA_HEADER.size)
+            delta.write(struct.pack("<Q", 100 * self.BLOCK))
+        with self.assertRaises(ValueError):
+            raspiqemu.patch_image(self.base, self.delta)
+        self.assertEqual(self.read(self.base)[:len(self.base_contents)],
+                         self.base_contents)
+
+class TestImageCache(unittest.TestCase):
+    """Unit test ImageCache and image_digest()."""
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = raspiqemu.ImageCache(os.path.join(self.tmpdir.name, "cache"),
+                                          "12K")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_image(self, name, contents):
+        """Make a file name in the temporary directory with contents."""
+        filespec = os.path.join(self.tmpdir.name, name)
+        with open(filespec, "wb") as image:
+            image.write(contents)
+        return filespec
+
+    def test_fetch_store(self):
+        """Fetch misses until the image is stored, then copies it."""
+        image = self.make_image("image", b"PREPPED")
+        dest = os.path.join(self.tmpdir.name, "dest")
+        self.assertFalse(self.cache.fetch("key", dest))
+        self.cache.store("key", image)
+        self.assertTrue(self.cache.fetch("key", dest))
+        with open(dest, "rb") as destfile:
+            self.assertEqual(destfile.read(), b"PREPPED")
+
+    def test_evict(self):
+        """The least recently used images are evicted over max_size."""
+        for key in ("one", "two", "three", "four"):
+            self.cache.store(key, self.make_image(key, key.encode() * 1024))
+            if key == "two":
+                os.utime(self.cache.filespec("one"), (0, 0))
+                os.utime(self.cache.filespec("two"), (1, 1))
+        self.assertFalse(os.path.exists(self.cache.filespec("one")))
+        self.assertTrue(os.path.exists(self.cache.filespec("four")))
+
+    def test_kernel_cache_separate(self):
+        """A KernelCache sharing a directory leaves images alone."""
+        self.cache.store("image", self.make_image("image", b"IMAGE" * 1024))
+        kernels = raspiqemu.KernelCache(self.cache.path, 0)
+        kernels.store("kernel", self.make_image("kernel", b"KERNEL"))
+        self.assertFalse(os.path.exists(kernels.filespec("kernel")))
+        self.assertTrue(os.path.exists(self.cache.filespec("image")))
+
+    def test_digest_ignores_sparseness(self):
+        """The same contents digest the same, sparse or not."""
+        dense = self.make_image("dense", bytes(8 * 1024**2) + b"DATA")
+        sparse = os.path.join(self.tmpdir.name, "sparse")
+        raspiqemu.data_copy(dense, sparse)
+        other = self.make_image("other", bytes(8 * 1024**2) + b"DATB")
+        self.assertEqual(raspiqemu.image_digest(dense),
+                         raspiqemu.image_digest(sparse))
+        self.assertNotEqual(raspiqemu.image_digest(dense),
+                            raspiqemu.image_digest(other))
+
+class TestKernelCacheKey(unittest.TestCase):
+    """Unit test kernel_cache_key() against a git checkout."""
+    ARM_PATCH = b"--- a/arch/arm/Kconfig\n+++ b/arch/arm/Kconfig\n"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.linux = self.tmpdir.name
+        self.write("Makefile", "all:\n")
+        self.write("arch/arm/Kconfig", "config ARM\n")
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git("-c", "user.name=test", "-c", "user.email=test@example.com",
+                 "commit", "-q", "-m", "linux")
+        self.saved_tool_version = raspiqemu.tool_version
+        raspiqemu.tool_version = lambda tool: "gcc 1.0"
+
+    def tearDown(self):
+        raspiqemu.tool_version = self.saved_tool_version
+        self.tmpdir.cleanup()
+
+    def git(self, *args):
+        """Run git in the checkout."""
+        subprocess.check_call(["git", "-C", self.linux] + list(args))
+
+    def write(self, name, contents):
+        """Write contents to the file name in the checkout."""
+        path = os.path.join(self.linux, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(contents)
+
+    def key(self):
+        """Return the checkout's key."""
+        return raspiqemu.kernel_cache_key(self.linux, self.ARM_PATCH)
+
+    def test_uncommitted_changes(self):
+        """Edited and new files change the key, patching and the cached
+        patch don't."""
+        clean = self.key()
+        self.assertIsNotNone(clean)
+        self.write("arch/arm/Kconfig", "config ARM\nconfig QEMU\n")
+        self.write(raspiqemu.ARM_PATCH_FILE, self.ARM_PATCH.decode())
+        self.assertEqual(self.key(), clean)
+
+        self.write("Makefile", "all: vmlinux\n")
+        edited = self.key()
+        self.assertNotEqual(edited, clean)
+        self.write("Makefile", "all:\n")
+        self.assertEqual(self.key(), clean)
+
+        self.write("drivers/new.c", "int x;\n")
+        added = self.key()
+        self.assertNotIn(added, (clean, edited))
+        self.write("drivers/new.c", "int y;\n")
+        self.assertNotEqual(self.key(), added)
+
+    def test_not_git(self):
+        """Without a git checkout there's no key."""
+        with tempfile.TemporaryDirectory() as linux:
+            self.assertIsNone(raspiqemu.kernel_cache_key(linux, self.ARM_PATCH))
+
+class TestChunkStore(unittest.TestCase):
+    """Unit test ChunkStore."""
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = raspiqemu.ChunkStore(os.path.join(self.tmpdir.name, "store"))
+        self.base = os.path.join(self.tmpdir.name, "base.img")
+        self.base_contents = os.urandom(1024**2) + bytes(1024**2) + os.urandom(1024**2)
+        with open(self.base, "wb") as base:
+            base.write(self.base_contents)
+            base.truncate(8 * 1024**2)
+        self.variant = os.path.join(self.tmpdir.name, "variant.img")
+        with open(self.variant, "wb") as variant:
+            variant.write(self.base_contents)
+            variant.seek(1024**2 + 4096)
+            variant.write(b"changed")
+            variant.truncate(8 * 1024**2)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, image):
+        """Return the contents of image."""
+        with open(image, "rb") as imagefile:
+            return imagefile.read()
+
+    def test_dedup_rebuild(self):
+        """A variant shares the base's chunks and both rebuild exactly."""
+        data_size, stored = self.store.add(self.base)
+        self.assertEqual(data_size, 2 * 1024**2)
+        data_size, stored = self.store.add(self.variant)
+        self.assertLess(stored, 64 * 1024)
+        self.assertEqual(self.store.images(), ["base.img", "variant.img"])
+
+        dest = os.path.join(self.tmpdir.name, "dest")
+        for image in (self.base, self.variant):
+            with self.subTest(image=image):
+                self.store.rebuild(os.path.basename(image), dest)
+                self.assertEqual(self.read(dest), self.read(image))
+                self.assertLess(os.stat(dest).st_blocks * 512, 3 * 1024**2)
+
+    def test_gc(self):
+        """Only chunks of removed images are collected."""
+        self.store.add(self.base)
+        self.store.add(self.variant, "variant")
+        self.assertEqual(self.store.gc(), (0, 0))
+        self.store.remove("variant")
+        deleted, freed = self.store.gc()
+        self.assertGreater(deleted, 0)
+        dest = os.path.join(self.tmpdir.name, "dest")
+        self.store.rebuild("base.img", dest)
+        self.assertEqual(self.read(dest), self.read(self.base))
+        with self.assertRaises(ValueError):
+            self.store.rebuild("variant", dest)
+
+    def test_corrupt_chunk(self):
+        """Rebuilding from a corrupt chunk fails."""
+        self.store.add(self.base)
+        offset, length, digest = self.store.manifest("base.img")["chunks"][0]
+        with open(self.store.chunk_filespec(digest), "wb") as chunk:
+            chunk.write(b"corrupt")
+        with self.assertRaises(ValueError):
+            self.store.rebuild("base.img", os.path.join(self.tmpdir.name, "dest"))
+
+class TestPrepMany(unittest.TestCase):
+    """Unit test prep_many()'s handling of failed preps."""
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved_prep = raspiqemu.prep
+
+    def tearDown(self):
+        raspiqemu.prep = self.saved_prep
+        self.tmpdir.cleanup()
+
+    def test_failures_reported(self):
+        """A prep that raises and a worker that dies are both failed preps."""
+        def prep(image, dest, **options):
+            if image == "crash.img":
+                os._exit(1)
+            raise ValueError("bad image")
+        raspiqemu.prep = prep
+        reports = []
+        jobs = raspiqemu.prep_many([("bad.img", None), ("crash.img", None)],
+                                   1, 1, self.tmpdir.name, reports.append)
+        self.assertEqual([job.image for job in jobs], ["bad.img", "crash.img"])
+        self.assertIn("bad image", jobs[0].error)
+        self.assertIsNotNone(jobs[1].error)
+        self.assertEqual(len(reports), 2)
+
+class TestRunImage(unittest.TestCase):
+    """Unit test run_image() with an overlay, with the emulator stubbed out."""
+    def setUp(self):
+        self.saved = (raspiqemu.run, raspiqemu.emulator_args)
+        self.commands = []
+        def run(cmd, input=None):
+            self.commands.append(cmd[:2])
+        run.debug = False
+        raspiqemu.run = run
+
+    def tearDown(self):
+        raspiqemu.run, raspiqemu.emulator_args = self.saved
+
+    def run_image(self, returncode):
+        """Run with an emulator that exits with returncode, committing the
+        overlay, and return the qemu-img commands run."""
+        raspiqemu.emulator_args = lambda *args, **kwargs: \
+            [sys.executable, "-c", "raise SystemExit(%d)" % (returncode,)]
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(raspiqemu.run_image("test.img", False, False, None,
+                                                 lambda: None, overlay=tempfile.gettempdir(),
+                                                 commit_overlay=True),
+                             returncode)
+        return [command for tool, command in self.commands]
+
+    def test_commit_overlay(self):
+        """The overlay is only committed after a clean exit."""
+        self.assertEqual(self.run_image(0), ["create", "commit"])
+        self.commands = []
+        self.assertEqual(self.run_image(1), ["create"])
+
+class TestRunMany(unittest.TestCase):
+    """Unit test run_many()'s handling of each instance's overlay."""
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved = (raspiqemu.run, raspiqemu.emulator_args)
+
+    def tearDown(self):
+        raspiqemu.run, raspiqemu.emulator_args = self.saved
+        self.tmpdir.cleanup()
+
+    def test_overlay_removed_on_exit(self):
+        """An instance's overlay goes as soon as it exits, not with the fleet."""
+        overlays = []
+        def emulator_args(image, display, ssh_port, **options):
+            overlays.append(os.path.dirname(image))
+            seconds = 0 if len(overlays) == 1 else 1
+            return [sys.executable, "-c", "import time; time.sleep(%d)" % (seconds,)]
+        raspiqemu.run = lambda args, **kwargs: None
+        raspiqemu.emulator_args = emulator_args
+
+        present = {}
+        def report(message):
+            if message.startswith("instance 1: exited"):
+                present.update(first=os.path.isdir(overlays[0]),
+                               second=os.path.isdir(overlays[1]))
+        instances = raspiqemu.run_many("test.img", 2, 2, self.tmpdir.name,
+                                       overlay=self.tmpdir.name, reportfunc=report)
+        self.assertEqual([instance.returncode for instance in instances], [0, 0])
+        self.assertEqual(present, {"first": False, "second": True})
+        self.assertFalse(any(os.path.isdir(overlay) for overlay in overlays))
+
+class TestSnapshot(unittest.TestCase):
+    """Unit test snapshot() with a script standing in for the emulator."""
+    # Prompts for a login, then answers each monitor command with a prompt
+    # until it's told to quit.
+    EMULATOR = ("import os, sys\n"
+                "sys.stdout.buffer.write(b'login: '); sys.stdout.flush()\n"
+                "while b'quit' not in os.read(0, 4096):\n"
+                "    sys.stdout.buffer.write(b'(qemu) '); sys.stdout.flush()\n"
+                "raise SystemExit(%d)\n")
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved = (raspiqemu.run, raspiqemu.emulator_args, raspiqemu.snapshot_tag)
+        def run(cmd, input=None):
+            open(cmd[-1], "wb").close()
+        run.debug = False
+        raspiqemu.run = run
+        raspiqemu.snapshot_tag = lambda image, machine: "tag"
+
+    def tearDown(self):
+        raspiqemu.run, raspiqemu.emulator_args, raspiqemu.snapshot_tag = self.saved
+        self.tmpdir.cleanup()
+
+    def snapshot(self, returncode):
+        """Snapshot with an emulator that exits with returncode and return
+        the snapshot's path."""
+        raspiqemu.emulator_args = lambda *args, **kwargs: \
+            [sys.executable, "-c", self.EMULATOR % (returncode,)]
+        path = os.path.join(self.tmpdir.name, "test.snapshot.qcow2")
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with contextlib.redirect_stdout(stdout):
+            raspiqemu.snapshot("test.img", path, "login: ")
+        return path
+
+    def test_snapshot(self):
+        """The snapshot is only kept if the emulator exits cleanly."""
+        self.assertTrue(os.path.isfile(self.snapshot(0)))
+        os.unlink(os.path.join(self.tmpdir.name, "test.snapshot.qcow2"))
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.snapshot(1)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+class TestRecordTimeline(unittest.TestCase):
+    """Unit test record_timeline() with a script standing in for the emulator."""
+    CONSOLE = ("import sys, time\n"
+               "write = sys.stdout.buffer.write\n"
+               "write(b'Booting Linux\\n' + b'x' * 200000)\n"
+               "sys.stdout.flush(); time.sleep(0.1)\n"
+               "write(b'\\nsshd[123]: Server listening\\n')\n"
+               "sys.stdout.flush(); time.sleep(0.1)\n"
+               "write(b'[  OK  ] Started OpenBSD Secure Shell server.\\n')\n"
+               "write(b'raspberrypi login: ')\n")
+
+    def test_milestones(self):
+        """Milestones are found in long and unfinished lines, and ssh only
+        when init says it started."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            timeline = os.path.join(tmpdir, "timeline.json")
+            stdout = io.TextIOWrapper(io.BytesIO())
+            with contextlib.redirect_stdout(stdout):
+                returncode = raspiqemu.record_timeline(
+                                 [sys.executable, "-c", self.CONSOLE], timeline)
+            self.assertEqual(returncode, 0)
+            with open(timeline) as f:
+                recorded = json.load(f)
+        lines = dict((line, when) for when, line in recorded["lines"])
+        self.assertEqual(recorded["lines"][1][1], "x" * 200000)
+        self.assertEqual(recorded["lines"][-1][1], "raspberrypi login: ")
+        self.assertEqual(sorted(recorded["milestones"]), ["getty", "kernel", "ssh"])
+        self.assertGreater(recorded["milestones"]["ssh"],
+                           lines["sshd[123]: Server listening"])
+
+class TestBuildKernel(unittest.TestCase):
+    """Unit test build_kernel()'s choice of make targets with make stubbed out."""
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.linux = os.path.join(self.tmpdir.name, "linux")
+        os.makedirs(os.path.join(self.linux, "arch/arm/boot"))
+        with open(os.path.join(self.linux, raspiqemu.ARM_PATCH_FILE), "wb") as patch:
+            patch.write(b"patch\n")
+        self.machine = raspiqemu.MACHINES["versatilepb"]._replace(
+                           kernel=os.path.join(self.tmpdir.name, "kernel"))
+        self.defconfig = "CONFIG_ONE=y\n"
+        self.makes = []
+        self.patches = []
+        self.saved_run = raspiqemu.run
+        def run(cmd, input=None):
+            if cmd[0] == raspiqemu.PATCH:
+                self.patches.append(input)
+            self.make(cmd)
+        run.debug = False
+        raspiqemu.run = run
+
+    def tearDown(self):
+        raspiqemu.run = self.saved_run
+        self.tmpdir.cleanup()
+
+    def make(self, cmd):
+        """Stand in for make, writing what each target would."""
+        if cmd[0] != raspiqemu.MAKE:
+            return
+        self.makes.append(cmd)
+        target = cmd[-1]
+        if target == self.machine.defconfig:
+            with open(".config", "w") as dotconfig:
+                dotconfig.write(self.defconfig)
+        elif target == "bzImage":
+            with open("arch/arm/boot/zImage", "wb") as zimage:
+                zimage.write(b"zImage")
+
+    def build(self, **options):
+        """Build the stub kernel, returning the make targets run."""
+        self.makes = []
+        raspiqemu.build_kernel(self.linux, machine=self.machine, **options)
+        return [args[-1] for args in self.makes]
+
+    def test_incremental(self):
+        """An unchanged .config keeps the build, a changed one cleans it."""
+        clean = ["distclean", "versatile_defconfig", "olddefconfig", "bzImage"]
+        self.assertEqual(self.build(incremental=True), clean)
+        self.assertEqual(self.build(incremental=True),
+                         ["versatile_defconfig", "olddefconfig", "bzImage"])
+        self.assertEqual(self.build(), clean)
+        self.defconfig = "CONFIG_TWO=y\n"
+        self.assertEqual(self.build(incremental=True),
+                         ["versatile_defconfig", "olddefconfig"] + clean)
+
+    def test_profile(self):
+        """The profile's settings are written into .config."""
+        self.build(profile="fastboot")
+        with open(os.path.join(self.linux, ".config")) as dotconfig:
+            lines = dotconfig.read().splitlines()
+        self.assertEqual(lines[0], "CONFIG_ONE=y")
+        self.assertEqual(lines[1:], raspiqemu.FASTBOOT_CONFIGS)
+        self.assertIn("# CONFIG_LOGO is not set", lines)
+        self.assertNotIn("CONFIG_LOGO=y", lines)
+
+    def test_patch(self):
+        """Only versatilepb kernels get the ARM1176 patch."""
+        self.build()
+        self.assertEqual(self.patches, [b"patch\n"])
+        self.patches = []
+        os.unlink(os.path.join(self.linux, raspiqemu.ARM_PATCH_FILE))
+        self.machine = raspiqemu.MACHINES["virt"]._replace(kernel=self.machine.kernel)
+        self.assertEqual(self.build(), ["distclean", "multi_v7_defconfig",
+                                        "olddefconfig", "bzImage"])
+        self.assertEqual(self.patches, [])
+
+    def test_ccache(self):
+        """Only the compiler is run through ccache."""
+        self.build(ccache=True)
+        cc = "CC=%s %s-gcc" % (raspiqemu.CCACHE, raspiqemu.TOOLCHAIN)
+        self.assertTrue(all(cc in args for args in self.makes))
+        self.build()
+        self.assertFalse(any(arg.startswith("CC=") for args in self.makes for arg in args))
+
+class TestTools(unittest.TestCase):
+    """Unit test find_tool() and tool_version()."""
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tool = os.path.join(self.tmpdir.name, "tool")
+        self.runs = os.path.join(self.tmpdir.name, "runs")
+        self.cache = os.path.join(self.tmpdir.name, "versions.json")
+        with open(self.tool, "w") as tool:
+            tool.write("#!/bin/sh\necho run >> %s\necho 'tool 1.0'\necho more\n"
+                       % (self.runs,))
+        os.chmod(self.tool, 0o755)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_run_debug_large_input(self):
+        """Debug output shows the size of large inputs rather than them."""
+        output = io.StringIO()
+        raspiqemu.run.debug = True
+        try:
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(raspiqemu.run(["cat"], input=b"x" * 65536),
+                                 b"x" * 65536)
+                raspiqemu.run(["cat"], input=b"small")
+        finally:
+            raspiqemu.run.debug = False
+        self.assertIn("<65536 bytes of input>", output.getvalue())
+        self.assertNotIn("xxxx", output.getvalue())
+        self.assertIn("b'small'", output.getvalue())
+
+    def test_find_tool(self):
+        """Tools on PATH are found as absolute paths, missing ones aren't."""
+        self.assertTrue(os.path.isabs(raspiqemu.find_tool("sh")))
+        self.assertIsNone(raspiqemu.find_tool("no-such-tool-anywhere"))
+
+    def test_version_cached(self):
+        """Versions are only probed again when the tool changes."""
+        for expected_runs in (1, 1):
+            self.assertEqual(raspiqemu.tool_version(self.tool, self.cache), "tool 1.0")
+            with open(self.runs) as runs:
+                self.assertEqual(len(runs.readlines()), expected_runs)
+        os.utime(self.tool, ns=(0, 0))
+        raspiqemu.tool_version(self.tool, self.cache)
+        with open(self.runs) as runs:
+            self.assertEqual(len(runs.readlines()), 2)
+
+class TestMachines(unittest.TestCase):
+    """Unit test emulator_args() for each machine and the options that pick one."""
+    def test_virt_args(self):
+        """virt runs on several CPUs with paravirtual disk and network."""
+        machine = raspiqemu.MACHINES["virt"]._replace(smp=2)
+        args = raspiqemu.emulator_args("test.img", False, 2222, machine=machine)
+        self.assertEqual(args[args.index("-smp") + 1], "2")
+        self.assertEqual(args[args.index("-machine") + 1], "virt")
+        self.assertIn("virtio-blk-device,drive=sd", args)
+        self.assertIn("virtio-net-device,netdev=user.0", args)
+        self.assertIn("root=/dev/vda2", args[args.index("-append") + 1].split())
+
+    def test_versatilepb_args(self):
+        """versatilepb runs on one CPU with the disk on /dev/sda."""
+        args = raspiqemu.emulator_args("test.img", False, None)
+        self.assertNotIn("-smp", args)
+        self.assertNotIn("virtio-blk-device,drive=sd", args)
+        self.assertIn("root=/dev/sda2", args[args.index("-append") + 1].split())
+
+    def test_versatilepb_limits(self):
+        """More than one CPU or 256M of RAM on versatilepb is a usage error."""
+        for options in (["--smp", "2"], ["--memory", "512"],
+                        ["--machine", "versatilepb", "--smp", "2"]):
+            with self.subTest(options=options):
+                stderr = io.StringIO()
+                with self.assertRaises(SystemExit) as cm, \
+                     contextlib.redirect_stderr(stderr):
+                    raspiqemu.main(["raspbian-qemu", "run"] + options + ["test.img"])
+                self.assertEqual(cm.exception.code, 2)
+                self.assertIn("versatilepb can only have 1 CPU and 256M of RAM",
+                              stderr.getvalue())
+
+class TestUsage(unittest.TestCase):
+    """Unit test the option combinations main() rejects as usage errors."""
+    def assertUsageError(self, argv, message):
+        """Assert main() exits with a usage error containing message."""
+        stderr = io.StringIO()
+        with self.assertRaises(SystemExit) as cm, \
+             contextlib.redirect_stderr(stderr):
+            raspiqemu.main(["raspbian-qemu"] + argv)
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn(message, stderr.getvalue())
+
+    def test_run_many_jobs(self):
+        """run-many needs to run at least one instance at a time."""
+        for jobs in ("0", "-1"):
+            with self.subTest(jobs=jobs):
+                self.assertUsageError(["run-many", "test.img", "2", "--jobs", jobs],
+                                      "--jobs must be at least 1")
+
+    def test_prep_many_jobs(self):
+        """prep-many needs at least one prep and one disk stage at a time."""
+        for option in ("--jobs", "--disk-jobs"):
+            with self.subTest(option=option):
+                self.assertUsageError(["prep-many", "test.img", option, "0"],
+                                      option + " must be at least 1")
+
+    def test_prep_cache_keep_root(self):
+        """A cached prep has no root partition to keep."""
+        self.assertUsageError(["--keep-root", "prep", "test.img", "--cache", "cache"],
+                              "--keep-root can't be used with --cache")
+
+    def test_shrink_headroom(self):
+        """shrink --headroom must be a size."""
+        for headroom in ("lots", "1.5G", "10X"):
+            with self.subTest(headroom=headroom):
+                self.assertUsageError(["shrink", "test.img", "--headroom", headroom],
+                                      "--headroom must be a number of bytes")
+
+    def test_diff_block_size(self):
+        """diff needs blocks of at least a byte."""
+        for block_size in ("0", "-64K"):
+            with self.subTest(block_size=block_size):
+                self.assertUsageError(["diff", "base.img", "test.img", "delta",
+                                       "--block-size=" + block_size],
+                                      "--block-size must be at least 1 byte")
+
+class TestFilespec(unittest.TestCase):
+    """Unit test offset_filespec() and split_filespec()."""
+    def test_round_trip(self):
+        """Split a filespec made with an offset."""
+        filespec = raspiqemu.offset_filespec("some.img", 4096)
+        self.assertEqual(raspiqemu.split_filespec(filespec), ("some.img", 4096))
+
+    def test_plain(self):
+        """Split a plain filename."""
+        self.assertEqual(raspiqemu.split_filespec("some.img"), ("some.img", 0))
+
+    def test_question_mark(self):
+        """Split a filename containing ?, with and without an offset."""
+        self.assertEqual(raspiqemu.split_filespec("what?.img"), ("what?.img", 0))
+        filespec = raspiqemu.offset_filespec("what?offset=1.img", 4096)
+        self.assertEqual(raspiqemu.split_filespec(filespec),
+                         ("what?offset=1.img", 4096))
+
+class TestPartitions(TestImageBase):
+    """Unit test read_partitions() and resize_partition()."""
+    def write_table(self, lba, entries):
+        """Write an MBR/EBR at sector lba of the test image with entries, a
+        list of (type, lba_begin, lba_size) tuples."""
+        mbr = raspiqemu.MBR()
+        mbr.signature[:] = raspiqemu.MBR.SIGNATURE
+        for partition, (type, lba_begin, lba_size) in zip(mbr.partitions, entries):
+            partition.type = type
+            partition.lba_begin = lba_begin
+            partition.lba_size = lba_size
+        with open(self.TESTIMG, "r+b") as image:
+            image.seek(lba * 512)
+            image.write(bytes(mbr))
+
+    def test_matches_read_mbr(self):
+        """Primary partitions match the second opinion."""
+        mbr = read_mbr(self.TESTIMG)
+        partitions = raspiqemu.read_partitions(self.TESTIMG)
+        self.assertEqual([(p.number, p.start, p.size, p.kind) for p in partitions],
+                         [(1, mbr.partitions[0].begin, mbr.partitions[0].size, "primary"),
+                          (2, mbr.partitions[1].begin, mbr.partitions[1].size, "primary")])
+
+    def test_resize(self):
+        """Resizing the last partition to the end of a grown image."""
+        with open(self.TESTIMG, "ab") as image:
+            image.truncate(os.path.getsize(self.TESTIMG) + 1024**2)
+        before = read_mbr(self.TESTIMG).partitions[1].size
+        raspiqemu.resize_partition(self.TESTIMG, 2)
+        self.assertEqual(read_mbr(self.TESTIMG).partitions[1].size,
+                         before + 1024**2)
+
+    def test_logical(self):
+        """Logical partitions in an extended partition."""
+        self.write_table(0, [(0x0C, 8, 8), (0x05, 16, 32)])
+        self.write_table(16, [(0x83, 2, 6), (0x05, 8, 24)])
+        self.write_table(24, [(0x83, 2, 22)])
+        partitions = raspiqemu.read_partitions(self.TESTIMG)
+        self.assertEqual([(p.number, p.start // 512, p.size // 512, p.kind)
+                          for p in partitions],
+                         [(1, 8, 8, "primary"), (2, 16, 32, "extended"),
+                          (5, 18, 6, "logical"), (6, 26, 22, "logical")])
+
+        sectors = os.path.getsize(self.TESTIMG) // 512
+        raspiqemu.resize_partition(self.TESTIMG, 6)
+        partitions = raspiqemu.read_partitions(self.TESTIMG)
+        self.assertEqual([(p.number, (p.start + p.size) // 512) for p in partitions],
+                         [(1, 16), (2, sectors), (5, 24), (6, sectors)])
+
+    def test_gpt(self):
+        """Partitions in a GPT behind a protective MBR."""
+        self.write_table(0, [(0xEE, 1, 6399)])
+        header = raspiqemu.GPTHeader()
+        header.signature[:] = raspiqemu.GPTHeader.SIGNATURE
+        header.entries_lba = 2
+        header.entry_count = 4
+        header.entry_size = 128
+        entry = raspiqemu.GPTEntry()
+        entry.type_guid[0] = 1
+        entry.first_lba = 34
+        entry.last_lba = 6000
+        with open(self.TESTIMG, "r+b") as image:
+            image.seek(512)
+            image.write(bytes(header).ljust(512, b"\0"))
+            image.write(bytes(entry) + bytes(3 * 128))
+
+        partition, = raspiqemu.read_partitions(self.TESTIMG)
+        self.assertEqual((partition.number, partition.start, partition.size,
+                          partition.kind), (1, 34 * 512, 5967 * 512, "gpt"))
+
+        # Resizing moves the backup GPT to after the partition's new end.
+        with open(self.TESTIMG, "ab") as image:
+            image.truncate(os.path.getsize(self.TESTIMG) + 1024**2)
+        sectors = os.path.getsize(self.TESTIMG) // 512
+        raspiqemu.resize_partition(self.TESTIMG, 1)
+        partition, = raspiqemu.read_partitions(self.TESTIMG)
+        self.assertEqual((partition.start + partition.size) // 512, sectors)
+        self.assertEqual(os.path.getsize(self.TESTIMG) // 512, sectors + 2)
+
+        with open(self.TESTIMG, "rb") as image:
+            for lba, other_lba, entries_lba in ((1, sectors + 1, 2),
+                                                (sectors + 1, 1, sectors)):
+                image.seek(lba * 512)
+                header = raspiqemu.GPTHeader.from_buffer_copy(image.read(92))
+                self.assertEqual((header.current_lba, header.backup_lba,
+                                  header.entries_lba, header.last_usable),
+                                 (lba, other_lba, entries_lba, sectors - 1))
+                crc, header.header_crc = header.header_crc, 0
+                self.assertEqual(zlib.crc32(bytes(header)), crc)
+                image.seek(entries_lba * 512)
+                self.assertEqual(zlib.crc32(image.read(4 * 128)), header.entries_crc)
+        self.assertEqual(read_mbr(self.TESTIMG).partitions[0].size // 512, sectors + 1)
+
+class TestFilesystemImage(TestImageBase):
+    """Unit test FilesystemImage, with and without a debugfs session."""
+    def setUp(self):
+        super().setUp()
+        root = read_mbr(self.TESTIMG).partitions[1]
+        self.rootfs = raspiqemu.offset_filespec(self.TESTIMG, root.begin)
+
+    def test_write_cat(self):
+        """Write a file and read it back within a session."""
+        with raspiqemu.FilesystemImage(self.rootfs) as rootfs:
+            rootfs.write("/etc/hello", b"HELLO", uid=0, gid=0, mode=0o600)
+            self.assertEqual(rootfs.cat("/etc/hello"), b"HELLO")
+            hello, = rootfs.ls("/etc", "hello")
+            self.assertEqual(hello.mode, 0o600)
+            self.assertEqual(hello.size, 5)
+        self.assertEqual(raspiqemu.FilesystemImage(self.rootfs).cat("/etc/hello"),
+                         b"HELLO")
+
+    def test_queued_until_close(self):
+        """Writes in a session are only sent when it closes cleanly."""
+        with raspiqemu.FilesystemImage(self.rootfs) as rootfs:
+            rootfs.write("/etc/hello", b"HELLO")
+        with self.assertRaises(KeyError):
+            with raspiqemu.FilesystemImage(self.rootfs) as rootfs:
+                rootfs.rm("/etc/hello")
+                raise KeyError
+        self.assertEqual(raspiqemu.FilesystemImage(self.rootfs).cat("/etc/hello"),
+                         b"HELLO")
+
+    def test_binary_without_newline(self):
+        """Read back contents which would confuse line-based parsing."""
+        contents = bytes(range(256)) * 64 + b"debugfs: no newline"
+        with raspiqemu.FilesystemImage(self.rootfs) as rootfs:
+            rootfs.write("/etc/binary", contents)
+            self.assertEqual(rootfs.cat("/etc/binary"), contents)
+            self.assertEqual(rootfs.cat("/etc/missing"), b"")
+            self.assertEqual(rootfs.cat("/etc/binary"), contents)
+
+    def test_mark_across_reads(self):
+        """Find the end of a command's output split across reads of debugfs."""
+        class Session:
+            def __init__(self, output):
+                self.stdin = io.BytesIO()
+                self.stdout = io.BufferedReader(io.BytesIO(output), 64 * 1024)
+                self.args = ["debugfs"]
+            def wait(self):
+                return 1
+        rootfs = raspiqemu.FilesystemImage(self.rootfs)
+        rootfs.token, rootfs.marks, rootfs.pending = b"token", 0, []
+        mark = b"# raspbian-qemu token 1\n"
+        echo = b"debugfs: cat /etc/big\n"
+        # The mark starts just before the end of the second 64K read and a
+        # full read follows it.
+        contents = b"x" * (2 * 64 * 1024 - len(echo) - 5)
+        rootfs.session = Session(echo + contents + mark + rootfs.PADDING * 8)
+        self.assertEqual(rootfs.request("cat /etc/big"), contents)
+
+        # Without the echo of the command its output can't be told apart.
+        rootfs.session = Session(contents + b"# raspbian-qemu token 2\n")
+        with self.assertRaises(ValueError):
+            rootfs.request("cat /etc/big")
+
+class TestExt4Image(TestImageBase):
+    """Unit test Ext4Image against debugfs through FilesystemImage."""
+    def setUp(self):
+        super().setUp()
+        root = read_mbr(self.TESTIMG).partitions[1]
+        self.rootfs = raspiqemu.offset_filespec(self.TESTIMG, root.begin)
+
+    def test_matches_debugfs(self):
+        """Every directory listing and file matches what debugfs reads."""
+        with raspiqemu.FilesystemImage(self.rootfs) as rootfs:
+            rootfs.write("/etc/binary", bytes(range(256)) * 1024,
+                         uid=1000, gid=1000, mode=0o640)
+
+        with raspiqemu.FilesystemImage(self.rootfs) as debugfs, \
+             raspiqemu.Ext4Image(self.rootfs) as native:
+            paths = ["/"]
+            for path in paths:
+                listed = {file.name: file for file in native.ls(path)}
+                for name, file in listed.items():
+                    filespec = os.path.join(path, name)
+                    if file.isdir():
+                        paths.append(filespec)
+                    elif file.isreg():
+                        self.assertEqual(native.cat(filespec),
+                                         debugfs.cat(filespec))
+
+                try:
+                    expected = {file.name: file for file in debugfs.ls(path)}
+                except NotImplementedError:
+                    # debugfs.ls() only handles files and directories.
+                    continue
+                self.assertEqual(sorted(listed), sorted(expected))
+                for name, file in listed.items():
+                    self.assertEqual((file.type, file.mode, file.uid,
+                                      file.gid, file.size),
+                                     (expected[name].type, expected[name].mode,
+                                      expected[name].uid, expected[name].gid,
+                                      expected[name].size))
+            self.assertIn("/etc", paths)
+
+    def test_missing(self):
+        """Missing files and directories read as empty."""
+        with raspiqemu.Ext4Image(self.rootfs) as native:
+            self.assertEqual(native.cat("/etc/missing"), b"")
+            self.assertEqual(list(native.ls("/missing")), [])
+
+    def test_not_ext4(self):
+        """Refuse to read something that's not a filesystem."""
+        with self.assertRaises(ValueError):
+            with raspiqemu.Ext4Image(self.TESTIMG):
+                pass
+
+    def test_symlinks_inline_data(self):
+        """Read fast symlinks and inline data like debugfs."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, "source")
+            os.makedirs(os.path.join(source, "dir"))
+            with open(os.path.join(source, "dir", "file"), "wb") as f:
+                f.write(b"HELLO")
+            os.symlink("dir/file", os.path.join(source, "fast"))
+            # Too long for the block map, so kept in an extended attribute.
+            os.symlink("t" * 80, os.path.join(source, "long"))
+            filesystem = os.path.join(tmpdir, "fs.img")
+            subprocess.check_call(["mke2fs", "-q", "-t", "ext4", "-O", "inline_data",
+                                   "-d", source, filesystem, "1M"],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+            with raspiqemu.FilesystemImage(filesystem) as debugfs, \
+                 raspiqemu.Ext4Image(filesystem) as native:
+                self.assertTrue(native.inode(native.lookup("/dir")).flags
+                                & native.INLINE_DATA_FL)
+                self.assertEqual(sorted(file.name for file in native.ls("/dir")),
+                                 sorted(file.name for file in debugfs.ls("/dir")))
+                self.assertEqual(native.cat("/dir/file"), b"HELLO")
+                self.assertIn(b'Fast link dest: "%s"' % (native.cat("/fast"),),
+                              debugfs.debugfs(["stat /fast"]))
+                self.assertEqual(native.cat("/fast"), b"dir/file")
+                self.assertEqual(native.cat("/long"), b"t" * 80)
+
+    def test_free_ranges(self):
+        """Free ranges add up to the superblock's count of free blocks."""
+        with raspiqemu.Ext4Image(self.rootfs) as native:
+            free_blocks, = struct.unpack_from("<I", native.read(1024, 1024), 0x0C)
+            ranges = list(native.free_ranges())
+            self.assertTrue(ranges)
+            self.assertEqual(sum(length for offset, length in ranges),
+                             free_blocks * native.block_size)
+
+class TestCompact(TestImageBase):
+    """Unit test compact_image() and fat_free_ranges()."""
+    def write_fat12(self, start):
+        """Write a 4K FAT12 file system at start in the test image, with
+        clusters 3, 4 and 6 free and each of its five clusters full of its
+        own number."""
+        boot = bytearray(512)
+        struct.pack_into("<HBHBHH", boot, 0x0B, 512, 1, 1, 1, 16, 8)
+        struct.pack_into("<H", boot, 0x16, 1)
+        boot[510:512] = b"\x55\xAA"
+        entries = (0xFF8, 0xFFF, 0xFFF, 0, 0, 0xFFF, 0, 0)
+        fat = bytearray(512)
+        for pair in range(0, len(entries), 2):
+            first, second = entries[pair:pair + 2]
+            fat[pair * 3 // 2:pair * 3 // 2 + 3] = bytes((first & 0xFF,
+                                                          first >> 8 | (second & 0xF) << 4,
+                                                          second >> 4))
+        clusters = b"".join(bytes((number,)) * 512 for number in range(2, 7))
+        with open(self.TESTIMG, "r+b") as image:
+            image.seek(start)
+            image.write(boot + fat + bytes(512) + clusters)
+
+    def test_fat_free_ranges(self):
+        """Free clusters are found from the FAT and punched out."""
+        boot = raspiqemu.read_partitions(self.TESTIMG)[0]
+        self.write_fat12(boot.start)
+        filespec = raspiqemu.offset_filespec(self.TESTIMG, boot.start)
+        self.assertEqual(raspiqemu.fat_free_ranges(filespec),
+                         [(2048, 1024), (3584, 512)])
+
+        raspiqemu.compact_image(self.TESTIMG)
+        with open(self.TESTIMG, "rb") as image:
+            image.seek(boot.start + 1536)
+            self.assertEqual(image.read(2560),
+                             bytes((2,)) * 512 + bytes(1024)
+                             + bytes((5,)) * 512 + bytes(512))
+
+    def test_not_fat(self):
+        """An ext4 file system isn't taken for FAT."""
+        root = raspiqemu.read_partitions(self.TESTIMG)[1]
+        self.assertIsNone(raspiqemu.fat_free_ranges(
+            raspiqemu.offset_filespec(self.TESTIMG, root.start)))
+
+    def test_compact_keeps_files(self):
+        """Compacting frees space without changing any file."""
+        root = raspiqemu.read_partitions(self.TESTIMG)[1]
+        rootfs = raspiqemu.offset_filespec(self.TESTIMG, root.start)
+        def contents():
+            """Return the contents of the files in /etc."""
+            with raspiqemu.Ext4Image(rootfs) as native:
+                return {file.name: native.cat("/etc/" + file.name)
+                        for file in native.ls("/etc") if file.isreg()}
+        before = contents()
+        with raspiqemu.Ext4Image(rootfs) as native:
+            offset, length = next(native.free_ranges())
+        with open(self.TESTIMG, "r+b") as image:
+            image.seek(root.start + offset)
+            image.write(b"stale" * (length // 5))
+        self.assertGreater(raspiqemu.compact_image(self.TESTIMG), 0)
+        self.assertEqual(contents(), before)
+        with open(self.TESTIMG, "rb") as image:
+            self.assertNotIn(b"stale", image.read())
+
 if __name__ == "__main__":
     unittest.main(failfast=True)